@@ -0,0 +1,430 @@
+﻿"""
+AnkiConnect stand-in backed by an in-memory collection.
+
+Implements the actions Focus uses, with the response format of AnkiConnect version 6, so anki_handler,
+anki_async and display.screens can be exercised and benchmarked without Anki. Latency can be injected per request
+(HTTP and scheduling overhead), per action (work done on Anki's main thread, one action at a time) and per note of
+the actions taking a list of notes, and actions can be made to fail at a given rate.
+
+    python bench/anki_server.py [--port 8765] [--request-latency 0.002] [--action-latency 0.0005]
+                                [--note-latency 0.0] [--error addNote=0.1]
+"""
+import argparse
+import fnmatch
+import html
+import json
+import random
+import re
+import shlex
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+_RE_HTML_TAG = re.compile(r'<[^>]+>')
+
+
+class AnkiError(Exception):
+    pass
+
+
+def _first_field_key(value: str) -> str:
+    return html.unescape(_RE_HTML_TAG.sub('', value)).strip()
+
+
+class Collection:
+    """ In-memory profiles, models, decks, notes and media, with the AnkiConnect actions as methods. """
+    def __init__(self, profiles=('User 1',)):
+        self.profiles = list(profiles)
+        self.profile = self.profiles[0]
+        self.models: Dict[str, dict] = {}
+        self.decks = {'Default'}
+        self.notes: Dict[int, dict] = {}
+        self.media: Dict[str, str] = {}
+        self.gui_edits: List[int] = []
+
+        self._next_id = int(time.time() * 1000)
+
+    def _new_id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    # profiles
+    def getProfiles(self):
+        return self.profiles
+
+    def loadProfile(self, name):
+        if name not in self.profiles:
+            return False
+        self.profile = name
+        return True
+
+    def version(self):
+        return 6
+
+    # models
+    def modelNames(self):
+        return list(self.models)
+
+    def createModel(self, modelName, inOrderFields, cardTemplates, css='', isCloze=False):
+        if modelName in self.models:
+            raise AnkiError('Model name already exists')
+        self.models[modelName] = {
+            'fields': list(inOrderFields),
+            'css': css,
+            'templates': {t['Name']: {'Front': t['Front'], 'Back': t['Back']} for t in cardTemplates},
+        }
+        return {'name': modelName}
+
+    def _model(self, name) -> dict:
+        if name not in self.models:
+            raise AnkiError(f'model was not found: {name}')
+        return self.models[name]
+
+    def modelFieldNames(self, modelName):
+        return list(self._model(modelName)['fields'])
+
+    def modelFieldAdd(self, modelName, fieldName, index=None):
+        fields = self._model(modelName)['fields']
+        if fieldName in fields:
+            raise AnkiError(f'field already exists: {fieldName}')
+        fields.insert(len(fields) if index is None else index, fieldName)
+        for note in self.notes.values():
+            if note['modelName'] == modelName:
+                note['fields'] = {f: note['fields'].get(f, '') for f in fields}
+
+    def modelTemplates(self, modelName):
+        return {k: dict(v) for k, v in self._model(modelName)['templates'].items()}
+
+    def modelStyling(self, modelName):
+        return {'css': self._model(modelName)['css']}
+
+    def modelTemplateAdd(self, modelName, template):
+        self._model(modelName)['templates'][template['Name']] = {'Front': template['Front'], 'Back': template['Back']}
+
+    def updateModelTemplates(self, model):
+        self._model(model['name'])['templates'].update(model['templates'])
+
+    def updateModelStyling(self, model):
+        self._model(model['name'])['css'] = model['css']
+
+    # decks
+    def createDeck(self, deck):
+        self.decks.add(deck)
+        return self._new_id()
+
+    def deleteDecks(self, decks, cardsToo=False):
+        if not cardsToo:
+            raise AnkiError('Since Anki 2.1.28 it\'s not possible to delete decks without deleting cards as well')
+        for deck in decks:
+            self.decks.discard(deck)
+            for note_id in [i for i, n in self.notes.items() if _in_deck(n['deckName'], deck)]:
+                del self.notes[note_id]
+
+    def getDecks(self, cards):
+        card_notes = self._card_notes()
+        decks = {}
+        for card in cards:
+            if card in card_notes:
+                decks.setdefault(card_notes[card]['deckName'], []).append(card)
+        return decks
+
+    def changeDeck(self, cards, deck):
+        self.decks.add(deck)
+        card_notes = self._card_notes()
+        for card in cards:
+            if card in card_notes:
+                card_notes[card]['deckName'] = deck
+
+    def _card_notes(self) -> Dict[int, dict]:
+        # the deck is kept per note, all cards of a note move together
+        return {card: note for note in self.notes.values() for card in note['cards']}
+
+    # notes
+    def _can_add(self, note) -> str | None:
+        model = self._model(note['modelName'])
+        if note['deckName'] not in self.decks:
+            return f'deck was not found: {note["deckName"]}'
+
+        first = _first_field_key(note['fields'].get(model['fields'][0], ''))
+        if first == '':
+            return 'cannot create note because it is empty'
+        for other in self.notes.values():
+            if other['modelName'] == note['modelName'] and _first_field_key(other['fields'][model['fields'][0]]) == first:
+                return 'cannot create note because it is a duplicate'
+        return None
+
+    def canAddNotes(self, notes):
+        return [self._can_add(n) is None for n in notes]
+
+    def canAddNotesWithErrorDetail(self, notes):
+        out = []
+        for note in notes:
+            try:
+                error = self._can_add(note)
+            except AnkiError as ex:
+                error = str(ex)
+            out.append({'canAdd': True} if error is None else {'canAdd': False, 'error': error})
+        return out
+
+    def addNote(self, note):
+        error = self._can_add(note)
+        if error is not None:
+            raise AnkiError(error)
+
+        note_id = self._new_id()
+        model = self._model(note['modelName'])
+        self.notes[note_id] = {
+            'noteId': note_id,
+            'modelName': note['modelName'],
+            'deckName': note['deckName'],
+            'fields': {f: note['fields'].get(f, '') for f in model['fields']},
+            'tags': list(note.get('tags', [])),
+            'mod': int(time.time()),
+            'cards': [self._new_id() for _ in model['templates']],
+        }
+        return note_id
+
+    def addNotes(self, notes):
+        # like AnkiConnect: all notes or none of them are added
+        results, errors = [], []
+        for note in notes:
+            try:
+                results.append(self.addNote(note))
+            except AnkiError as ex:
+                errors.append(str(ex))
+        if errors:
+            self.deleteNotes(results)
+            raise AnkiError(str(errors))
+        return results
+
+    def updateNoteFields(self, note):
+        if note['id'] not in self.notes:
+            raise AnkiError(f'note was not found: {note["id"]}')
+        stored = self.notes[note['id']]
+        stored['fields'].update(note['fields'])
+        stored['mod'] = int(time.time())
+        return None
+
+    def updateNoteTags(self, note, tags):
+        if note not in self.notes:
+            raise AnkiError(f'note was not found: {note}')
+        self.notes[note]['tags'] = list(tags)
+
+    def deleteNotes(self, notes):
+        for note_id in notes:
+            self.notes.pop(note_id, None)
+
+    def notesInfo(self, notes):
+        out = []
+        for note_id in notes:
+            note = self.notes.get(note_id)
+            if note is None:
+                out.append({})
+                continue
+            out.append({
+                'noteId': note_id,
+                'modelName': note['modelName'],
+                'tags': list(note['tags']),
+                'fields': {f: {'value': v, 'order': i} for i, (f, v) in enumerate(note['fields'].items())},
+                'mod': note['mod'],
+                'cards': list(note['cards']),
+            })
+        return out
+
+    def findNotes(self, query):
+        terms = [t for t in shlex.split(query) if t.lower() != 'and']
+
+        note_ids = []
+        for note_id, note in self.notes.items():
+            if all(_match(note, term) for term in terms):
+                note_ids.append(note_id)
+        return note_ids
+
+    def guiEditNote(self, note):
+        if note not in self.notes:
+            raise AnkiError(f'note was not found: {note}')
+        self.gui_edits.append(note)
+
+    # media
+    def storeMediaFile(self, filename, data=None, path=None, url=None, deleteExisting=True):
+        if data is None:
+            raise AnkiError('only "data" is supported by the stand-in')
+        self.media[filename] = data
+        return filename
+
+    def getMediaFilesNames(self, pattern='*'):
+        return [name for name in self.media if fnmatch.fnmatchcase(name, pattern)]
+
+
+def _in_deck(note_deck: str, deck: str) -> bool:
+    note_deck, deck = note_deck.lower(), deck.lower()
+    return note_deck == deck or note_deck.startswith(deck + '::')
+
+
+def _match(note: dict, term: str) -> bool:
+    key, _, value = term.partition(':')
+    key = key.lower()
+    if key == 'deck':
+        return _in_deck(note['deckName'], value)
+    if key == 'tag':
+        value = value.lower()
+        return any(t.lower() == value or t.lower().startswith(value + '::') for t in note['tags'])
+    if key == 'note':
+        return note['modelName'] == value
+    if key == 'edited':
+        return note['mod'] >= time.time() - int(value) * 86400
+    if key == 'nid':
+        return str(note['noteId']) in value.split(',')
+    fields = {name.lower(): v for name, v in note['fields'].items()}
+    if key in fields:
+        # exact field search, wildcards are not supported
+        return fields[key].lower() == re.sub(r'\\(.)', r'\1', value).lower()
+    raise AnkiError(f'unsupported search term: {term}')
+
+
+class AnkiConnectStandIn:
+    """
+    Threaded HTTP server around a Collection.
+    :param request_latency: seconds added to every HTTP request, outside the collection lock.
+    :param action_latency: seconds added to every action, inside the collection lock, per action name or '*'.
+    :param note_latency: seconds added per note of the actions taking a list of notes, like canAddNotesWithErrorDetail.
+    :param error_rate: probability of failing an action, per action name or '*'.
+    """
+    def __init__(self, host='127.0.0.1', port=0, collection: Collection = None, request_latency=0.0,
+                 action_latency: Dict[str, float] | float = 0.0, error_rate: Dict[str, float] = None, seed=None,
+                 note_latency=0.0):
+        self.collection = collection if collection is not None else Collection()
+        self.request_latency = request_latency
+        self.action_latency = action_latency if isinstance(action_latency, dict) else {'*': action_latency}
+        self.note_latency = note_latency
+        self.error_rate = error_rate if error_rate is not None else {}
+        self.requests = 0
+        self.actions: Dict[str, int] = {}
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def dispatch(self, request: dict) -> dict:
+        self.requests += 1
+        if self.request_latency:
+            time.sleep(self.request_latency)
+
+        action = request.get('action')
+        if action == 'multi':
+            results = []
+            for sub in request.get('params', {}).get('actions', []):
+                results.append(self._run(sub['action'], sub.get('params', {})))
+            return {'result': results, 'error': None}
+        return self._run(action, request.get('params', {}))
+
+    def _run(self, action, params) -> dict:
+        self.actions[action] = self.actions.get(action, 0) + 1
+        with self._lock:
+            latency = self.action_latency.get(action, self.action_latency.get('*', 0.0))
+            if isinstance(params.get('notes'), list):
+                latency += self.note_latency * len(params['notes'])
+            if latency:
+                time.sleep(latency)
+
+            if self._random.random() < self.error_rate.get(action, self.error_rate.get('*', 0.0)):
+                return {'result': None, 'error': f'injected error: {action}'}
+
+            func = getattr(self.collection, action, None) if not action.startswith('_') else None
+            if func is None:
+                return {'result': None, 'error': 'unsupported action'}
+            try:
+                return {'result': func(**params), 'error': None}
+            except (AnkiError, TypeError, KeyError) as ex:
+                return {'result': None, 'error': str(ex)}
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                try:
+                    response = stand_in.dispatch(json.loads(body))
+                except json.JSONDecodeError as ex:
+                    response = {'result': None, 'error': str(ex)}
+
+                data = json.dumps(response).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client timed out and closed the connection
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def _parse_rates(values: List[str]) -> Dict[str, float]:
+    rates = {}
+    for value in values:
+        action, _, rate = value.partition('=')
+        rates[action] = float(rate)
+    return rates
+
+
+def _main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--profile', action='append', default=None, help='profile name, may be repeated')
+    parser.add_argument('--request-latency', type=float, default=0.0)
+    parser.add_argument('--action-latency', type=float, default=0.0)
+    parser.add_argument('--note-latency', type=float, default=0.0)
+    parser.add_argument('--error', action='append', default=[], metavar='ACTION=RATE', help='error rate of an action')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    collection = Collection(args.profile if args.profile else ('User 1',))
+    server = AnkiConnectStandIn(
+        args.host, args.port, collection, args.request_latency, args.action_latency, _parse_rates(args.error),
+        args.seed, args.note_latency
+    )
+    print(f'AnkiConnect stand-in listening on {args.host}:{server.address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    _main()
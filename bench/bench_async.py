@@ -0,0 +1,101 @@
+﻿"""
+Blocking vs asyncio duplicate check benchmark.
+
+Adds synthetic notes spread over several decks, then checks near-duplicates of them with:
+    sequential  canAddNotesWithErrorDetail + AnkiNote.calculate_ratio per note
+    batched     canAddNotesWithErrorDetail + anki_handler.calculate_ratios
+    async       anki_async.check_notes with --concurrency actions in flight
+and deletes everything afterwards. Runs against the AnkiConnect server at --host/--port, which needs the Focus model,
+or against bench/anki_server.py with --stand-in.
+
+    python bench/bench_async.py [--notes 200] [--decks 8] [--concurrency 4] [--port 8765 | --stand-in]
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+from common import start_stand_in
+
+# focus imports
+import anki_async
+import anki_handler
+from anki_handler import AnkiNote, AnkiConnectClient
+
+
+def build_notes(n: int, decks: list, run: str, suffix='') -> list:
+    return [
+        AnkiNote(decks[i % len(decks)], f'<p>bench {run} question {i}{suffix}</p>', f'<p>answer {i}</p>', ['bench/async'])
+        for i in range(n)
+    ]
+
+
+def check_sequential(notes):
+    result = anki_handler.invoke('canAddNotesWithErrorDetail', notes=[n.to_json() for n in notes])
+    for note, res in zip(notes, result):
+        note.parse_can_add_response(res)
+
+
+def check_batched(notes):
+    result = anki_handler.invoke('canAddNotesWithErrorDetail', notes=[n.to_json() for n in notes])
+    for note, res in zip(notes, result):
+        note.parse_can_add_response(res, calculate=False)
+    anki_handler.calculate_ratios([n for n in notes if not n.is_valid()])
+
+
+async def check_async(notes, host, port, concurrency):
+    async with anki_async.AsyncAnkiConnectClient(host, port, concurrency=concurrency) as client:
+        await anki_async.check_notes(client, notes)
+
+
+def timed(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def _main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--notes', type=int, default=200)
+    parser.add_argument('--decks', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, default=anki_async.DEFAULT_CONCURRENCY)
+    parser.add_argument('--host', default=anki_handler.ANKI_CONNECT_HOST)
+    parser.add_argument('--port', type=int, default=anki_handler.ANKI_CONNECT_PORT)
+    parser.add_argument('--stand-in', action='store_true', help='run against bench/anki_server.py')
+    parser.add_argument('--request-latency', type=float, default=0.002, help='stand-in latency per request')
+    parser.add_argument('--action-latency', type=float, default=0.0005, help='stand-in latency per action')
+    args = parser.parse_args()
+
+    if args.stand_in:
+        server = start_stand_in(request_latency=args.request_latency, action_latency=args.action_latency)
+        args.host, args.port = server.address
+
+    if not args.stand_in:
+        anki_handler.set_client(AnkiConnectClient(args.host, args.port))
+
+    run = uuid.uuid4().hex[:8]
+    decks = [f'Focus Benchmark::{run}::{i}' for i in range(args.decks)]
+    for deck in decks:
+        anki_handler.invoke('createDeck', deck=deck)
+
+    added = anki_handler.push_notes(build_notes(args.notes, decks, run))
+    try:
+        # the first field is identical, so every note comes back as a duplicate and gets scored
+        sequential = timed(check_sequential, build_notes(args.notes, decks, run))
+        batched = timed(check_batched, build_notes(args.notes, decks, run))
+        asynchronous = timed(
+            lambda x: asyncio.run(check_async(x, args.host, args.port, args.concurrency)),
+            build_notes(args.notes, decks, run)
+        )
+    finally:
+        anki_handler.invoke('deleteNotes', notes=[i for i in added if i is not None])
+        anki_handler.invoke('deleteDecks', decks=decks, cardsToo=True)
+
+    print(f'notes={args.notes} decks={args.decks}')
+    print(f'\tsequential {sequential:8.3f} s')
+    print(f'\tbatched    {batched:8.3f} s')
+    print(f'\tasync      {asynchronous:8.3f} s (concurrency={args.concurrency})')
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,60 @@
+﻿"""
+Single file sync benchmark against the AnkiConnect stand-in.
+
+Writes a large synthetic vault and crawls it once to save its link index, then times main --files for one file:
+sync.sync_files converts that file only, resolving its links through the index, and pushes its notes. The first
+sync adds the notes, the second one finds them unchanged. The target is under a second.
+
+    python bench/bench_files.py [--files 5000] [--cards 10] [--request-latency 0.002]
+"""
+import argparse
+import tempfile
+import time
+
+from os import path
+
+from bench_sync import write_vault
+from common import start_stand_in
+
+# focus imports
+import anki_handler
+import settings
+import sync
+from crawler import VaultCrawler, link_index_path
+
+BUDGET = 1.0
+
+
+def _main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--cards', type=int, default=10)
+    parser.add_argument('--request-latency', type=float, default=0.002)
+    args = parser.parse_args()
+
+    server = start_stand_in(request_latency=args.request_latency)
+    for f in range(5):
+        anki_handler.invoke('createDeck', deck=f'deck{f}')
+
+    with tempfile.TemporaryDirectory() as vault, tempfile.TemporaryDirectory() as out:
+        settings.OUTPUT_DIR = out
+        write_vault(vault, args.files, args.cards, 0)
+
+        start = time.perf_counter()
+        VaultCrawler(vault, index_path=link_index_path(out, vault)).convert_files()
+        print(f'whole vault: {args.files} files crawled and converted in {time.perf_counter() - start:.3f} s')
+
+        target = path.join(vault, 'deck1_topic1.md')
+        for label in ('add', 'unchanged'):
+            server.requests = 0
+            start = time.perf_counter()
+            report = sync.sync_files([target], [(vault, server.collection.profile)])[0]
+            elapsed = time.perf_counter() - start
+            print(f'{label}: {report.added} added, {report.unchanged} unchanged in {elapsed:.3f} s, '
+                  f'{server.requests} requests{"" if elapsed <= BUDGET else "  OVER BUDGET"}')
+
+    server.stop()
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,92 @@
+﻿"""
+Printer benchmark.
+
+Reports notes per second for note_to_html and the cost of each transform of text_to_html, for synthetic notes
+built from the fixture corpus at several sizes.
+
+    python bench/bench_printer.py [--sizes 1 4 16 64] [--repeat 5]
+"""
+import argparse
+import time
+
+from typing import Callable, List, Tuple
+
+from common import load_text_fixtures
+
+# focus imports
+import markdown
+import printer
+
+
+def _stages(lower_headings=False, web=False) -> List[Tuple[str, Callable[[str], str]]]:
+    # mirrors the order of printer.text_to_html
+    stages = [
+        ('media_embed', printer._replace_media_embed),
+        ('link', printer._replace_link),
+        ('strikethrough', printer._replace_strikethrough),
+        ('tags', lambda t: printer._RE_TAGS.sub('', t)),
+        ('hr', lambda t: printer._RE_HR.sub('', t)),
+    ]
+    if lower_headings:
+        stages.append(('lower_headings', printer._lower_headings))
+    stages.extend([
+        ('safe_headings', printer._safe_headings),
+        ('safe_lists', printer._safe_lists),
+        ('highlight', printer._replace_highlight),
+        ('anki_mathjax', printer._replace_anki_mathjax),
+        ('markdown', lambda t: markdown.markdown(t, extensions=['tables', 'sane_lists'])),
+        ('callout', printer._replace_callout),
+    ])
+    if web:
+        stages.append(('mathjax', printer._replace_mathjax))
+    return stages
+
+
+def build_note(size: int) -> List[Tuple[str, str]]:
+    """ A single field note whose answer repeats the whole fixture corpus `size` times. """
+    corpus = '\n\n'.join(load_text_fixtures().values())
+    return [('What does the corpus render to? [[corpus|ans]]', '\n\n'.join([corpus] * size))]
+
+
+def bench_notes(fields, repeat: int, web=False) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        printer.note_to_html(fields, web=web)
+    elapsed = time.perf_counter() - start
+    return repeat / elapsed
+
+
+def bench_stages(text: str, repeat: int, web=False) -> List[Tuple[str, float]]:
+    stages = _stages(web=web)
+    costs = {name: 0.0 for name, _ in stages}
+    for _ in range(repeat):
+        t = text
+        for name, func in stages:
+            start = time.perf_counter()
+            t = func(t)
+            costs[name] += time.perf_counter() - start
+    return [(name, cost / repeat) for name, cost in costs.items()]
+
+
+def _main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--web', action='store_true', help='benchmark the web preview rendering')
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        fields = build_note(size)
+        n_chars = sum(len(q) + len(ans) for q, ans in fields)
+
+        notes_per_sec = bench_notes(fields, args.repeat, web=args.web)
+        print(f'size={size} chars={n_chars}: {notes_per_sec:.1f} notes/s')
+
+        stages = bench_stages(fields[0][1], args.repeat, web=args.web)
+        total = sum(cost for _, cost in stages)
+        for name, cost in stages:
+            print(f'\t{name:<16}{cost * 1000:10.3f} ms {100 * cost / total:6.1f}%')
+
+
+if __name__ == '__main__':
+    _main()
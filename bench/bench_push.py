@@ -0,0 +1,70 @@
+﻿"""
+Note insertion benchmark.
+
+Adds the same synthetic notes with push_notes_sequential (one addNote per note) and with push_notes (bulk addNotes
+in chunks), then deletes them. Runs against the AnkiConnect server at --host/--port, which needs the Focus model,
+or against bench/anki_server.py with --stand-in. The notes go to a throwaway deck.
+
+    python bench/bench_push.py [--notes 100 1000] [--chunk-size 100] [--port 8765 | --stand-in]
+"""
+import argparse
+import time
+import uuid
+
+from common import start_stand_in
+
+# focus imports
+import anki_handler
+from anki_handler import AnkiNote, AnkiConnectClient
+
+
+def build_notes(n: int, deck: str) -> list:
+    run = uuid.uuid4().hex[:8]
+    return [
+        AnkiNote(deck, f'<p>benchmark {run} question {i}</p>', f'<p>benchmark answer {i}</p>', ['bench/push'])
+        for i in range(n)
+    ]
+
+
+def bench(func, notes) -> float:
+    start = time.perf_counter()
+    results = func(notes)
+    elapsed = time.perf_counter() - start
+
+    added = [r for r in results if r is not None]
+    anki_handler.invoke('deleteNotes', notes=added)
+    if len(added) != len(notes):
+        print(f'WARNING: {len(notes) - len(added)} notes were not added')
+    return elapsed
+
+
+def _main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--notes', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--chunk-size', type=int, default=anki_handler.BATCH_CHUNK_SIZE)
+    parser.add_argument('--deck', default='Focus Benchmark')
+    parser.add_argument('--host', default=anki_handler.ANKI_CONNECT_HOST)
+    parser.add_argument('--port', type=int, default=anki_handler.ANKI_CONNECT_PORT)
+    parser.add_argument('--stand-in', action='store_true', help='run against bench/anki_server.py')
+    parser.add_argument('--request-latency', type=float, default=0.002, help='stand-in latency per request')
+    parser.add_argument('--action-latency', type=float, default=0.0005, help='stand-in latency per action')
+    args = parser.parse_args()
+
+    if args.stand_in:
+        server = start_stand_in(request_latency=args.request_latency, action_latency=args.action_latency)
+        args.host, args.port = server.address
+
+    if not args.stand_in:
+        anki_handler.set_client(AnkiConnectClient(args.host, args.port))
+    anki_handler.invoke('createDeck', deck=args.deck)
+
+    for n in args.notes:
+        sequential = bench(anki_handler.push_notes_sequential, build_notes(n, args.deck))
+        bulk = bench(lambda x: anki_handler.push_notes(x, args.chunk_size), build_notes(n, args.deck))
+        print(f'notes={n}: sequential {n / sequential:8.1f} notes/s, bulk {n / bulk:8.1f} notes/s')
+
+    anki_handler.invoke('deleteDecks', decks=[args.deck], cardsToo=True)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,134 @@
+﻿"""
+Startup benchmark.
+
+Times `import main` and `import display` in fresh interpreters with `python -X importtime`, lists the slowest
+modules, checks that the heavy modules stay out of the startup, and times the first window of the wizard (the Tk
+window is shown before the vault is read, so an empty vault is enough). Exits with status 1 when a time is over its
+budget or a heavy module is imported, so the numbers can be tracked.
+
+    python bench/bench_startup.py [--repeat 5] [--top 10]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from typing import Dict, List, Tuple
+
+from common import SRC
+
+# milliseconds, the median of --repeat runs
+IMPORT_BUDGET_MS = 100
+DISPLAY_BUDGET_MS = 250
+WINDOW_BUDGET_MS = 1000
+
+# must not be imported by `import main` or, for the first three, by the first window either
+LAZY_MODULES = ('markdown', 'difflib', 'webbrowser', 'tkinter', 'display', 'printer', 'export')
+FIRST_USE_MODULES = LAZY_MODULES[:3]
+
+_PRELUDE = f'import sys; sys.path.insert(0, {SRC!r}); '
+
+_WINDOW_SCRIPT = _PRELUDE + """
+import time
+start = time.perf_counter()
+
+from tkinter import Tk, TclError
+from crawler import VaultCrawler
+from display.focus import Focus
+
+try:
+    root = Tk()
+except TclError as ex:
+    print('skipped', ex)
+    sys.exit(0)
+
+root.columnconfigure(0, weight=1, minsize=900)
+root.rowconfigure(0, weight=1, minsize=600)
+app = Focus(root, VaultCrawler(sys.argv[1], crawl=False))
+app.mainloop()
+root.update()
+print('window', (time.perf_counter() - start) * 1000)
+root.destroy()
+"""
+
+
+def import_times(statement: str) -> Dict[str, Tuple[int, int]]:
+    """
+    :return: module -> (self, cumulative) import time in microseconds, from -X importtime of a new interpreter.
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', _PRELUDE + statement],
+        capture_output=True, text=True, check=True
+    )
+
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix('import time:').split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def window_time(vault: str) -> float | None:
+    proc = subprocess.run([sys.executable, '-c', _WINDOW_SCRIPT, vault], capture_output=True, text=True, check=True)
+    kind, value = proc.stdout.strip().split(' ', maxsplit=1)
+    if kind == 'skipped':
+        print(f'first window skipped, no display: {value}')
+        return None
+    return float(value)
+
+
+def _report(label: str, samples: List[float], budget: float) -> bool:
+    median = statistics.median(samples)
+    is_ok = median <= budget
+    print(f'{label:<16}{median:8.1f} ms (min {min(samples):.1f}, budget {budget} ms){"" if is_ok else "  OVER BUDGET"}')
+    return is_ok
+
+
+def _main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    main_ms, display_ms = [], []
+    times, display_times = {}, {}
+    for _ in range(args.repeat):
+        times = import_times('import main')
+        main_ms.append(times['main'][1] / 1000)
+        display_times = import_times('import main; import display')
+        display_ms.append(display_times['display'][1] / 1000)
+
+    is_ok = _report('import main', main_ms, IMPORT_BUDGET_MS)
+    is_ok &= _report('import display', display_ms, DISPLAY_BUDGET_MS)
+
+    eager = [name for name in LAZY_MODULES if name in times]
+    if eager:
+        print(f'imported by main but should be lazy: {", ".join(eager)}')
+        is_ok = False
+    eager = [name for name in FIRST_USE_MODULES if name in display_times]
+    if eager:
+        print(f'imported by display but should be lazy: {", ".join(eager)}')
+        is_ok = False
+
+    print('slowest modules of import main (self time):')
+    for name, (self_us, cumulative_us) in sorted(times.items(), key=lambda kv: -kv[1][0])[:args.top]:
+        print(f'\t{name:<32}{self_us / 1000:8.2f} ms{cumulative_us / 1000:10.2f} ms cumulative')
+
+    samples = []
+    with tempfile.TemporaryDirectory() as vault:
+        for _ in range(args.repeat):
+            ms = window_time(vault)
+            if ms is None:
+                break
+            samples.append(ms)
+    if samples:
+        is_ok &= _report('first window', samples, WINDOW_BUDGET_MS)
+
+    sys.exit(0 if is_ok else 1)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,139 @@
+﻿"""
+End-to-end sync benchmark against the AnkiConnect stand-in.
+
+Writes a synthetic vault, then times every stage of a sync: crawl, convert, render, check (canAdd and duplicate
+scoring) and push. The sync runs three times: first every note is new, then every answer changed so every note is
+updated by its source ID, then nothing changed and no note is checked or pushed.
+
+With --stream, conversion, rendering and the canAdd checks run as one pipeline with bounded queues between them.
+
+    python bench/bench_sync.py [--files 50] [--cards 20] [--request-latency 0.002] [--action-latency 0.0005]
+                               [--note-latency 0.0] [--stream]
+"""
+import argparse
+import tempfile
+import time
+
+from os import path
+
+from common import start_stand_in
+
+# focus imports
+import anki_handler
+import printer
+from crawler import VaultCrawler
+from pipeline import threaded
+from sources import SourceMap
+
+RATIO_T = 0.8
+
+
+def write_vault(root: str, n_files: int, n_cards: int, revision: int) -> None:
+    for f in range(n_files):
+        deck = f'deck{f % 5}'
+        filepath = path.join(root, f'{deck}_topic{f}.md')
+
+        text = f'#anki/{deck}/topic{f}\n# Anki Cards\n'
+        for k in range(n_cards):
+            text += f'{k + 1}. What is item {k} of topic {f}? [[#Item {k}|ans]]\n'
+        for k in range(n_cards):
+            text += f'# Item {k}\n'
+            text += f'Item **{k}** of topic {f}, revision {revision}: ==highlight== and $x_{k}^2$\n'
+            text += f'- first point of [[topic{f}]]\n- second point\n\n$$\\sum_{{i=0}}^{{{k}}} i$$\n'
+
+        with open(filepath, 'w', encoding='utf-8') as fp:
+            fp.write(text)
+
+
+def sync(vault: str, source_map: SourceMap) -> dict:
+    timings = {}
+
+    start = time.perf_counter()
+    crawler = VaultCrawler(vault)
+    timings['crawl'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    crawler.convert_files()
+    timings['convert'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    notes = list(printer.render_notes(crawler.valid_notes))
+    timings['render'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    source_map.prune()
+    anki_handler.check_notes(source_map.plan(notes))
+    timings['check'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pushed = [n for n in notes if n.is_valid() or n.can_edit(RATIO_T)]
+    results = anki_handler.push_notes(pushed)
+    source_map.record(pushed, results)
+    timings['push'] = time.perf_counter() - start
+
+    timings['notes'] = len(notes)
+    timings['pushed'] = len([r for r in results if r is not None])
+    return timings
+
+
+def sync_streamed(vault: str, source_map: SourceMap) -> dict:
+    # the same sync with conversion, rendering and the canAdd checks overlapped through bounded queues
+    timings = {}
+
+    start = time.perf_counter()
+    crawler = VaultCrawler(vault)
+    timings['crawl'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    source_map.prune()
+    notes = anki_handler.check_notes_stream(
+        threaded(printer.render_notes(threaded(crawler.iter_converted()))), source_map.plan
+    )
+    timings['stream'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pushed = [n for n in notes if n.is_valid() or n.can_edit(RATIO_T)]
+    results = anki_handler.push_notes(pushed)
+    source_map.record(pushed, results)
+    timings['push'] = time.perf_counter() - start
+
+    timings['notes'] = len(notes)
+    timings['pushed'] = len([r for r in results if r is not None])
+    return timings
+
+
+def _main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--cards', type=int, default=20)
+    parser.add_argument('--request-latency', type=float, default=0.002)
+    parser.add_argument('--action-latency', type=float, default=0.0005)
+    parser.add_argument('--note-latency', type=float, default=0.0)
+    parser.add_argument('--stream', action='store_true', help='overlap convert, render and check (pipeline.threaded)')
+    args = parser.parse_args()
+
+    server = start_stand_in(
+        request_latency=args.request_latency, action_latency=args.action_latency, note_latency=args.note_latency
+    )
+    for f in range(5):
+        anki_handler.invoke('createDeck', deck=f'deck{f}')
+
+    with tempfile.TemporaryDirectory() as vault, tempfile.TemporaryDirectory() as out:
+        source_map = SourceMap(path.join(out, 'source_map.json'), server.collection.profile)
+        for revision, label in [(0, 'add'), (1, 'edit'), (1, 'unchanged')]:
+            write_vault(vault, args.files, args.cards, revision)
+            server.requests = 0
+
+            timings = sync_streamed(vault, source_map) if args.stream else sync(vault, source_map)
+            stages = [k for k in timings if k not in ('notes', 'pushed')]
+            total = sum(timings[k] for k in stages)
+            print(f'{label}: {timings["pushed"]}/{timings["notes"]} notes pushed in {total:.3f} s, '
+                  f'{server.requests} requests')
+            for stage in stages:
+                print(f'\t{stage:<8}{timings[stage]:8.3f} s')
+
+    server.stop()
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,49 @@
+﻿import json
+import os
+import sys
+
+from os import path
+from typing import Dict, List, Tuple
+
+# ../src, so focus modules are imported the same way main.py sees them
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+SRC = path.join(ROOT, 'src')
+if SRC not in sys.path:
+    sys.path.insert(0, SRC)
+
+BENCH = path.join(ROOT, 'bench')
+FIXTURES = path.join(BENCH, 'fixtures')
+GOLDEN = path.join(BENCH, 'golden')
+
+
+def load_text_fixtures() -> Dict[str, str]:
+    dirpath = path.join(FIXTURES, 'text')
+
+    fixtures = {}
+    for f_name in sorted(os.listdir(dirpath)):
+        if not f_name.endswith('.md'):
+            continue
+        with open(path.join(dirpath, f_name), 'r', encoding='utf-8') as fp:
+            fixtures[f_name.removesuffix('.md')] = fp.read()
+    return fixtures
+
+
+def load_note_fixtures() -> Dict[str, List[Tuple[str, str]]]:
+    with open(path.join(FIXTURES, 'notes.json'), 'r', encoding='utf-8') as fp:
+        data = json.load(fp)
+    return {name: [(q, ans) for q, ans in fields] for name, fields in data.items()}
+
+
+def start_stand_in(**kwargs):
+    """ Starts an AnkiConnect stand-in on a free port, points anki_handler at it and creates the Focus model. """
+    import anki_handler
+    import settings
+    from anki_server import AnkiConnectStandIn
+
+    server = AnkiConnectStandIn(**kwargs)
+    server.start()
+
+    anki_handler.set_client(anki_handler.AnkiConnectClient(*server.address))
+    settings.PROFILE = server.collection.profile
+    anki_handler.startup()
+    return server
@@ -0,0 +1,88 @@
+﻿"""
+Golden-output check for the printer.
+
+Renders every fixture in bench/fixtures with text_to_html and note_to_html, both with web=True and web=False,
+and compares the result with the HTML stored in bench/golden. Any difference means the card HTML written to the
+collection would change.
+
+    python bench/golden.py            # check, exits with 1 on mismatch
+    python bench/golden.py --update   # accept the current output as the new golden files
+"""
+import argparse
+import difflib
+import os
+import sys
+
+from os import path
+from typing import Dict
+
+from common import GOLDEN, load_text_fixtures, load_note_fixtures
+
+# focus imports
+import printer
+
+
+def render_corpus() -> Dict[str, str]:
+    outputs = {}
+    for name, text in load_text_fixtures().items():
+        outputs[f'text/{name}.html'] = printer.text_to_html(text)
+        outputs[f'text/{name}.web.html'] = printer.text_to_html(text, web=True)
+
+    for name, fields in load_note_fixtures().items():
+        for web, suffix in ((False, ''), (True, '.web')):
+            front, back = printer.note_to_html(fields, web=web)
+            outputs[f'note/{name}{suffix}.front.html'] = front
+            outputs[f'note/{name}{suffix}.back.html'] = back
+    return outputs
+
+
+def update(outputs: Dict[str, str]) -> None:
+    for key, html in outputs.items():
+        filepath = path.join(GOLDEN, key)
+        os.makedirs(path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'w', encoding='utf-8', newline='\n') as fp:
+            fp.write(html)
+    print(f'{len(outputs)} golden files written to {GOLDEN}')
+
+
+def check(outputs: Dict[str, str]) -> bool:
+    failed = []
+    for key, html in outputs.items():
+        filepath = path.join(GOLDEN, key)
+        if not path.isfile(filepath):
+            failed.append(key)
+            print(f'MISSING: {key}')
+            continue
+
+        with open(filepath, 'r', encoding='utf-8', newline='\n') as fp:
+            expected = fp.read()
+
+        if expected != html:
+            failed.append(key)
+            print(f'CHANGED: {key}')
+            diff = difflib.unified_diff(
+                expected.splitlines(keepends=True),
+                html.splitlines(keepends=True),
+                fromfile=f'golden/{key}',
+                tofile='rendered'
+            )
+            sys.stdout.writelines(diff)
+
+    print(f'{len(outputs) - len(failed)}/{len(outputs)} golden files match')
+    return len(failed) == 0
+
+
+def _main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--update', action='store_true', help='overwrite the golden files with the current output')
+    args = parser.parse_args()
+
+    outputs = render_corpus()
+    if args.update:
+        update(outputs)
+    elif not check(outputs):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,237 @@
+﻿import asyncio
+import json
+import time
+
+from typing import List, Tuple, Dict, Iterable
+
+# focus imports
+import media
+from similarity import CandidateIndex
+from anki_handler import (
+    AnkiNote, LatencyRecorder, ANKI_CONNECT_HOST, ANKI_CONNECT_PORT, BATCH_CHUNK_SIZE, find_notes_query,
+    is_idempotent, source_query, _request, _parse_response
+)
+
+DEFAULT_CONCURRENCY = 4
+
+
+class AsyncAnkiConnectClient(LatencyRecorder):
+    """
+    asyncio AnkiConnect client, at most `concurrency` actions are in flight at the same time.
+    Each action is sent on an idle keep-alive connection of the pool, a new one is opened when none is idle. As in
+    AnkiConnectClient, a request is only sent again on a new connection when the idle one failed before the request
+    was written, or when the action is idempotent.
+    Cancelling the awaiting task closes the connection the action was using.
+    """
+    # the request may have reached Anki, as AnkiConnectClient._transport_errors
+    _transport_errors = (TimeoutError, ConnectionError, asyncio.IncompleteReadError)
+
+    def __init__(self, host=ANKI_CONNECT_HOST, port=ANKI_CONNECT_PORT, concurrency=DEFAULT_CONCURRENCY, timeout=30.0):
+        if concurrency < 1:
+            raise ValueError(f'concurrency must be at least 1, got {concurrency}')
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def invoke(self, action, *, timeout=None, **params):
+        body = json.dumps(_request(action, **params)).encode('utf-8')
+        timeout = self.timeout if timeout is None else timeout
+
+        async with self._semaphore:
+            start = time.perf_counter()
+            data = await asyncio.wait_for(self._post(body, is_idempotent(action, params)), timeout)
+            self._record(action, time.perf_counter() - start)
+
+        return _parse_response(json.loads(data))
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+        for _, writer in idle:
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _post(self, body: bytes, idempotent: bool) -> bytes:
+        while self._idle:
+            conn = self._idle.pop()
+            reader, writer = conn
+            if reader.at_eof() or writer.is_closing():
+                # the server closed this idle connection, nothing was sent on it
+                writer.close()
+                continue
+
+            try:
+                await self._write(conn, body)
+            except ConnectionError:
+                continue  # the request was not written, send it on another connection
+            try:
+                return await self._read(conn)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                # the request may have been applied, only read only actions are sent again
+                if not idempotent:
+                    raise
+            break
+
+        conn = await asyncio.open_connection(self.host, self.port)
+        await self._write(conn, body)
+        return await self._read(conn)
+
+    async def _write(self, conn, body: bytes) -> None:
+        _, writer = conn
+        try:
+            head = f'POST / HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nContent-Type: application/json\r\n'
+            head += f'Content-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n'
+            writer.write(head.encode('ascii') + body)
+            await writer.drain()
+        except BaseException:
+            writer.close()
+            raise
+
+    async def _read(self, conn) -> bytes:
+        reader, writer = conn
+        try:
+            status = await reader.readline()
+            if not status:
+                raise asyncio.IncompleteReadError(b'', None)
+
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                key, value = line.decode('latin-1').split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+
+            if 'content-length' in headers:
+                data = await reader.readexactly(int(headers['content-length']))
+            else:
+                data = await reader.read()
+        except BaseException:
+            writer.close()
+            raise
+
+        keep_alive = status.startswith(b'HTTP/1.1') and headers.get('connection', '').lower() != 'close'
+        if keep_alive and 'content-length' in headers:
+            self._idle.append(conn)
+        else:
+            writer.close()
+        return data
+
+
+async def fetch_candidates(client: AsyncAnkiConnectClient, queries: Iterable[str]) -> Dict[str, List[dict]]:
+    # same as anki_handler.fetch_candidates, the unique queries run concurrently
+    queries = list(dict.fromkeys(queries))
+    found = await asyncio.gather(*[client.invoke('findNotes', query=q) for q in queries])
+
+    note_ids = list(dict.fromkeys(i for ids in found for i in ids))
+    infos = {}
+    if len(note_ids) > 0:
+        infos = {res['noteId']: res for res in await client.invoke('notesInfo', notes=note_ids) if res}
+
+    return {q: [infos[i] for i in ids if i in infos] for q, ids in zip(queries, found)}
+
+
+async def calculate_ratios(client: AsyncAnkiConnectClient, notes: List[AnkiNote]) -> None:
+    # same as anki_handler.calculate_ratios
+    queries = [find_notes_query(n.deck, n.convert_to_nested_tags()) for n in notes]
+    candidates = await fetch_candidates(client, queries)
+
+    indexes = {q: CandidateIndex(c) for q, c in candidates.items()}
+    for note, q in zip(notes, queries):
+        if len(indexes[q]) != 1:
+            note.set_ratio(indexes[q])
+
+
+async def check_notes(client: AsyncAnkiConnectClient, notes: List[AnkiNote]) -> None:
+    # canAddNotesWithErrorDetail followed by the duplicate scoring, as done by ThirdStep
+    result = await client.invoke('canAddNotesWithErrorDetail', notes=[n.to_json() for n in notes])
+    for note, res in zip(notes, result):
+        note.parse_can_add_response(res, calculate=False)
+    await calculate_ratios(client, [n for n in notes if not n.is_valid()])
+
+
+async def push_notes(client: AsyncAnkiConnectClient, notes: List[AnkiNote], chunk_size=BATCH_CHUNK_SIZE):
+    # same as anki_handler.push_notes, with the chunks and updates sent concurrently
+    results: List[int | None] = [None] * len(notes)
+
+    async def _add(chunk):
+        try:
+            ids = await client.invoke('addNotes', notes=[notes[i].to_json() for i in chunk])
+        except AsyncAnkiConnectClient._transport_errors as ex:
+            # the response was lost, Anki may have added some notes of this chunk already
+            print(f'WARNING: addNotes did not answer, checking which notes were added error={ex}')
+            ids = await _reconcile_adds(client, [notes[i] for i in chunk])
+        except Exception as ex:
+            # an error returned by Anki: addNotes fails as a whole when any note fails, nothing was added
+            print(f'WARNING: addNotes failed, retrying one by one error={ex}')
+            ids = await _add_one_by_one(client, [notes[i] for i in chunk])
+        for i, note_id in zip(chunk, ids):
+            results[i] = note_id
+
+    async def _update(i):
+        try:
+            await client.invoke('updateNoteFields', note=notes[i].to_json(True))
+            results[i] = notes[i].duplicate_id
+        except Exception as ex:
+            print(f'WARNING: unable to edit note with ID={notes[i].duplicate_id} error={ex}')
+
+    new = [i for i, n in enumerate(notes) if n.duplicate_id is None]
+    tasks = [_add(new[k:k + chunk_size]) for k in range(0, len(new), chunk_size)]
+    tasks += [_update(i) for i, n in enumerate(notes) if n.duplicate_id is not None]
+    await asyncio.gather(*tasks)
+
+    return results
+
+
+async def _reconcile_adds(client: AsyncAnkiConnectClient, notes: List[AnkiNote]) -> List[int | None]:
+    # same as anki_handler._reconcile_adds: the notes refused by canAddNotes are found by their Source field
+    can_add = await client.invoke('canAddNotes', notes=[n.to_json() for n in notes])
+
+    added = [i for i, (n, ok) in enumerate(zip(notes, can_add)) if not ok and n.source_id is not None]
+    found = await asyncio.gather(
+        *[client.invoke('findNotes', query=source_query(notes[i].source_id)) for i in added],
+        return_exceptions=True
+    )
+
+    results: List[int | None] = [None] * len(notes)
+    for i, note_ids in zip(added, found):
+        if not isinstance(note_ids, Exception) and len(note_ids) > 0:
+            results[i] = note_ids[0]
+
+    missing = [i for i, ok in enumerate(can_add) if ok]
+    for i, note_id in zip(missing, await _add_one_by_one(client, [notes[i] for i in missing])):
+        results[i] = note_id
+    return results
+
+
+async def _add_one_by_one(client: AsyncAnkiConnectClient, notes: List[AnkiNote]) -> List[int | None]:
+    ids = await asyncio.gather(*[client.invoke('addNote', note=n.to_json()) for n in notes], return_exceptions=True)
+    return [None if isinstance(note_id, Exception) else note_id for note_id in ids]
+
+
+async def sync_notes(client: AsyncAnkiConnectClient, notes: List[AnkiNote], ratio_t: float):
+    """
+    Checks every note, then adds the notes that can be added and edits the ones that can be edited.
+    The media of the pushed notes is uploaded in a worker thread while the first notes are pushed. Only used by
+    bench/bench_async.py, the wizard and --sync push through anki_handler.
+    :return: the pushed notes and their note ID, or None when they could not be pushed.
+    """
+    await check_notes(client, notes)
+    pushed = [n for n in notes if n.is_valid() or n.can_edit(ratio_t)]
+
+    media_task = asyncio.create_task(asyncio.to_thread(media.store_media, pushed))
+    results = await push_notes(client, pushed)
+    for name, error in (await media_task).items():
+        print(f'WARNING: unable to store {name} error={error}')
+    return pushed, results
@@ -1,22 +1,52 @@
 ﻿import json
-import urllib.request
+import time
+import random
+import select
+import socket
+import threading
+import http.client
 
-from difflib import SequenceMatcher
-from typing import Tuple, List
+from typing import Tuple, List, Dict, Iterable, Callable
 
 # focus imports
 import settings
+from progress import Progress, ensure
+from pipeline import chunked
+from similarity import CandidateIndex, build_index
 
 MODEL_NAME = 'Focus'
+# hidden field of the model, links each note to the vault note it was created from
+SOURCE_FIELD = 'Source'
+MODEL_FIELDS = ['Question', 'Answer', SOURCE_FIELD]
+# status of the notes found in the source map, see sources.SourceMap.plan
+STATUS_UPDATE = 'changed since the last sync'
+STATUS_UNCHANGED = 'unchanged since the last sync'
+ANKI_CONNECT_HOST = '127.0.0.1'
+ANKI_CONNECT_PORT = 8765
+BATCH_CHUNK_SIZE = 100
+# notes per canAddNotesWithErrorDetail request, so progress can be reported and cancelled between them
+CHECK_CHUNK_SIZE = 1000
+# read only actions, safe to send again when the response is lost
+IDEMPOTENT_ACTIONS = {
+    'version', 'getProfiles', 'modelNames', 'modelFieldNames', 'modelTemplates', 'modelStyling',
+    'deckNames', 'getDecks',
+    'findNotes', 'notesInfo', 'canAddNotes', 'canAddNotesWithErrorDetail', 'getMediaFilesNames',
+}
+# seconds, actions that do a lot of work in Anki get a larger budget than the client timeout
+ACTION_TIMEOUTS = {
+    'canAddNotesWithErrorDetail': 120.0,
+    'addNotes': 120.0,
+    'multi': 120.0,
+    'notesInfo': 60.0,
+    'guiEditNote': 10.0,
+}
 
 
 def _request(action, **params):
     return {'action': action, 'params': params, 'version': 6}
 
 
-def invoke(action, **params):
-    request_json = json.dumps(_request(action, **params)).encode('utf-8')
-    response = json.load(urllib.request.urlopen(urllib.request.Request('http://127.0.0.1:8765', request_json)))
+def _parse_response(response):
     if len(response) != 2:
         raise Exception('response has an unexpected number of fields')
     if 'error' not in response:
@@ -28,6 +58,319 @@ def invoke(action, **params):
     return response['result']
 
 
+class CircuitOpenError(ConnectionError):
+    pass
+
+
+class LatencyRecorder:
+    """ Count, total and max seconds of every action sent by a client. """
+    def __init__(self):
+        # action -> [count, total seconds, max seconds]
+        self._latency: Dict[str, List] = {}
+
+    def latency_stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            action: {'count': count, 'total': total, 'mean': total / count, 'max': max_t}
+            for action, (count, total, max_t) in self._latency.items()
+        }
+
+    def _record(self, action, elapsed):
+        if action not in self._latency:
+            self._latency[action] = [0, 0.0, 0.0]
+        stats = self._latency[action]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+
+
+class AnkiConnectClient(LatencyRecorder):
+    """
+    AnkiConnect client that keeps a single keep-alive connection open between actions.
+    The client is shared by threads, actions are sent one at a time on the connection. The connection is opened again
+    when the server drops it, and the latency of every action is recorded. A request is only sent again on the new
+    connection when the old one failed before the request was written, or when the action is idempotent: a lost
+    response may hide an addNotes that Anki already applied.
+
+    Every action has a timeout budget (ACTION_TIMEOUTS, or timeout). Idempotent actions are retried up to
+    max_retries times with jittered exponential backoff when the connection fails or times out; other actions are
+    never retried. After breaker_threshold consecutive failures the circuit opens and actions fail immediately with
+    CircuitOpenError for breaker_cooldown seconds, then a single action is let through to probe the server.
+    """
+    _reconnect_errors = (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionError)
+    _transport_errors = (TimeoutError, ConnectionError, http.client.HTTPException)
+
+    def __init__(self, host=ANKI_CONNECT_HOST, port=ANKI_CONNECT_PORT, timeout=30.0, connect_timeout=5.0,
+                 max_retries=3, backoff=0.25, max_backoff=4.0, breaker_threshold=5, breaker_cooldown=30.0):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.action_timeouts: Dict[str, float] = dict(ACTION_TIMEOUTS)
+
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+
+        self._conn: http.client.HTTPConnection | None = None
+        # invoke() is called from the Tk thread and from the TaskRunner workers
+        self._lock = threading.RLock()
+        # retries, timeouts and errors per action, and circuit breaker events
+        self._failures = {
+            'retries': {}, 'resent': {}, 'timeouts': {}, 'errors': {}, 'circuit_opened': 0, 'rejected': 0
+        }
+
+        self._consecutive_failures = 0
+        self._opened_at: float | None = None
+
+    def invoke(self, action, **params):
+        body = json.dumps(_request(action, **params)).encode('utf-8')
+        timeout = self.action_timeouts.get(action, self.timeout)
+        idempotent = is_idempotent(action, params)
+        retries = self.max_retries if idempotent else 0
+
+        attempt = 0
+        while True:
+            # one exchange at a time on the connection, the backoff below does not hold it
+            with self._lock:
+                self._check_circuit(action)
+
+                start = time.perf_counter()
+                try:
+                    data = self._post(action, body, timeout, idempotent)
+                except self._transport_errors as ex:
+                    self._count('timeouts' if isinstance(ex, TimeoutError) else 'errors', action)
+                    self._on_failure()
+                    if attempt >= retries or self._opened_at is not None:
+                        raise
+                else:
+                    self._on_success()
+                    self._record(action, time.perf_counter() - start)
+                    return _parse_response(json.loads(data))
+
+                attempt += 1
+                self._count('retries', action)
+            time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def failure_stats(self) -> dict:
+        return {
+            'retries': dict(self._failures['retries']),
+            'resent': dict(self._failures['resent']),
+            'timeouts': dict(self._failures['timeouts']),
+            'errors': dict(self._failures['errors']),
+            'circuit_opened': self._failures['circuit_opened'],
+            'rejected': self._failures['rejected'],
+            'circuit_open': self._opened_at is not None,
+        }
+
+    def reset_stats(self):
+        self._latency = {}
+        self._failures = {
+            'retries': {}, 'resent': {}, 'timeouts': {}, 'errors': {}, 'circuit_opened': 0, 'rejected': 0
+        }
+
+    def _check_circuit(self, action):
+        if self._opened_at is None:
+            return
+        if time.monotonic() - self._opened_at < self.breaker_cooldown:
+            self._failures['rejected'] += 1
+            raise CircuitOpenError(f'AnkiConnect is not responding, {action} was not sent')
+        # half open: let this action through, a single failure opens the circuit again
+        self._consecutive_failures = self.breaker_threshold - 1
+        self._opened_at = None
+
+    def _on_failure(self):
+        self._consecutive_failures += 1
+        if self._consecutive_failures >= self.breaker_threshold and self._opened_at is None:
+            self._opened_at = time.monotonic()
+            self._failures['circuit_opened'] += 1
+
+    def _on_success(self):
+        self._consecutive_failures = 0
+
+    def _count(self, key, action):
+        self._failures[key][action] = self._failures[key].get(action, 0) + 1
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self._conn is not None and _is_closed_by_server(self._conn.sock):
+            self.close()
+        if self._conn is None:
+            self._conn = http.client.HTTPConnection(self.host, self.port, timeout=self.connect_timeout)
+            self._conn.connect()
+            # many small request/response exchanges, do not let Nagle hold them back
+            self._conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return self._conn
+
+    def _post(self, action: str, body: bytes, timeout: float, idempotent: bool) -> bytes:
+        reused = self._conn is not None
+        conn = self._connect()
+        try:
+            conn.sock.settimeout(timeout)
+            conn.request('POST', '/', body, {'Content-Type': 'application/json', 'Connection': 'keep-alive'})
+        except self._reconnect_errors:
+            self.close()
+            if not reused:
+                raise
+            # the server closed the idle connection before the request was written, nothing was sent
+            self._count('resent', action)
+            return self._send(body, timeout)
+        except Exception:
+            self.close()
+            raise
+
+        try:
+            return self._read(conn)
+        except self._reconnect_errors:
+            self.close()
+            # the request may have been applied, only read only actions are sent again
+            if not reused or not idempotent:
+                raise
+        self._count('resent', action)
+        return self._send(body, timeout)
+
+    def _send(self, body: bytes, timeout: float) -> bytes:
+        conn = self._connect()
+        try:
+            conn.sock.settimeout(timeout)
+            conn.request('POST', '/', body, {'Content-Type': 'application/json', 'Connection': 'keep-alive'})
+        except Exception:
+            self.close()
+            raise
+        return self._read(conn)
+
+    def _read(self, conn: http.client.HTTPConnection) -> bytes:
+        try:
+            response = conn.getresponse()
+            data = response.read()
+        except Exception:
+            self.close()
+            raise
+
+        if response.will_close:
+            self.close()
+        return data
+
+
+def _is_closed_by_server(sock: socket.socket) -> bool:
+    # an idle keep-alive socket is only readable once the server closed it (or sent data nobody asked for)
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return len(readable) > 0
+
+
+def is_idempotent(action, params) -> bool:
+    if action == 'multi':
+        return all(a['action'] in IDEMPOTENT_ACTIONS for a in params.get('actions', []))
+    return action in IDEMPOTENT_ACTIONS
+
+
+_client = AnkiConnectClient()
+
+
+def get_client() -> AnkiConnectClient:
+    return _client
+
+
+def set_client(client: AnkiConnectClient) -> None:
+    global _client
+    _client.close()
+    _client = client
+
+
+def invoke(action, **params):
+    return _client.invoke(action, **params)
+
+
+class AnkiFuture:
+    """ Result of an action queued in an AnkiBatch, available after the batch is flushed. """
+    def __init__(self, action):
+        self.action = action
+        self._done = False
+        self._result = None
+        self._error = None
+
+    def done(self) -> bool:
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise ValueError(f'{self.action} has not been sent, flush the batch first')
+        if self._error is not None:
+            raise Exception(self._error)
+        return self._result
+
+    def error(self):
+        if not self._done:
+            raise ValueError(f'{self.action} has not been sent, flush the batch first')
+        return self._error
+
+    def _set(self, result, error):
+        self._result = result
+        self._error = error
+        self._done = True
+
+
+class AnkiBatch:
+    """
+    Collects actions and sends them as "multi" requests of at most chunk_size actions.
+    The result or error of every action is set on the AnkiFuture returned by queue().
+    """
+    def __init__(self, chunk_size=BATCH_CHUNK_SIZE, client: AnkiConnectClient = None):
+        if chunk_size < 1:
+            raise ValueError(f'chunk_size must be at least 1, got {chunk_size}')
+        self.chunk_size = chunk_size
+        self._client = client
+        self._pending: List[Tuple[dict, AnkiFuture]] = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+
+    def queue(self, action, **params) -> AnkiFuture:
+        future = AnkiFuture(action)
+        self._pending.append((_request(action, **params), future))
+        return future
+
+    def flush(self, progress: Progress = None) -> None:
+        # when progress is cancelled the actions not sent yet fail with a "cancelled" error
+        client = self._client if self._client is not None else _client
+        pending, self._pending = self._pending, []
+
+        for i in range(0, len(pending), self.chunk_size):
+            chunk = pending[i:i + self.chunk_size]
+            if progress is not None and progress.is_cancelled():
+                for _, future in pending[i:]:
+                    future._set(None, 'cancelled')
+                return
+            try:
+                results = client.invoke('multi', actions=[request for request, _ in chunk])
+            except Exception as ex:
+                for _, future in chunk:
+                    future._set(None, str(ex))
+            else:
+                for (_, future), res in zip(chunk, results):
+                    future._set(res['result'], res['error'])
+
+            if progress is not None:
+                progress.advance(len(chunk))
+
+
 def startup():
     result = invoke('getProfiles')
     if settings.PROFILE not in result:
@@ -48,6 +391,9 @@ def check_for_changes():
 
     changes = {}
 
+    missing_fields = requires_field_changes()
+    if len(missing_fields) > 0:
+        changes['fields'] = {'add': missing_fields}
     flag, template_changes = requires_template_changes()
     if flag:
         changes['templates'] = template_changes
@@ -60,7 +406,8 @@ def check_for_changes():
 
 
 class AnkiNote:
-    def __init__(self, deck: str, question: str, answer: str, tags: List[str]):
+    def __init__(self, deck: str, question: str, answer: str, tags: List[str], media: Dict[str, str] = None,
+                 source_id: str = None):
         if not isinstance(deck, str):
             raise TypeError('deck must be a string')
         if not isinstance(tags, list):
@@ -70,6 +417,10 @@ class AnkiNote:
         self.tags = tags
         self.question = question
         self.answer = answer
+        # file name in Anki -> file path in the vault
+        self.media = media if media else {}
+        # stable ID of the vault note, stored in the Source field
+        self.source_id = source_id
 
         self.q_ratio = 0
         self.ans_ratio = 0
@@ -85,59 +436,65 @@ class AnkiNote:
                 raise ValueError(f'cannot edit note without duplicated_id')
             return {
                 'id': self.duplicate_id,
-                'fields': {
-                    'Question': self.question,
-                    'Answer': self.answer,
-                }
+                'fields': self.fields()
             }
 
         else:
             return {
                 'deckName': self.deck,
                 'modelName': MODEL_NAME,
-                'fields': {
-                    'Question': self.question,
-                    'Answer': self.answer
-                },
+                'fields': self.fields(),
                 'tags': self.convert_to_nested_tags()
             }
 
-    def calculate_ratio(self):
-        q_max, ans_max, dup_id = 0, 0, None
+    def fields(self) -> Dict[str, str]:
+        fields = {
+            'Question': self.question,
+            'Answer': self.answer
+        }
+        if self.source_id is not None:
+            fields[SOURCE_FIELD] = self.source_id
+        return fields
+
+    def set_source_match(self, note_id: int, unchanged: bool):
+        # linked through the Source field, neither canAdd nor the duplicate scoring are needed
+        self.duplicate_id = note_id
+        self.status = STATUS_UNCHANGED if unchanged else STATUS_UPDATE
 
+    def is_source_update(self) -> bool:
+        return self.status == STATUS_UPDATE
+
+    def is_unchanged(self) -> bool:
+        return self.status == STATUS_UNCHANGED
+
+    def calculate_ratio(self):
         results = find_notes(self.deck, self.convert_to_nested_tags())
         if len(results) == 1:
-            return q_max, ans_max
-
-        results = invoke('notesInfo', notes=results)
-        for res in results:
-            q = res['fields']['Question']['value']
-            matcher = SequenceMatcher(lambda x: x == ' ', self.question, q)
-            q_ratio = matcher.ratio()
-
-            ans_b = res['fields']['Answer']['value']
-            matcher = SequenceMatcher(lambda x: x == ' ', self.answer, ans_b)
-            ans_ratio = matcher.ratio()
-
-            if q_ratio > q_max and ans_ratio > ans_max:
-                q_max = q_ratio
-                ans_max = ans_ratio
-                dup_id = res['noteId']
-            elif q_ratio > q_max:
-                q_max = q_ratio
-            elif ans_ratio > ans_max:
-                ans_max = ans_ratio
+            return 0, 0
+
+        self.set_ratio(invoke('notesInfo', notes=results))
+
+    def set_ratio(self, results: List[dict] | CandidateIndex):
+        q_max, ans_max, dup_id = build_index(results).score(self.question, self.answer)
 
         self.q_ratio = q_max
         self.ans_ratio = ans_max
         self.duplicate_id = dup_id
 
-    def parse_can_add_response(self, response):
+    def parse_can_add_response(self, response, calculate=True):
+        # a previous check (the mirror, or before a reconvert) may have matched another note, Anki has the last word
+        self.duplicate_id = None
+        self.q_ratio = 0
+        self.ans_ratio = 0
         if response['canAdd'] is True:
             self.status = 'can_add'
         else:
             self.status = response['error']
-            self.calculate_ratio()
+            if calculate:
+                self.calculate_ratio()
+
+    def has_mathjax(self) -> bool:
+        return '<anki-mathjax' in self.question or '<anki-mathjax' in self.answer
 
     def convert_to_nested_tags(self) -> List[str]:
         anki_tags = []
@@ -154,6 +511,8 @@ class AnkiNote:
     def can_edit(self, t):
         if self.duplicate_id is None:
             return False
+        if self.status in (STATUS_UPDATE, STATUS_UNCHANGED):
+            return self.status == STATUS_UPDATE
         if self.max_t() == self.min_t() == 1:
             return False
         if self.max_t() == 1 and self.min_t() != 1:
@@ -163,12 +522,245 @@ class AnkiNote:
         return False
 
 
+def push_notes(notes: List[AnkiNote], chunk_size=BATCH_CHUNK_SIZE, progress: Progress = None,
+               checkpoint: Callable[[List[int], List[int | None]], None] = None) -> List[int | None]:
+    """
+    Adds new notes with bulk addNotes and updates notes with a duplicate_id through batched updateNoteFields.
+    When progress is cancelled the notes not sent yet are left out, the notes already pushed are still returned.
+    :param checkpoint: called with the indices of notes and their results after each addNotes chunk and after the
+    updates (SyncJournal.done).
+    :return: the note ID of each note, in the same order, or None when it could not be added or updated.
+    """
+    progress = ensure(progress)
+    results: List[int | None] = [None] * len(notes)
+
+    new = [i for i, n in enumerate(notes) if n.duplicate_id is None]
+    progress.start('adding notes', len(new))
+    for k in range(0, len(new), chunk_size):
+        if progress.is_cancelled():
+            break
+        chunk = new[k:k + chunk_size]
+        try:
+            ids = invoke('addNotes', notes=[notes[i].to_json() for i in chunk])
+        except AnkiConnectClient._transport_errors as ex:
+            # the response was lost, Anki may have added some notes of this chunk already
+            print(f'WARNING: addNotes did not answer, checking which notes were added error={ex}')
+            ids = _reconcile_adds([notes[i] for i in chunk], chunk_size)
+        except Exception as ex:
+            # addNotes fails as a whole when any note fails, add this chunk note by note to find which ones
+            print(f'WARNING: addNotes failed, retrying one by one error={ex}')
+            ids = _add_one_by_one([notes[i] for i in chunk], chunk_size)
+
+        for i, note_id in zip(chunk, ids):
+            results[i] = note_id
+        progress.advance(len(chunk))
+        if checkpoint is not None:
+            checkpoint(chunk, ids)
+
+    batch = AnkiBatch(chunk_size)
+    updates = [
+        (i, batch.queue('updateNoteFields', note=n.to_json(True)))
+        for i, n in enumerate(notes) if n.duplicate_id is not None
+    ]
+    progress.start('updating notes', len(updates))
+    batch.flush(progress)
+    for i, f in updates:
+        if f.error() is None:
+            results[i] = notes[i].duplicate_id
+        elif f.error() != 'cancelled':
+            print(f'WARNING: unable to edit note with ID={notes[i].duplicate_id} error={f.error()}')
+    _move_source_updates([n for n, r in zip(notes, results) if r is not None and n.is_source_update()], chunk_size)
+    if checkpoint is not None and len(updates) > 0:
+        checkpoint([i for i, _ in updates], [results[i] for i, _ in updates])
+
+    return results
+
+
+def _move_source_updates(notes: List[AnkiNote], chunk_size=BATCH_CHUNK_SIZE) -> None:
+    # updateNoteFields leaves deck and tags as they are, a note linked by source ID follows its vault note
+    if len(notes) == 0:
+        return
+    infos = {res['noteId']: res for res in invoke('notesInfo', notes=[n.duplicate_id for n in notes]) if res}
+    decks = invoke('getDecks', cards=[card for res in infos.values() for card in res['cards']])
+    card_decks = {card: deck for deck, cards in decks.items() for card in cards}
+
+    batch = AnkiBatch(chunk_size)
+    tags = []
+    by_deck: Dict[str, List[int]] = {}
+    for note in notes:
+        info = infos.get(note.duplicate_id)
+        if info is None:
+            continue
+        note_tags = note.convert_to_nested_tags()
+        if sorted(info['tags']) != sorted(note_tags):
+            tags.append((note, batch.queue('updateNoteTags', note=note.duplicate_id, tags=note_tags)))
+        by_deck.setdefault(note.deck, []).extend(c for c in info['cards'] if card_decks.get(c) != note.deck)
+    moves = [(deck, batch.queue('changeDeck', cards=cards, deck=deck)) for deck, cards in by_deck.items() if cards]
+    batch.flush()
+
+    for note, f in tags:
+        if f.error() is not None:
+            print(f'WARNING: unable to set the tags of note with ID={note.duplicate_id} error={f.error()}')
+    for deck, f in moves:
+        if f.error() is not None:
+            print(f'WARNING: unable to move notes to {deck} error={f.error()}')
+
+
+def _add_one_by_one(notes: List[AnkiNote], chunk_size=BATCH_CHUNK_SIZE) -> List[int | None]:
+    batch = AnkiBatch(chunk_size)
+    futures = [batch.queue('addNote', note=n.to_json()) for n in notes]
+    batch.flush()
+    return [None if f.error() is not None else f.result() for f in futures]
+
+
+def _reconcile_adds(notes: List[AnkiNote], chunk_size=BATCH_CHUNK_SIZE) -> List[int | None]:
+    """
+    After an addNotes whose response was lost: canAddNotes refuses the notes Anki already added, their note ID is
+    found through their Source field (None without one, they are not added twice). The others are added again.
+    """
+    can_add = invoke('canAddNotes', notes=[n.to_json() for n in notes])
+
+    batch = AnkiBatch(chunk_size)
+    found = {
+        i: batch.queue('findNotes', query=source_query(n.source_id))
+        for i, (n, ok) in enumerate(zip(notes, can_add)) if not ok and n.source_id is not None
+    }
+    batch.flush()
+
+    results: List[int | None] = [None] * len(notes)
+    for i, f in found.items():
+        if f.error() is None and len(f.result()) > 0:
+            results[i] = f.result()[0]
+
+    missing = [i for i, ok in enumerate(can_add) if ok]
+    for i, note_id in zip(missing, _add_one_by_one([notes[i] for i in missing], chunk_size)):
+        results[i] = note_id
+    return results
+
+
+def push_notes_sequential(notes: List[AnkiNote], progress: Progress = None,
+                          checkpoint: Callable[[List[int], List[int | None]], None] = None) -> List[int | None]:
+    # one addNote or updateNoteFields call per note, checkpoint as in push_notes after each one
+    progress = ensure(progress)
+    progress.start('pushing notes', len(notes))
+    results = []
+    for i, note in enumerate(notes):
+        if progress.is_cancelled():
+            results.append(None)
+            continue
+        if note.duplicate_id is not None:
+            print(f'\t editing note with ID={note.duplicate_id}')
+            r = invoke('updateNoteFields', note=note.to_json(True))
+            r = note.duplicate_id if r is None else r
+            if note.is_source_update():
+                _move_source_updates([note])
+        else:
+            r = invoke('addNote', note=note.to_json())
+        results.append(r)
+        progress.advance()
+        if checkpoint is not None:
+            checkpoint([i], [r])
+    return results
+
+
+def fetch_candidates(queries: Iterable[str], batch: AnkiBatch = None,
+                     progress: Progress = None) -> Dict[str, List[dict]]:
+    """
+    Runs each unique query once, in a batched findNotes round, and fetches the notes of all queries with a single
+    notesInfo call.
+    :return: query -> notesInfo of the matching notes, in findNotes order.
+    """
+    progress = ensure(progress)
+    batch = batch if batch is not None else AnkiBatch()
+
+    found = {q: batch.queue('findNotes', query=q) for q in dict.fromkeys(queries)}
+    progress.start('finding candidates', len(found))
+    batch.flush(progress)
+    progress.check()
+
+    note_ids = list(dict.fromkeys(i for f in found.values() for i in f.result()))
+    infos = {}
+    if len(note_ids) > 0:
+        infos = {res['noteId']: res for res in invoke('notesInfo', notes=note_ids) if res}
+
+    return {q: [infos[i] for i in f.result() if i in infos] for q, f in found.items()}
+
+
+def calculate_ratios(notes: List[AnkiNote], batch: AnkiBatch = None, progress: Progress = None) -> None:
+    # same as AnkiNote.calculate_ratio, notes sharing deck and tags are scored against the same candidates
+    progress = ensure(progress)
+    queries = [find_notes_query(n.deck, n.convert_to_nested_tags()) for n in notes]
+    candidates = fetch_candidates(queries, batch, progress)
+
+    indexes = {q: CandidateIndex(c) for q, c in candidates.items()}
+    progress.start('scoring duplicates', len(notes))
+    for note, q in zip(notes, queries):
+        progress.check()
+        if len(indexes[q]) != 1:
+            note.set_ratio(indexes[q])
+        progress.advance()
+
+
+def check_notes(notes: List[AnkiNote], progress: Progress = None) -> None:
+    # canAddNotesWithErrorDetail followed by the duplicate scoring
+    if len(notes) == 0:
+        return
+    progress = ensure(progress)
+    progress.start('checking notes', len(notes))
+    for k in range(0, len(notes), CHECK_CHUNK_SIZE):
+        progress.check()
+        chunk = notes[k:k + CHECK_CHUNK_SIZE]
+        result = invoke('canAddNotesWithErrorDetail', notes=[n.to_json() for n in chunk])
+        for note, res in zip(chunk, result):
+            note.parse_can_add_response(res, calculate=False)
+        progress.advance(len(chunk))
+    calculate_ratios([n for n in notes if not n.is_valid()], progress=progress)
+
+
+def check_notes_stream(notes: Iterable[AnkiNote], select: Callable[[List[AnkiNote]], List[AnkiNote]] = None,
+                       total: int = None, chunk_size=CHECK_CHUNK_SIZE, progress: Progress = None) -> List[AnkiNote]:
+    """
+    check_notes for notes still being produced, rendered on another thread by pipeline.threaded() for instance.
+    canAddNotesWithErrorDetail is sent for the notes ready when the previous request returns (pipeline.chunked), the
+    duplicate scoring runs once at the end so notes sharing deck and tags still share their candidates.
+    :param select: chunk -> the notes of the chunk that must be checked (SourceMap.plan), all of them by default.
+    :param total: number of notes, for progress.
+    :return: every note of notes, in order.
+    """
+    progress = ensure(progress)
+    progress.start('checking notes', total)
+
+    out, failed = [], []
+    for chunk in chunked(notes, chunk_size):
+        progress.check()
+        out.extend(chunk)
+        checked = select(chunk) if select is not None else chunk
+        if len(checked) > 0:
+            result = invoke('canAddNotesWithErrorDetail', notes=[n.to_json() for n in checked])
+            for note, res in zip(checked, result):
+                note.parse_can_add_response(res, calculate=False)
+            failed.extend(n for n in checked if not n.is_valid())
+        progress.advance(len(chunk))
+
+    calculate_ratios(failed, progress=progress)
+    return out
+
+
 def apply_changes(changes: dict):
+    if 'fields' in changes:
+        for name in changes['fields']['add']:
+            invoke('modelFieldAdd', modelName=MODEL_NAME, fieldName=name, index=MODEL_FIELDS.index(name))
     if 'templates' in changes:
         templates = changes['templates']
 
-        for new_template in templates['add']:
-            invoke('modelTemplateAdd', modelName=MODEL_NAME, template=new_template)
+        batch = AnkiBatch()
+        added = [
+            batch.queue('modelTemplateAdd', modelName=MODEL_NAME, template=new_template)
+            for new_template in templates['add']
+        ]
+        batch.flush()
+        for f in added:
+            f.result()
 
         if len(templates['update']) > 0:
             modify = {
@@ -184,6 +776,11 @@ def apply_changes(changes: dict):
         invoke('updateModelStyling', model=modify)
 
 
+def requires_field_changes() -> List[str]:
+    result = invoke('modelFieldNames', modelName=MODEL_NAME)
+    return [name for name in MODEL_FIELDS if name not in result]
+
+
 def requires_template_changes():
     templates = _get_templates()
 
@@ -216,46 +813,54 @@ def requires_styling_changes():
     return False
 
 
-def match_with_anki(note: AnkiNote) -> Tuple[float, float]:
-    q_max = 0
-    ans_max = 0
+def match_with_anki(note: AnkiNote, candidates: List[dict] | CandidateIndex = None) -> Tuple[float, float]:
+    if candidates is None:
+        results = find_notes(note.deck, note.tags)
+        if len(results) == 0:
+            return 0, 0
+        candidates = invoke('notesInfo', notes=results)
 
-    results = find_notes(note.deck, note.tags)
-    if len(results) == 0:
-        return q_max, ans_max
+    return build_index(candidates).best(note.question, note.answer)
 
-    results = invoke('notesInfo', notes=results)
-    for res in results:
-        qa = note.question
-        qb = res['fields']['Question']['value']
-        matcher = SequenceMatcher(lambda x: x == ' ', qa, qb)
-        q_ratio = matcher.ratio()
 
-        ans_a = note.answer
-        ans_b = res['fields']['Answer']['value']
-        matcher = SequenceMatcher(lambda x: x == ' ', ans_a, ans_b)
-        ans_ratio = matcher.ratio()
+def match_many_with_anki(notes: List[AnkiNote], batch: AnkiBatch = None) -> List[Tuple[float, float]]:
+    # same as match_with_anki, the candidates of notes sharing deck and tags are fetched once
+    queries = [find_notes_query(n.deck, n.tags) for n in notes]
+    candidates = fetch_candidates(queries, batch)
+    indexes = {q: CandidateIndex(c) for q, c in candidates.items()}
+    return [match_with_anki(note, indexes[q]) for note, q in zip(notes, queries)]
 
-        if q_ratio > q_max:
-            q_max = q_ratio
-        if ans_ratio > ans_max:
-            ans_max = ans_ratio
 
-    return q_max, ans_max
+def store_media_files(files: List[Tuple[str, str]]) -> List[str | None]:
+    # files: (file name, base64 data), stored with a single "multi" request
+    batch = AnkiBatch(chunk_size=max(len(files), 1))
+    futures = [batch.queue('storeMediaFile', filename=name, data=data) for name, data in files]
+    batch.flush()
+    return [f.error() for f in futures]
 
 
-def find_notes(deck, tags):
+def find_notes_query(deck, tags) -> str:
     q = f'deck:{deck}'
     for tag in tags:
         q += f' and tag:{tag}'
-    return invoke('findNotes', query=q)
+    return q
+
+
+def source_query(source_id: str) -> str:
+    # search of the note linked to source_id, the wildcards and quotes of the search syntax are escaped
+    value = ''.join('\\' + c if c in '\\"*_:' else c for c in source_id)
+    return f'"note:{MODEL_NAME}" "{SOURCE_FIELD}:{value}"'
+
+
+def find_notes(deck, tags):
+    return invoke('findNotes', query=find_notes_query(deck, tags))
 
 
 def _create_model():
     invoke(
         'createModel',
         modelName=MODEL_NAME,
-        inOrderFields=['Question', 'Answer'],
+        inOrderFields=MODEL_FIELDS,
         css=settings.STYLES.to_string(),
         isCloze=False,
         cardTemplates=_get_templates(inline=True)
@@ -1,8 +1,13 @@
-﻿from .crawler import VaultCrawler, NoteTree, ObsidianNote, Answer
+﻿from .crawler import VaultCrawler, NoteTree, ObsidianNote, Answer, link_index_path, media_name, vault_name
+from .index import NoteIndex
 
 __all__ = [
     'VaultCrawler',
     'NoteTree',
     'ObsidianNote',
-    'Answer'
+    'Answer',
+    'link_index_path',
+    'media_name',
+    'vault_name',
+    'NoteIndex'
 ]
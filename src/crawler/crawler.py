@@ -1,7 +1,21 @@
 ﻿import os
-from typing import Iterator, Dict, List
+import json
+import hashlib
+from typing import Iterable, Iterator, Dict, List, Set
 
 from .utils import *
+from .index import NoteIndex
+
+# focus imports
+from progress import Progress, ensure
+
+LINK_INDEX_NAME = 'link_index_{}.json'
+
+
+def link_index_path(dirpath: str, vault: str) -> str:
+    # one index per vault, named after the hash of its path
+    digest = hashlib.sha1(path.normpath(vault).encode('utf-8')).hexdigest()[:12]
+    return path.join(dirpath, LINK_INDEX_NAME.format(digest))
 
 
 class Answer:
@@ -27,14 +41,31 @@ class Answer:
         self._text = text
 
 
+def media_name(vault: str, relative_path: str) -> str:
+    """
+    Name of a vault file in the collection media: its file name with a hash of the vault name and its path, so
+    a/img.png and b/img.png, or the same file of two vaults, do not overwrite each other in Anki.
+    """
+    key = vault + '\n' + relative_path.replace('\\', '/')
+    stem, ext = path.splitext(path.basename(relative_path))
+    return f'{stem}_{hashlib.sha1(key.encode("utf-8")).hexdigest()[:8]}{ext}'
+
+
+def vault_name(vault: str) -> str:
+    # the folder name, as Obsidian names vaults, so the source IDs survive moving the vault
+    return path.basename(path.normpath(vault))
+
+
 class ObsidianNote:
-    def __init__(self, relative_path, name, deck, tags, note_text, main_tag=None):
+    def __init__(self, relative_path, name, deck, tags, note_text, main_tag=None, vault=''):
         if not isinstance(deck, str):
             raise TypeError(f'deck must be a string, not {type(deck)}')
         if not isinstance(tags, list):
             raise TypeError(f'tags must be a list, not {type(tags)}')
 
         self.relative_path = relative_path
+        # name of the vault holding the note, see vault_name()
+        self.vault = vault
         self.name = name
         self.text = note_text
         self.deck = deck
@@ -47,6 +78,10 @@ class ObsidianNote:
 
         self.questions = []
         self.answers = []
+        # file name in Anki (media_name) -> absolute path, resolved by the crawler
+        self.media: Dict[str, str] = {}
+        # embed as written in the note -> file name in Anki
+        self.media_names: Dict[str, str] = {}
 
         for question, answer in RE_NOTE_ENTRY.findall(note_text):
 
@@ -54,7 +89,7 @@ class ObsidianNote:
             if answer:
                 ans_link = parse_link(answer)
             else:
-                links = RE_LINKS.findall(question)
+                links = RE_LINKS.findall(RE_MEDIA_EMBED.sub('', question))
                 if len(links) == 1:
                     ans_link = parse_link(links[0])
 
@@ -80,15 +115,37 @@ class ObsidianNote:
     def get_invalid_reason(self) -> str:
         return self._invalid_reason
 
+    def index_fields(self) -> Dict[str, str]:
+        # searchable text of the note, see NoteIndex
+        return {
+            'path': self.relative_path,
+            'deck': self.deck,
+            'tag': ' '.join(self.tags),
+            'status': 'ok' if self._is_valid else f'invalid {self._invalid_reason}',
+            'text': '\n'.join(self.questions) if self.questions else self.text,
+        }
+
+    def source_id(self) -> str:
+        # vault, file and questions of the entry, the answers can change without changing the ID. The vault keeps
+        # apart the same file of two vaults synced with the same profile
+        key = '\n'.join([self.vault, self.relative_path.replace('\\', '/')] + self.questions)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+    def get_media_embeds(self) -> Iterator[str]:
+        for question, answer in self.get_fields():
+            for m in RE_MEDIA_EMBED.finditer(question + '\n' + answer):
+                yield m.group(1)
+
     def get_fields(self) -> Iterator[Tuple[str, str]]:
         for i in range(len(self.questions)):
             yield self.questions[i], self.answers[i].get_text()
 
 
 class NoteTree(object):
-    def __init__(self, notes: List[ObsidianNote]):
+    def __init__(self, notes: List[ObsidianNote], indices: List[int] = None):
+        # indices: position of each note in the crawler list, when notes is a subset of it
         tree: Dict[str, Dict[str, List[Tuple[int, ObsidianNote]]]] = {}
-        for i, note in enumerate(notes):
+        for i, note in zip(indices if indices is not None else range(len(notes)), notes):
             d, t = note.deck, note.main_tag
             if d not in tree:
                 tree[d] = {}
@@ -105,29 +162,105 @@ class NoteTree(object):
 
 
 class VaultCrawler:
-    def __init__(self, vault: str):
-
+    def __init__(self, vault: str, progress: Progress = None, crawl=True, index_path: str = None):
+        """
+        :param crawl: False to read the vault later with reset(), the GUI shows its window first.
+        :param index_path: file the links and embeds found by every crawl are saved to, convert_paths() resolves them
+        from it without crawling.
+        """
         self.vault = path.normpath(vault)
+        self.index_path = index_path
+        self._crawled = False
+        # links and embeds of the last conversion that could not be resolved and may point to a file not crawled yet
+        self._misses = 0
+        # 'link:name' and 'media:name' targets missed by the last conversion
+        self._missed: Set[str] = set()
+        # the targets a crawl found nowhere in the vault, saved in the link index so that a broken link does not make
+        # every convert_paths() read the vault again
+        self._known_missing: Set[str] = set()
+        # files the links and embeds of the last conversion point to, answers and media outside the Anki files
+        self._resolved: Set[str] = set()
 
         # file related
         self._vault_links = {}
+        self._vault_media = {}
         self.anki_files: List[str] = []
         self.invalid_files: Dict[str, str] = {}
         # formatted notes
         self.valid_notes: List[ObsidianNote] = []
         self.invalid_notes: List[ObsidianNote] = []
+        # ('valid' | 'invalid', index in valid_notes | invalid_notes), built by convert_files
+        self.note_index = NoteIndex()
+
+        if crawl:
+            self._crawl(progress)
 
-        self._crawl()
+    def is_crawled(self) -> bool:
+        return self._crawled
 
-    def reset(self):
-        self._crawl()
+    def reset(self, progress: Progress = None):
+        self._crawl(progress)
         self.valid_notes: List[ObsidianNote] = []
         self.invalid_notes: List[ObsidianNote] = []
+        self.note_index = NoteIndex()
+
+    def convert_files(self, progress: Progress = None):
+        for _ in self.iter_converted(progress):
+            pass
+
+    def convert_paths(self, filepaths: Iterable[str], progress: Progress = None):
+        """
+        convert_files for some files of the vault only. Their links and embeds are resolved through the index saved
+        by the last crawl, the vault is only crawled when there is no index, or when a link or an embed points to a
+        file the index does not know or that is gone.
+        """
+        for _ in self.iter_converted_paths(filepaths, progress):
+            pass
+
+    def iter_converted_paths(self, filepaths: Iterable[str], progress: Progress = None) -> Iterator[ObsidianNote]:
+        """
+        convert_paths one file at a time, as iter_converted. When the vault has to be read again, the second
+        conversion only yields the notes the first one did not.
+        """
+        progress = ensure(progress)
+        filepaths = list(filepaths)
+
+        is_fresh = self._crawled
+        if not is_fresh and not self._load_link_index():
+            self._crawl(progress)
+            is_fresh = True
+
+        self._select_files(filepaths)
+        yielded = set()
+        for note in self.iter_converted(progress):
+            yielded.add(note.source_id())
+            yield note
+
+        if self._misses > 0 and not is_fresh:
+            print(f'\t{self._misses} links or embeds not in the link index, reading the vault again')
+            self._crawl(progress)
+            self._select_files(filepaths)
+            for note in self.iter_converted(progress):
+                if note.source_id() not in yielded:
+                    yield note
+
+    def iter_converted(self, progress: Progress = None) -> Iterator[ObsidianNote]:
+        """
+        convert_files one file at a time: yields each valid note once its file is converted, so the next stage can
+        start before the last file is read. valid_notes, invalid_notes and note_index are complete at the end.
+        """
+        progress = ensure(progress)
+        progress.start('converting files', len(self.anki_files))
+        self._misses = 0
+        self._missed = set()
+        self._resolved = set()
 
-    def convert_files(self):
         self.valid_notes: List[ObsidianNote] = []
         self.invalid_notes: List[ObsidianNote] = []
+        self.note_index = NoteIndex()
+        vault = vault_name(self.vault)
         for filepath in self.anki_files:
+            progress.check()
 
             with open(filepath, 'r', encoding='utf-8') as fp:
                 text = fp.read()
@@ -140,18 +273,44 @@ class VaultCrawler:
             for note_entry in RE_NOTE_BODY.findall(cards_text):
 
                 name, rp = relpath(self.vault, filepath)
-                note = ObsidianNote(rp, name, deck, tags, note_entry, main_tag=main_tag[1])
+                note = ObsidianNote(rp, name, deck, tags, note_entry, main_tag=main_tag[1], vault=vault)
 
                 if not note.is_valid():
                     self.invalid_notes.append(note)
                 else:
                     try:
                         self._set_answers(note, text)
+                        self._set_media(note)
                         self.valid_notes.append(note)
                     except CrawlerError as ex:
                         note.set_invalid(ex.message)
                         self.invalid_notes.append(note)
 
+                if note.is_valid():
+                    self.note_index.add(('valid', len(self.valid_notes) - 1), **note.index_fields())
+                    yield note
+                else:
+                    self.note_index.add(('invalid', len(self.invalid_notes) - 1), **note.index_fields())
+
+            progress.advance()
+
+        if self._crawled and self.index_path is not None and not self._missed <= self._known_missing:
+            # missed right after a crawl, these targets are not in the vault
+            self._known_missing |= self._missed
+            self._save_link_index()
+
+    def fingerprint(self) -> int:
+        # changes when an Anki file is modified, added by a crawl or removed, or when a file the last conversion
+        # read an answer or a media from is modified or removed
+        stats = []
+        for filepath in self.anki_files + sorted(self._resolved):
+            try:
+                st = os.stat(filepath)
+                stats.append((filepath, st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                stats.append((filepath, None, None))
+        return hash(tuple(stats))
+
     def build_filetree(self, key=None):
         valid_files = []
         for f in self.anki_files:
@@ -172,15 +331,29 @@ class VaultCrawler:
         inv_tree = NoteTree(self.invalid_notes)
         return v_tree, inv_tree
 
-    def _crawl(self):
+    def _crawl(self, progress: Progress = None):
+        progress = ensure(progress)
+        progress.start('reading vault')
+
+        self._crawled = False
         self._vault_links = {}
+        self._vault_media = {}
         self.anki_files: List[str] = []
         self.invalid_files: Dict[str, str] = {}
 
         for root, subdir, files in os.walk(self.vault):
             for f_name in files:
+                progress.check()
+                progress.advance()
                 f_path = path.join(root, f_name)
 
+                if f_name.lower().endswith(MEDIA_EXTENSIONS):
+                    _, rp = relpath(self.vault, f_path)
+                    if f_name not in self._vault_media:
+                        self._vault_media[f_name] = []
+                    self._vault_media[f_name].append(rp)
+                    continue
+
                 if not f_name.endswith('.md'):
                     continue
 
@@ -200,6 +373,11 @@ class VaultCrawler:
                 else:
                     self.anki_files.append(f_path)
 
+        self._crawled = True
+        self._known_missing = {t for t in self._known_missing if not self._is_indexed(t)}
+        if self.index_path is not None:
+            self._save_link_index()
+
     def _set_answers(self, note: ObsidianNote, text: str):
         for i, ans in enumerate(note.answers):
             if ans.is_self_ref():
@@ -209,9 +387,43 @@ class VaultCrawler:
 
             note.answers[i].set(ans_text)
 
+    def _set_media(self, note: ObsidianNote):
+        for name in note.get_media_embeds():
+            filepath = self.find_media(name)
+            anki_name = media_name(note.vault, path.relpath(filepath, self.vault))
+            note.media[anki_name] = filepath
+            note.media_names[name] = anki_name
+
+    def find_media(self, name: str) -> str:
+        key = path.basename(name)
+        if key not in self._vault_media:
+            self._miss('media:' + key, path.join(self.vault, name))
+            raise CrawlerError(f'embed points to a non-existent file: {key}')
+
+        relative_paths = self._vault_media[key]
+
+        filepath = None
+        if len(relative_paths) == 1:
+            filepath = path.join(self.vault, path.normcase(relative_paths[0]))
+        else:
+            for rp in relative_paths:
+                if rp == name:
+                    filepath = path.join(self.vault, path.normcase(rp))
+                    break
+
+        if filepath is None:
+            raise CrawlerError(f'embed points to an ambiguous file: {name}')
+        if not path.isfile(filepath):
+            self._miss('media:' + key, filepath)
+            raise CrawlerError(f'embed points to a non-existent file: {name}')
+
+        self._resolved.add(filepath)
+        return filepath
+
     def _goto(self, link: ObsidianLink) -> str:
         key = path.basename(link.name)
         if key not in self._vault_links:
+            self._miss('link:' + key, path.join(self.vault, link.name + '.md'))
             raise CrawlerError(f'link points to a non-existent file: {key}')
 
         relative_paths = self._vault_links[key]
@@ -225,7 +437,62 @@ class VaultCrawler:
                     filepath = path.join(self.vault, path.normcase(rp))
                     break
 
-        if filepath is None:
+        if filepath is None or not path.isfile(filepath):
+            self._miss('link:' + key, filepath if filepath is not None else path.join(self.vault, link.name + '.md'))
             raise CrawlerError(f'link points to a non-existent file: {link}')
 
+        self._resolved.add(filepath)
         return navigate(filepath, link, parse_mode(link))
+
+    def _miss(self, target: str, filepath: str) -> None:
+        # a target the last crawl did not find either only needs a new crawl once a file is where the link points
+        self._missed.add(target)
+        if target not in self._known_missing or path.isfile(filepath):
+            self._misses += 1
+
+    def _is_indexed(self, target: str) -> bool:
+        kind, name = target.split(':', 1)
+        return name in (self._vault_links if kind == 'link' else self._vault_media)
+
+    def _select_files(self, filepaths: List[str]):
+        # anki_files and invalid_files as a crawl limited to filepaths would find them
+        self.anki_files: List[str] = []
+        self.invalid_files: Dict[str, str] = {}
+        for filepath in filepaths:
+            filepath = path.abspath(filepath)
+            if not path.normcase(filepath).startswith(path.normcase(self.vault) + path.sep):
+                raise ValueError(f'{filepath} is not in the vault {self.vault}')
+            # same prefix as the paths of a crawl
+            filepath = path.join(self.vault, filepath[len(self.vault) + 1:])
+
+            with open(filepath, 'r', encoding='utf-8') as fp:
+                text = fp.read()
+
+            is_anki, reason = is_anki_file(text)
+            if not is_anki:
+                _, rp = relpath(self.vault, filepath)
+                self.invalid_files[rp] = reason
+            else:
+                self.anki_files.append(filepath)
+
+    def _load_link_index(self) -> bool:
+        if self.index_path is None or not path.isfile(self.index_path):
+            return False
+        with open(self.index_path, 'r', encoding='utf-8') as fp:
+            data = json.load(fp)
+        if data.get('vault') != self.vault:
+            return False
+
+        self._vault_links = data['links']
+        self._vault_media = data['media']
+        self._known_missing = set(data.get('missing', []))
+        return True
+
+    def _save_link_index(self):
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            json.dump({
+                'vault': self.vault, 'links': self._vault_links, 'media': self._vault_media,
+                'missing': sorted(self._known_missing)
+            }, fp)
+        os.replace(tmp, self.index_path)
@@ -0,0 +1,64 @@
+﻿import re
+
+from bisect import bisect_left
+from typing import Dict, Hashable, List, Set
+
+RE_TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> List[str]:
+    return RE_TOKEN.findall(text.lower())
+
+
+class NoteIndex:
+    """
+    Inverted index from the lowercase word tokens of some named fields to the keys of the notes holding them.
+    Every token is indexed alone and as ":field:token", so a query like "deck:math" can be restricted to a field.
+    search() matches every query token as a prefix and returns the notes matching all of them.
+    """
+    def __init__(self, fields=('path', 'deck', 'tag', 'status', 'text')):
+        self.fields = fields
+        self._postings: Dict[str, Set[Hashable]] = {}
+        self._vocabulary: List[str] | None = None
+
+    def __len__(self):
+        return len(self._postings)
+
+    def add(self, key: Hashable, **fields: str) -> None:
+        for field, text in fields.items():
+            if field not in self.fields:
+                raise ValueError(f'unknown field: {field}')
+            for token in tokenize(text):
+                self._postings.setdefault(token, set()).add(key)
+                self._postings.setdefault(f':{field}:{token}', set()).add(key)
+        self._vocabulary = None
+
+    def search(self, query: str) -> Set[Hashable] | None:
+        """
+        :return: the keys matching every token of query, None when query has no token (everything matches).
+        """
+        result = None
+        for term in query.lower().split():
+            field, sep, value = term.partition(':')
+            if sep and field in self.fields:
+                prefixes = [f':{field}:{token}' for token in tokenize(value)]
+            else:
+                prefixes = tokenize(term)
+
+            for prefix in prefixes:
+                keys = self._prefix(prefix)
+                result = keys if result is None else result & keys
+                if len(result) == 0:
+                    return result
+        return result
+
+    def _prefix(self, prefix: str) -> Set[Hashable]:
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._postings)
+
+        keys = set()
+        i = bisect_left(self._vocabulary, prefix)
+        while i < len(self._vocabulary) and self._vocabulary[i].startswith(prefix):
+            keys |= self._postings[self._vocabulary[i]]
+            i += 1
+        return keys
@@ -52,10 +52,18 @@ RE_ANKI_TAG = re.compile(r'#anki/(.+?)\s')
 RE_NOTE_BODY = re.compile(r'(?:^|\n\s*)\d+\. +(.+)')  # re.compile(r'(?<=\n)\s*\d+\. +(.+)')
 # Targe: QUESTION .|? [[text[#op]|ans]]
 # Groups: (1)=question, (2)=link
-RE_NOTE_ENTRY = re.compile(r'(.+?(?:[.?]|$))\s*(?:\[\[(.+\|' + ANS_ALIAS_TOKEN + r'(?:_\w*)?)]])*')
+# embeds (![[image.png]]) are matched as a whole, so the dot of the file extension does not end the question
+RE_NOTE_ENTRY = re.compile(r'((?:!\[\[[^\]]*]]|.)+?(?:[.?]|$))\s*(?:\[\[(.+\|' + ANS_ALIAS_TOKEN + r'(?:_\w*)?)]])*')
 # Target: [[ANY TEXT BETWEEN TWO BRACKETS]]
 # Group: text in between, may contain the optional #heading link or |link renaming tokens
 RE_LINKS = re.compile(r'\[\[(.+?)]]')
+MEDIA_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.svg', '.webp')
+# Target: ![[path/to/image.png|WIDTHxHEIGHT]]
+# Groups: (1)=file name or path, (2)=optional width, (3)=optional height
+RE_MEDIA_EMBED = re.compile(
+    r'!\[\[([^\]|]+?(?:' + '|'.join(re.escape(ext) for ext in MEDIA_EXTENSIONS) + r'))(?:\|(\d+)(?:x(\d+))?)?]]',
+    flags=re.IGNORECASE
+)
 
 
 def parse_link(link: str) -> ObsidianLink:
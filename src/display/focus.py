@@ -3,6 +3,7 @@ from tkinter import ttk
 
 from crawler import VaultCrawler
 from .screens import FirstStep, SecondStep, ThirdStep, FourthStep, AppController
+from .tasks import TaskRunner
 from display import messages as mbox
 
 from anki_handler import MODEL_NAME
@@ -25,6 +26,7 @@ def changes_warning(changes):
 
 class Focus(AppController):
     def __init__(self, root, crawler: VaultCrawler):
+        super().__init__()
         self._root_window = root
 
         self._mainframe = ttk.Frame(root, padding=(5, 5, 5, 5))
@@ -68,6 +70,11 @@ class Focus(AppController):
     def func_cancel(self, args=None):
         self._mainframe.quit()
 
+    def func_goto(self, step: type, args=None):
+        # straight to the first step of this type, for shortcuts like the file sync of the first step
+        self._app_index = [type(app) for app in self._apps].index(step)
+        self._execute(args)
+
     def _execute(self, args):
         for w in self._step_frame.winfo_children():
             w.destroy()
@@ -83,10 +90,11 @@ class Focus(AppController):
 
 
 def mainloop(crawler: VaultCrawler):
-    is_startup_ok, changes = anki_handler.startup()
-    if not is_startup_ok:
-        changes_warning(changes)
-
+    """
+    Shows the window first, the first step reads the vault on a worker thread while AnkiConnect is checked on another
+    one, so the window keeps repainting during the retries and timeouts of the client. The model changes are asked
+    for once the check is done. The steps talking to Anki wait for both, see AppController.wait_for_anki.
+    """
     root = Tk()
     root.columnconfigure(0, weight=1, minsize=900)
     root.rowconfigure(0, weight=1, minsize=600)
@@ -94,4 +102,26 @@ def mainloop(crawler: VaultCrawler):
     app = Focus(root, crawler)
     app.mainloop()
 
+    errors = []
+
+    def on_done(result):
+        is_startup_ok, changes = result
+        if not is_startup_ok:
+            try:
+                changes_warning(changes)
+            except Exception as ex:
+                on_error(ex)
+                return
+        app.set_anki_ready()
+
+    def on_error(ex):
+        # raised once the main loop returns, as when the check ran before it
+        errors.append(ex)
+        app.set_anki_ready(ex)
+        root.quit()
+
+    TaskRunner(root).run(anki_handler.startup, on_done, on_error)
     root.mainloop()
+    if len(errors) > 0:
+        root.destroy()
+        raise errors[0]
@@ -10,6 +10,19 @@ class Error:
         msg = 'Please select at least one valid item to continue'
         messagebox.showerror(title, msg, parent=cls.parent)
 
+    @classmethod
+    def no_valid_notes(cls, n_invalid):
+        title = 'No valid notes'
+        msg = f'The selected files have no valid note to sync, {n_invalid} invalid notes (see the console)'
+        messagebox.showerror(title, msg, parent=cls.parent)
+
+    @classmethod
+    def task_failed(cls, error):
+        title = 'Step failed'
+        msg = f'The step could not be completed:\n\t{type(error).__name__}: {error}\n\n'
+        msg += 'Fix the problem and use [refresh] or [back] to try again'
+        messagebox.showerror(title, msg, parent=cls.parent)
+
 
 class Alert:
     parent = None
@@ -0,0 +1,72 @@
+﻿import threading
+import time
+
+from typing import List, Tuple
+
+import anki_handler
+from anki_handler import AnkiConnectClient
+from progress import Progress, ensure
+
+MIN_DELAY = 0.05
+MAX_DELAY = 2.0
+START_DELAY = 0.5
+# the pause after each note is this many times the recent guiEditNote latency
+LATENCY_FACTOR = 2.0
+LATENCY_SMOOTHING = 0.3
+
+
+class LatexRenderQueue(threading.Thread):
+    """
+    Opens each note in the Anki editor with guiEditNote, so Anki renders its MathJax, on a worker thread.
+    The pause between notes follows the response latency: Anki answers slower while it is still busy rendering.
+    Progress is read from progress (or done/total), cancel() stops the queue before the next note.
+    """
+    def __init__(self, note_ids: List[int], progress: Progress = None):
+        super().__init__(daemon=True)
+        self.note_ids = note_ids
+        self.progress = ensure(progress)
+        self.errors: List[Tuple[int, str]] = []
+
+        # wakes the pause between notes when cancelled
+        self._wakeup = threading.Event()
+        # own connection, the shared client is not held by guiEditNote while the steps send their actions
+        client = anki_handler.get_client()
+        self._client = AnkiConnectClient(client.host, client.port, client.timeout, client.connect_timeout)
+
+    @property
+    def done(self) -> int:
+        return self.progress.done
+
+    @property
+    def total(self) -> int:
+        return len(self.note_ids)
+
+    def cancel(self):
+        self.progress.cancel()
+        self._wakeup.set()
+
+    def is_cancelled(self) -> bool:
+        return self.progress.is_cancelled()
+
+    def run(self):
+        latency = START_DELAY / LATENCY_FACTOR
+        self.progress.start('rendering latex', len(self.note_ids))
+        try:
+            for note_id in self.note_ids:
+                if self.progress.is_cancelled():
+                    break
+
+                start = time.perf_counter()
+                try:
+                    self._client.invoke('guiEditNote', note=note_id)
+                except Exception as ex:
+                    self.errors.append((note_id, str(ex)))
+                elapsed = time.perf_counter() - start
+
+                latency = LATENCY_SMOOTHING * elapsed + (1 - LATENCY_SMOOTHING) * latency
+                self.progress.advance()
+
+                delay = min(max(LATENCY_FACTOR * latency, MIN_DELAY), MAX_DELAY)
+                self._wakeup.wait(delay)
+        finally:
+            self._client.close()
@@ -1,20 +1,82 @@
-﻿import time
+﻿import threading
 
 from abc import ABC, abstractmethod
-from typing import Callable
+from tkinter import filedialog
+from typing import Any, Callable, Set, Tuple
 
+import media
 import printer
+import settings
+import similarity
 import anki_handler
 from anki_handler import AnkiNote
-from crawler import VaultCrawler, ObsidianNote
+from progress import Progress, Cancelled
+from pipeline import threaded
+from mirror import AnkiMirror
+from sources import SourceMap
+from journal import SyncJournal
+from crawler import VaultCrawler, ObsidianNote, NoteIndex
 from .utils import *
+from .render_queue import LatexRenderQueue
+from .tasks import TaskRunner, BusyIndicator
 from display import messages as mbox
 
 
 RATIO_T = 0.8
+# cosine similarity of the character 3-grams of two questions of the selection, not a SequenceMatcher ratio
+BATCH_DUP_T = 0.9
+RENDER_POLL_MS = 100
+# seconds between two cancel checks while a step waits for the AnkiConnect startup
+STARTUP_POLL = 0.1
+# search results up to this many notes are shown expanded
+OPEN_MATCHES = 200
 
 
 class AppController(ABC):
+    """
+    Besides navigation, keeps the computed model of each step keyed on the inputs it was computed from, so going back
+    and forward between steps redraws them without computing everything again.
+    """
+    def __init__(self):
+        # step name -> (key, model)
+        self._step_cache: Dict[str, Tuple[Any, Any]] = {}
+        # set once the profile is loaded and the model checked, see set_anki_ready
+        self._anki_ready = threading.Event()
+        self._anki_error: BaseException | None = None
+
+    def set_anki_ready(self, error: BaseException = None) -> None:
+        # called on the Tk thread when the startup check and the model changes are done, or failed with error
+        self._anki_error = error
+        self._anki_ready.set()
+
+    def wait_for_anki(self, progress: Progress) -> None:
+        """
+        Blocks the worker thread of a step talking to Anki until set_anki_ready(), so it never runs against another
+        profile or a model without the required changes. Stops with Cancelled when progress is cancelled.
+        """
+        if not self._anki_ready.is_set():
+            progress.start('waiting for AnkiConnect')
+        while not self._anki_ready.wait(STARTUP_POLL):
+            progress.check()
+        if self._anki_error is not None:
+            raise self._anki_error
+
+    def cache_get(self, name: str, key) -> Any | None:
+        cached = self._step_cache.get(name)
+        if cached is None or cached[0] != key:
+            return None
+        return cached[1]
+
+    def cache_set(self, name: str, key, model) -> None:
+        self._step_cache[name] = (key, model)
+
+    def cache_invalidate(self, *names: str) -> None:
+        # every step when no name is given
+        if len(names) == 0:
+            self._step_cache = {}
+        for name in names:
+            self._step_cache.pop(name, None)
+
     @abstractmethod
     def func_continue(self, args):
         raise NotImplementedError
@@ -27,20 +89,28 @@ class AppController(ABC):
     def func_cancel(self, args):
         raise NotImplementedError
 
+    @abstractmethod
+    def func_goto(self, step: type, args):
+        raise NotImplementedError
+
 
 class AppStep(ABC):
+    busy_text = 'Working, please wait...'
+
     def __init__(self, parent: AppController, mainframe: ttk.Frame):
         self.parent = parent
         self._mainframe = mainframe
 
         self._buttons_frame = None
         self._contents_frame = None
+        self._runner = TaskRunner(mainframe)
+        # False while load() runs and after it failed, the contents are not built
+        self._loaded = False
 
     def mainloop(self):
         self._contents_frame = ttk.Frame(self._mainframe)
         self._buttons_frame = ttk.Frame(self._mainframe)
 
-        self.build_contents()
         self.build_buttons()
 
         self._contents_frame.grid(column=0, row=0, sticky='NEWS')
@@ -49,6 +119,51 @@ class AppStep(ABC):
         self._mainframe.columnconfigure(0, weight=1)
         self._mainframe.rowconfigure(0, weight=1)
 
+        self.run_step()
+
+    def run_step(self):
+        """
+        Runs load() on a worker thread, with a busy indicator in place of the contents and the buttons disabled,
+        then build_contents() on the Tk thread. The busy indicator shows the progress reported by load() and can
+        cancel it.
+        """
+        for i in self._contents_frame.winfo_children():
+            i.destroy()
+        self._loaded = False
+        self.set_buttons_state(False)
+
+        progress = Progress()
+        busy = BusyIndicator(self._contents_frame, self.busy_text, progress)
+
+        def on_done(_):
+            busy.destroy()
+            self._loaded = True
+            self.build_contents()
+            self.set_buttons_state(True)
+
+        def on_error(ex):
+            busy.destroy()
+            self.set_buttons_state(True)
+            if isinstance(ex, Cancelled):
+                print(f'Step cancelled: {ex}')
+                ttk.Label(self._contents_frame, text='Cancelled, use [refresh] to run this step again').grid()
+            else:
+                mbox.Error.task_failed(ex)
+
+        self._runner.run(lambda: self.load(progress), on_done, on_error, busy.update)
+
+    def set_buttons_state(self, enabled: bool):
+        for w in self._buttons_frame.winfo_children():
+            if isinstance(w, ttk.Button):
+                w.state(['!disabled'] if enabled else ['disabled'])
+
+    def is_busy(self) -> bool:
+        return self._runner.is_running()
+
+    def load(self, progress: Progress):
+        # the slow part of the step, runs on a worker thread and must not touch any widget
+        pass
+
     @abstractmethod
     def set_input(self, *args):
         raise NotImplementedError
@@ -63,9 +178,13 @@ class AppStep(ABC):
 
 
 class FirstStep(AppStep):
+    busy_text = 'Reading the vault, please wait...'
+
     def __init__(self, parent, mainframe: ttk.Frame):
         super().__init__(parent, mainframe)
         self._crawler: VaultCrawler | None = None
+        self._tree: dict | None = None
+        self._needs_crawl = False
 
     def set_input(self, *args):
         self._crawler = args[0]
@@ -76,30 +195,67 @@ class FirstStep(AppStep):
         b_continue = ttk.Button(root, text='continue', command=self.parent.func_continue)
         b_cancel = ttk.Button(root, text='cancel', command=self.parent.func_cancel)
         b_refresh = ttk.Button(root, text='refresh', command=self.refresh)
+        b_files = ttk.Button(root, text='sync files...', command=self.sync_files)
 
         b_refresh.grid(column=0, row=0, sticky='W')
-        b_cancel.grid(column=1, row=0)
-        b_continue.grid(column=2, row=0)
+        b_files.grid(column=1, row=0, sticky='W')
+        b_cancel.grid(column=2, row=0)
+        b_continue.grid(column=3, row=0)
 
-        root.columnconfigure(0, weight=1)
+        root.columnconfigure(1, weight=1)
 
     def refresh(self):
-        for i in self._contents_frame.winfo_children():
-            i.destroy()
-        self._crawler.reset()
-        self.build_contents()
+        self._needs_crawl = True
+        self.run_step()
+
+    def sync_files(self):
+        """
+        Converts only the files picked in a dialog and goes straight to the Anki check of their notes. Their links are
+        resolved through the link index saved by the crawl of this step, the other files are not converted.
+        """
+        filepaths = filedialog.askopenfilenames(
+            parent=self._mainframe, initialdir=self._crawler.vault, filetypes=[('Markdown', '*.md')]
+        )
+        if len(filepaths) == 0:
+            return
+
+        crawler = VaultCrawler(self._crawler.vault, crawl=False, index_path=self._crawler.index_path)
+
+        def on_done(_):
+            self.set_buttons_state(True)
+            for md_note in crawler.invalid_notes:
+                print(f'WARNING: invalid note in {md_note.relative_path}, {md_note.get_invalid_reason()}')
+            if len(crawler.valid_notes) == 0:
+                mbox.Error.no_valid_notes(len(crawler.invalid_notes))
+                return
+            self.parent.func_goto(ThirdStep, crawler.valid_notes)
+
+        def on_error(ex):
+            self.set_buttons_state(True)
+            mbox.Error.task_failed(ex)
+
+        self.set_buttons_state(False)
+        self._runner.run(lambda: crawler.convert_paths(filepaths), on_done, on_error)
+
+    def load(self, progress: Progress):
+        if self._needs_crawl or not self._crawler.is_crawled():
+            self._crawler.reset(progress)
+            self._needs_crawl = False
+            self.parent.cache_invalidate()
+        self._tree = self._crawler.build_filetree()
 
     def build_contents(self):
         root = self._contents_frame
 
         treeview = ttk.Treeview(root, columns=['counter', 'anki_status'])
+        lazy_tree = LazyTree(treeview)
 
-        tree = self._crawler.build_filetree()
+        tree = self._tree
 
         vid = treeview.insert('', 'end', text='Valid Anki files', values=[count_leaves(tree['valid_files']), ''])
         iid = treeview.insert('', 'end', text='Invalid Anki files', values=[count_leaves(tree['invalid_files']), ''])
-        build_filetree_view(treeview, vid, tree['valid_files'])
-        build_filetree_view(treeview, iid, tree['invalid_files'])
+        build_filetree_view(lazy_tree, vid, tree['valid_files'])
+        build_filetree_view(lazy_tree, iid, tree['invalid_files'])
 
         treeview.heading('#0', text='File')
         treeview.heading('counter', text='# of files')
@@ -115,12 +271,17 @@ class FirstStep(AppStep):
 
 
 class SecondStep(AppStep):
+    busy_text = 'Converting notes, please wait...'
+
     def __init__(self, parent: AppController, mainframe: ttk.Frame):
         super().__init__(parent, mainframe)
 
         self._crawler: VaultCrawler | None = None
         self._treeview: ttk.Treeview | None = None
+        self._lazy_tree: LazyTree | None = None
+        self._search: SearchBar | None = None
         self._index_map: Dict[str, int] = {}
+        self._trees: Tuple[NoteTree, NoteTree] | None = None
 
     def set_input(self, *args):
         self._crawler = args[0]
@@ -145,13 +306,50 @@ class SecondStep(AppStep):
         self._buttons_frame.columnconfigure(2, weight=1)
 
     def refresh(self) -> None:
-        for i in self._contents_frame.winfo_children():
-            i.destroy()
-        self.build_contents()
+        self.parent.cache_invalidate('notes', 'entries')
+        self.run_step()
+
+    def load(self, progress: Progress):
+        # converted again only when an Anki file of the vault or a file its notes link to or embed changed
+        self._trees = self.parent.cache_get('notes', self._crawler.fingerprint())
+        if self._trees is not None:
+            return
+
+        self._crawler.convert_files(progress)
+        self._trees = self._crawler.build_notetree()
+        # taken after the conversion, which found the linked files
+        self.parent.cache_set('notes', self._crawler.fingerprint(), self._trees)
+
+    def filter(self, query: str) -> None:
+        hits = self._crawler.note_index.search(query)
+        if hits is None:
+            self._populate(*self._trees)
+            self._search.set_count('')
+            return
+
+        trees = []
+        for kind, notes in (('valid', self._crawler.valid_notes), ('invalid', self._crawler.invalid_notes)):
+            indices = sorted(i for k, i in hits if k == kind)
+            trees.append(NoteTree([notes[i] for i in indices], indices))
+        self._populate(*trees)
+        if len(hits) <= OPEN_MATCHES:
+            for iid in self._treeview.get_children(''):
+                self._lazy_tree.open_all(iid)
+        self._search.set_count(f'{len(hits)} notes')
+
+    def select_matches(self, query: str) -> None:
+        # the top level items hold every match, execute resolves them to the notes
+        self._treeview.selection_set(self._treeview.get_children(''))
 
     def execute(self, func: Callable):
+        if not self._loaded:
+            mbox.Error.invalid_selection()
+            return
+
         iid_list = self._treeview.selection()
-        index_list = get_treeview_selection(self._treeview, iid_list, key=lambda x: 'valid' in x, option='tags')
+        index_list = get_treeview_selection(
+            self._treeview, iid_list, key=lambda x: 'valid' in x, option='tags', lazy_tree=self._lazy_tree
+        )
 
         if len(index_list) == 0:
             mbox.Error.invalid_selection()
@@ -163,15 +361,10 @@ class SecondStep(AppStep):
         ])
 
     def build_contents(self):
+        self._search = SearchBar(self._contents_frame, self.filter, self.select_matches)
         self._treeview = ttk.Treeview(self._contents_frame, columns=['counter', 'status', 'text'])
-
-        self._crawler.convert_files()
-        v_tree, inv_tree = self._crawler.build_notetree()
-
-        vid = self._treeview.insert('', 'end', 'valid', text='Valid notes', values=[count_leaves(v_tree), '', ''])
-        iid = self._treeview.insert('', 'end', 'invalid', text='Invalid notes', values=[count_leaves(inv_tree), '', ''])
-        self._index_map = build_notetree_view(self._treeview, vid, v_tree)
-        self._index_map.update(build_notetree_view(self._treeview, iid, inv_tree))
+        self._lazy_tree = LazyTree(self._treeview)
+        self._populate(*self._trees)
 
         self._treeview.heading('#0', text='File')
         self._treeview.heading('status', text='Status')
@@ -182,20 +375,42 @@ class SecondStep(AppStep):
         self._treeview.column('text', anchor='center')
         self._treeview.column('counter', anchor='center')
 
-        self._treeview.grid(column=0, row=0, sticky='NEWS')
+        self._search.frame.grid(column=0, row=0, sticky='WE', pady=(0, 5))
+        self._treeview.grid(column=0, row=1, sticky='NEWS')
         self._contents_frame.columnconfigure(0, weight=1)
-        self._contents_frame.rowconfigure(0, weight=1)
+        self._contents_frame.rowconfigure(1, weight=1)
+
+    def _populate(self, v_tree: NoteTree, inv_tree: NoteTree) -> None:
+        self._lazy_tree.clear()
+        vid = self._treeview.insert('', 'end', 'valid', text='Valid notes', values=[count_leaves(v_tree), '', ''])
+        iid = self._treeview.insert('', 'end', 'invalid', text='Invalid notes', values=[count_leaves(inv_tree), '', ''])
+        self._index_map = build_notetree_view(self._lazy_tree, vid, v_tree, prefix='valid_note')
+        self._index_map.update(build_notetree_view(self._lazy_tree, iid, inv_tree, prefix='invalid_note'))
 
 
 class ThirdStep(AppStep):
+    busy_text = 'Checking notes with Anki, please wait...'
+    _groups = {
+        'can_add': 'Can add', 'can_edit': 'Can edit', 'duplicated': 'Duplicated', 'error': 'Error',
+        'unchanged': 'Unchanged'
+    }
+
     def __init__(self, parent: AppController, mainframe: ttk.Frame):
         super().__init__(parent, mainframe)
 
         self._md_notes: List[ObsidianNote] = []
         self._anki_entries: List[AnkiNote] = []
         self._index_map: Dict[str, int] = {}
+        # entries similar to another entry of the same selection
+        self._batch_dups: Set[int] = set()
+
+        self._search_index: NoteIndex | None = None
+        # (group, node) of each entry, in entry order
+        self._entry_nodes: List[Tuple[str, TreeNode]] = []
 
         self._treeview: ttk.Treeview | None = None
+        self._lazy_tree: LazyTree | None = None
+        self._search: SearchBar | None = None
 
     def set_input(self, *args):
         if isinstance(args[0][0], ObsidianNote):
@@ -224,28 +439,23 @@ class ThirdStep(AppStep):
         self._buttons_frame.columnconfigure(2, weight=1)
 
     def refresh(self):
-        for i in self._contents_frame.winfo_children():
-            i.destroy()
-        self.build_contents()
-
-    def generate_anki_entries(self):
-        self._anki_entries = []
-        for md_note in self._md_notes:
-            front, back = printer.note_to_html(list(md_note.get_fields()))
-            note = AnkiNote(md_note.deck, front, back, md_note.tags)
-            self._anki_entries.append(note)
+        self.parent.cache_invalidate('entries')
+        self.run_step()
 
     def execute(self, func: Callable, key=Callable) -> None:
+        if not self._loaded:
+            mbox.Error.invalid_selection()
+            return None
+
         iid_list = self._treeview.selection()
         index_list = get_treeview_selection(
             self._treeview,
             iid_list,
-            key=key, option='tags'
+            key=key, option='tags', lazy_tree=self._lazy_tree
         )
 
-        selected_entries = [
-            self._anki_entries[self._index_map[iid]] for iid in index_list
-        ]
+        selected_index = [self._index_map[iid] for iid in index_list]
+        selected_entries = [self._anki_entries[i] for i in selected_index]
 
         if len(selected_entries) == 0:
             mbox.Error.invalid_selection()
@@ -253,7 +463,10 @@ class ThirdStep(AppStep):
 
         if func == self.parent.func_continue:
             # alert user about duplicated items going into anki
-            ratio_warn = len(list(filter(lambda n: n.max_t() >= RATIO_T, selected_entries))) > 0
+            ratio_warn = len([
+                i for i in selected_index
+                if self._anki_entries[i].max_t() >= RATIO_T or i in self._batch_dups
+            ])
             if ratio_warn > 0:
                 _continue = mbox.Alert.duplicated_notes(ratio_warn, RATIO_T)
                 if _continue is not True:
@@ -261,38 +474,113 @@ class ThirdStep(AppStep):
 
         func(selected_entries)
 
-    def build_contents(self):
-        print(f'Started Anki preparation on selected items: step build_contents()')
+    def load(self, progress: Progress):
+        self.parent.wait_for_anki(progress)
 
-        self.generate_anki_entries()
-        self._index_map = {}
+        # the selected notes are the objects of the cached note tree, new objects mean the vault was converted again.
+        # The key holds the objects themselves: ids of freed notes are reused by the notes of the next conversion
+        key = tuple(self._md_notes)
+        cached = self.parent.cache_get('entries', key)
+        if cached is not None:
+            self._anki_entries, self._batch_dups, self._search_index = cached
+            return
 
-        self._treeview = ttk.Treeview(self._contents_frame, columns=['dt', 'status', 'ratio', 'text'])
+        print(f'Started Anki preparation on selected items: step load()')
+
+        source_map = SourceMap.open()
+        anki_mirror = AnkiMirror.open() if settings.MIRROR else None
+        if anki_mirror is not None:
+            anki_mirror.refresh()
+        counts = {'unknown': 0, 'verify': 0}
+
+        def select(chunk: List[AnkiNote]) -> List[AnkiNote]:
+            # notes pushed by a previous sync are linked through their source ID, only new notes are checked
+            unknown = source_map.plan(chunk)
+            counts['unknown'] += len(unknown)
+            if anki_mirror is not None:
+                # only the notes related to changes in the collection go back to AnkiConnect
+                unknown = anki_mirror.check_notes(unknown)
+            counts['verify'] += len(unknown)
+            return unknown
+
+        # notes are rendered on a worker thread while the previous chunks are checked by Anki
+        try:
+            self._anki_entries = anki_handler.check_notes_stream(
+                threaded(printer.render_notes(self._md_notes)), select, len(self._md_notes), progress=progress
+            )
+        finally:
+            if anki_mirror is not None:
+                anki_mirror.close()
 
-        ok_id = self._treeview.insert('', 'end', 'can_add', text='Can add')
-        edit_id = self._treeview.insert('', 'end', 'can_edit', text='Can edit')
-        dup_id = self._treeview.insert('', 'end', 'duplicated', text='Duplicated')
-        err_id = self._treeview.insert('', 'end', 'error', text='Error')
+        n_entries = len(self._anki_entries)
+        print(f'\t{n_entries - counts["unknown"]}/{n_entries} notes linked by source ID')
+        if anki_mirror is not None:
+            print(f'\t{counts["verify"]}/{counts["unknown"]} notes verified with AnkiConnect')
 
-        notes = [note.to_json() for note in self._anki_entries]
-        result = anki_handler.invoke('canAddNotesWithErrorDetail', notes=notes)
+        pairs = similarity.batch_duplicates(
+            [similarity.plain_text(n.question) for n in self._anki_entries], BATCH_DUP_T, progress
+        )
+        self._batch_dups = {i for pair in pairs for i in pair[:2]}
+        for i, j, sim in pairs:
+            print(f'\tWARNING: similar notes in selection ({sim:.2f}): '
+                  f'{self._md_notes[i].relative_path} and {self._md_notes[j].relative_path}')
+
+        # same fields as the note index of the crawler, with the status given by Anki
+        self._search_index = NoteIndex()
+        for i, (md_note, anki_entry) in enumerate(zip(self._md_notes, self._anki_entries)):
+            fields = md_note.index_fields()
+            fields['status'] = anki_entry.status
+            self._search_index.add(i, **fields)
+
+        self.parent.cache_set('entries', key, (self._anki_entries, self._batch_dups, self._search_index))
+
+    def filter(self, query: str) -> None:
+        hits = self._search_index.search(query)
+        self._populate(hits)
+        if hits is not None and len(hits) <= OPEN_MATCHES:
+            for iid in self._treeview.get_children(''):
+                self._lazy_tree.open_all(iid)
+        self._search.set_count('' if hits is None else f'{len(hits)} notes')
+
+    def select_matches(self, query: str) -> None:
+        self._treeview.selection_set(self._treeview.get_children(''))
 
-        for i, res in enumerate(result):
-            print(f'\t ({i + 1})/{len(result)}: {self._md_notes[i].relative_path} response={res}')
+    def build_contents(self):
+        self._index_map = {}
+        self._entry_nodes = []
 
-            parent, text, values, tags = self.create_treeview(i, res, ok_id, dup_id, err_id, edit_id)
+        self._search = SearchBar(self._contents_frame, self.filter, self.select_matches)
+        self._treeview = ttk.Treeview(self._contents_frame, columns=['dt', 'status', 'ratio', 'text'])
+        self._lazy_tree = LazyTree(self._treeview)
+
+        for i, anki_entry in enumerate(self._anki_entries):
+            parent, text, values, tags = self.create_treeview(
+                i, 'can_add', 'duplicated', 'error', 'can_edit', 'unchanged'
+            )
 
-            iid = self._treeview.insert(parent, 'end', text=text, values=values, tags=tags)
+            iid = f'entry{i}'
+            self._entry_nodes.append((parent, TreeNode(text, values, tags, iid=iid)))
             self._index_map[iid] = i
 
+        self._populate(None)
         self.style_tree()
 
-    def create_treeview(self, i, res, ok_id, dup_id, err_id, edit_id):
+    def _populate(self, hits: Set[int] | None) -> None:
+        self._lazy_tree.clear()
+
+        entries: Dict[str, List[TreeNode]] = {group: [] for group in self._groups}
+        for i, (group, node) in enumerate(self._entry_nodes):
+            if hits is None or i in hits:
+                entries[group].append(node)
+
+        # entries are inserted when their group is opened
+        for group, text in self._groups.items():
+            self._lazy_tree.insert('', TreeNode(text, [], iid=group, children=entries[group]))
+
+    def create_treeview(self, i, ok_id, dup_id, err_id, edit_id, same_id):
         md_note = self._md_notes[i]
         anki_entry = self._anki_entries[i]
 
-        anki_entry.parse_can_add_response(res)
-
         tags = []
         if anki_entry.is_valid():
             status = 'OK'
@@ -301,6 +589,18 @@ class ThirdStep(AppStep):
             tags.extend(['valid', 'selectable'])
             if anki_entry.max_t() >= RATIO_T:
                 tags.append('ratio_warn')
+            if i in self._batch_dups:
+                tags.append('batch_dup')
+
+        elif anki_entry.is_source_update():
+            status = anki_entry.status
+            tags.extend(['selectable', 'can_edit'])
+            parent = edit_id
+
+        elif anki_entry.is_unchanged():
+            status = anki_entry.status
+            tags.append('selectable')
+            parent = same_id
 
         else:
             status = anki_entry.status
@@ -328,6 +628,7 @@ class ThirdStep(AppStep):
         self._treeview.tag_configure('ratio_warn', background='#ffed7d')
         self._treeview.tag_configure('can_edit', background='#5175a9')
         self._treeview.tag_configure('new_candidate', background='#677e53')
+        self._treeview.tag_configure('batch_dup', background='#f2a36b')
 
         self._treeview.heading('#0', text='File')
         self._treeview.heading('dt', text='deck::tag')
@@ -340,17 +641,25 @@ class ThirdStep(AppStep):
         self._treeview.column('ratio', width=10, anchor='center')
         self._treeview.column('text', width=48)
 
-        self._treeview.grid(column=0, row=0, sticky='NEWS')
+        self._search.frame.grid(column=0, row=0, sticky='WE', pady=(0, 5))
+        self._treeview.grid(column=0, row=1, sticky='NEWS')
         self._contents_frame.columnconfigure(0, weight=1)
-        self._contents_frame.rowconfigure(0, weight=1)
+        self._contents_frame.rowconfigure(1, weight=1)
 
 
 class FourthStep(AppStep):
+    busy_text = 'Sending notes to Anki, please wait...'
+
     def __init__(self, parent: AppController, mainframe: ttk.Frame):
         super().__init__(parent, mainframe)
 
         self._anki_entries: List[AnkiNote] | None = None
         self.results: List[int | None] = []
+        self._sync_id: str | None = None
+
+        self._render_queue: LatexRenderQueue | None = None
+        self._render_label: ttk.Label | None = None
+        self._render_progress: ttk.Progressbar | None = None
 
     def set_input(self, *args):
         if len(args[0]) < 1:
@@ -371,17 +680,33 @@ class FourthStep(AppStep):
 
         self._buttons_frame.columnconfigure(0, weight=1)
 
-    def build_contents(self):
-        self.results = []
-        for note in self._anki_entries:
-            if note.duplicate_id is not None:
-                print(f'\t editing note with ID={note.duplicate_id}')
-                r = anki_handler.invoke('updateNoteFields', note=note.to_json(True))
-                r = note.duplicate_id if r is None else r
-            else:
-                r = anki_handler.invoke('addNote', note=note.to_json())
-            self.results.append(r)
+    def load(self, progress: Progress):
+        self.parent.wait_for_anki(progress)
+        for name, error in media.store_media(self._anki_entries, progress=progress).items():
+            print(f'WARNING: unable to store {name} error={error}')
+
+        # every pushed chunk is checkpointed in the journal, a sync that dies here is recovered by the next one
+        source_map = SourceMap.open()
+        journal = SyncJournal.open()
+        self._sync_id = journal.begin(self._anki_entries)
+
+        def checkpoint(indices, note_ids):
+            journal.done(self._anki_entries, indices, note_ids)
+
+        # a cancelled push still returns the notes already added, so they can be reverted
+        if settings.BULK_INSERT:
+            self.results = anki_handler.push_notes(self._anki_entries, progress=progress, checkpoint=checkpoint)
+        else:
+            self.results = anki_handler.push_notes_sequential(self._anki_entries, progress, checkpoint)
 
+        source_map.record(self._anki_entries, self.results)
+        source_map.save()
+        journal.end()
+
+        # the collection changed, the canAdd verdicts of the previous step are out of date
+        self.parent.cache_invalidate('entries')
+
+    def build_contents(self):
         treeview = ttk.Treeview(self._contents_frame, columns=['deck', 'tags', 'text'])
 
         for i, res in enumerate(self.results):
@@ -409,8 +734,22 @@ class FourthStep(AppStep):
         self._contents_frame.rowconfigure(0, weight=1)
 
     def revert(self, func: Callable):
-        notes = list(filter(lambda x: x is not None, self.results))
-        anki_handler.invoke('deleteNotes', notes=notes)
+        # as sync.revert_last: only the notes this push added are deleted, the updated notes were in the collection
+        # before it and are left as they are
+        added = [
+            res for res, note in zip(self.results, self._anki_entries)
+            if res is not None and note.duplicate_id is None
+        ]
+        anki_handler.invoke('deleteNotes', notes=added)
+        print(f'Reverted: {len(added)} notes deleted, '
+              f'{len([r for r in self.results if r is not None]) - len(added)} updated notes left as they are')
+
+        source_map = SourceMap.open()
+        source_map.forget(added)
+        source_map.save()
+        if self._sync_id is not None:
+            SyncJournal.open().revert(self._sync_id, added)
+        self.parent.cache_invalidate('entries')
         func(self._anki_entries)
 
     def safe_quit(self):
@@ -418,13 +757,47 @@ class FourthStep(AppStep):
             if mbox.Alert.add_notes_failed() is not True:
                 return
         self.gui_quick_check()
-        self.parent.func_continue(None)
 
     def gui_quick_check(self):
-        print(f'Rendering latex equations, please wait...')
-        for i, res in enumerate(self.results):
-            if res is None:
-                continue
-            print(f'\t{i+1}/{len(self.results)}: editing {res}')
-            anki_handler.invoke('guiEditNote', note=res)
-            time.sleep(0.5)
\ No newline at end of file
+        # only notes with equations need to be opened in Anki to be rendered
+        note_ids = [
+            res for res, note in zip(self.results, self._anki_entries)
+            if res is not None and note.has_mathjax()
+        ]
+        if len(note_ids) == 0:
+            self.parent.func_continue(None)
+            return
+
+        print(f'Rendering latex equations of {len(note_ids)} notes, please wait...')
+        self._render_queue = LatexRenderQueue(note_ids)
+
+        for w in self._buttons_frame.winfo_children():
+            w.destroy()
+        self._render_label = ttk.Label(self._buttons_frame)
+        self._render_progress = ttk.Progressbar(self._buttons_frame, maximum=len(note_ids))
+        b_cancel = ttk.Button(self._buttons_frame, text='cancel rendering', command=self._render_queue.cancel)
+
+        self._render_label.grid(column=0, row=0, sticky='W')
+        self._render_progress.grid(column=1, row=0, sticky='WE')
+        b_cancel.grid(column=2, row=0)
+        self._buttons_frame.columnconfigure(1, weight=1)
+
+        self._render_queue.start()
+        self._poll_render_queue()
+
+    def _poll_render_queue(self):
+        queue = self._render_queue
+        self._render_progress['value'] = queue.done
+        self._render_label['text'] = (
+            f'Rendering latex equations {queue.done}/{queue.total} ({queue.progress.rate():.1f}/s)'
+        )
+
+        if queue.is_alive():
+            self._mainframe.after(RENDER_POLL_MS, self._poll_render_queue)
+            return
+
+        for note_id, error in queue.errors:
+            print(f'WARNING: unable to render note with ID={note_id} error={error}')
+        if queue.is_cancelled():
+            print(f'Rendering cancelled after {queue.done}/{queue.total} notes')
+        self.parent.func_continue(None)
@@ -0,0 +1,110 @@
+﻿import threading
+import traceback
+
+from tkinter import ttk
+from typing import Any, Callable
+
+# focus imports
+from progress import Progress
+
+POLL_MS = 50
+
+
+class Task(threading.Thread):
+    """ Runs func on a worker thread and keeps its result or exception, nothing in func may touch Tk widgets. """
+    def __init__(self, func: Callable[[], Any]):
+        super().__init__(daemon=True)
+        self._func = func
+        self.result = None
+        self.error: BaseException | None = None
+
+    def run(self):
+        try:
+            self.result = self._func()
+        except BaseException as ex:
+            traceback.print_exc()
+            self.error = ex
+
+
+class TaskRunner:
+    """
+    Runs the work of a wizard step on a worker thread while the Tk main loop keeps running.
+    The task is polled with after() and on_done(result) or on_error(exception) are called on the Tk thread, on_poll()
+    is called on every poll while the task runs.
+    """
+    def __init__(self, widget: ttk.Widget, poll_ms=POLL_MS):
+        self._widget = widget
+        self._poll_ms = poll_ms
+        self._task: Task | None = None
+
+    def is_running(self) -> bool:
+        return self._task is not None
+
+    def run(self, func: Callable[[], Any], on_done: Callable[[Any], None], on_error: Callable[[BaseException], None],
+            on_poll: Callable[[], None] = None):
+        if self._task is not None:
+            raise RuntimeError('a task is already running')
+        self._task = Task(func)
+        self._task.start()
+        self._widget.after(self._poll_ms, self._poll, on_done, on_error, on_poll)
+
+    def _poll(self, on_done, on_error, on_poll):
+        task = self._task
+        if task.is_alive():
+            if on_poll is not None:
+                on_poll()
+            self._widget.after(self._poll_ms, self._poll, on_done, on_error, on_poll)
+            return
+
+        self._task = None
+        if task.error is not None:
+            on_error(task.error)
+        else:
+            on_done(task.result)
+
+
+class BusyIndicator:
+    """
+    Shown in a step frame while its task runs: the step text, the stage, count and throughput of progress, a progress
+    bar (indeterminate while the stage has no total) and a button to cancel progress.
+    """
+    def __init__(self, parent: ttk.Frame, text: str, progress: Progress):
+        self._progress = progress
+
+        self._frame = ttk.Frame(parent)
+        self._label = ttk.Label(self._frame, text=text)
+        self._stage = ttk.Label(self._frame)
+        self._bar = ttk.Progressbar(self._frame, mode='indeterminate', length=240)
+        self._cancel = ttk.Button(self._frame, text='cancel', command=self.cancel)
+
+        self._label.grid(column=0, row=0)
+        self._stage.grid(column=0, row=1)
+        self._bar.grid(column=0, row=2, pady=5)
+        self._cancel.grid(column=0, row=3)
+        self._frame.grid(column=0, row=0)
+        parent.columnconfigure(0, weight=1)
+        parent.rowconfigure(0, weight=1)
+
+        self._bar.start()
+
+    def cancel(self):
+        self._progress.cancel()
+        self._cancel.state(['disabled'])
+        self._label['text'] = 'Cancelling...'
+
+    def update(self):
+        progress = self._progress
+        self._stage['text'] = str(progress) if progress.stage else ''
+        if progress.total and str(self._bar['mode']) != 'determinate':
+            self._bar.stop()
+            self._bar['mode'] = 'determinate'
+        elif not progress.total and str(self._bar['mode']) != 'indeterminate':
+            self._bar['mode'] = 'indeterminate'
+            self._bar.start()
+        if progress.total:
+            self._bar['maximum'] = progress.total
+            self._bar['value'] = progress.done
+
+    def destroy(self):
+        self._bar.stop()
+        self._frame.destroy()
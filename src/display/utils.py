@@ -1,6 +1,6 @@
 ﻿from os import path
-from tkinter import ttk
-from typing import Dict, List
+from tkinter import ttk, StringVar
+from typing import Callable, Dict, List
 
 from crawler import NoteTree
 
@@ -11,50 +11,165 @@ def count_leaves(tree: List | NoteTree | Dict[str, List | Dict]) -> int:
     return sum([count_leaves(tree[k]) for k in tree])
 
 
-def build_filetree_view(treeview, parent_id, tree):
+class TreeNode:
+    """ Item of a LazyTree, children is a list of TreeNode or a function returning it, None for a leaf. """
+    __slots__ = ('text', 'values', 'tags', 'iid', 'children')
+
+    def __init__(self, text, values, tags=(), iid=None, children: List | Callable[[], List] | None = None):
+        self.text = text
+        self.values = values
+        self.tags = list(tags)
+        self.iid = iid
+        self.children = children
+
+    def get_children(self) -> List['TreeNode']:
+        if callable(self.children):
+            self.children = self.children()
+        return self.children if self.children is not None else []
+
+    def option(self, option):
+        # same values as Treeview.item(iid, option=option)
+        if option is None:
+            return {'text': self.text, 'values': self.values, 'tags': self.tags}
+        return getattr(self, option)
+
+
+class LazyTree:
+    """
+    Inserts the children of a Treeview item the first time it is opened, items with children get a placeholder child
+    until then. The nodes of the items never opened stay available through nodes() to resolve a selection.
+    """
+    _placeholder = '#placeholder'
+
+    def __init__(self, treeview: ttk.Treeview):
+        self.treeview = treeview
+        # iid -> node whose children are not inserted yet
+        self._pending: Dict[str, TreeNode] = {}
+        treeview.bind('<<TreeviewOpen>>', self._on_open, add='+')
+
+    def insert(self, parent: str, node: TreeNode) -> str:
+        kwargs = {} if node.iid is None else {'iid': node.iid}
+        iid = self.treeview.insert(parent, 'end', text=node.text, values=node.values, tags=node.tags, **kwargs)
+        if node.children is not None:
+            self._pending[iid] = node
+            self.treeview.insert(iid, 'end', iid + self._placeholder, text='')
+        return iid
+
+    def expand(self, iid: str) -> None:
+        node = self._pending.pop(iid, None)
+        if node is None:
+            return
+        self.treeview.delete(iid + self._placeholder)
+        for child in node.get_children():
+            self.insert(iid, child)
+
+    def open_all(self, iid: str) -> None:
+        self.expand(iid)
+        self.treeview.item(iid, open=True)
+        for child in self.treeview.get_children(iid):
+            self.open_all(child)
+
+    def clear(self) -> None:
+        self.treeview.delete(*self.treeview.get_children(''))
+        self._pending = {}
+
+    def is_pending(self, iid: str) -> bool:
+        return iid in self._pending
+
+    def nodes(self, iid: str) -> List[TreeNode]:
+        return self._pending[iid].get_children()
+
+    def _on_open(self, event):
+        self.expand(self.treeview.focus())
+
+
+class SearchBar:
+    """ Search entry above a tree: on_change(query) runs as the user types, on_submit(query) on Return. """
+    def __init__(self, parent: ttk.Frame, on_change: Callable[[str], None], on_submit: Callable[[str], None]):
+        self.frame = ttk.Frame(parent)
+        self._query = StringVar(self.frame)
+        self._count = ttk.Label(self.frame)
+
+        entry = ttk.Entry(self.frame, textvariable=self._query)
+        ttk.Label(self.frame, text='Search').grid(column=0, row=0, padx=(0, 5))
+        entry.grid(column=1, row=0, sticky='WE')
+        self._count.grid(column=2, row=0, padx=(5, 0))
+        self.frame.columnconfigure(1, weight=1)
+
+        self._query.trace_add('write', lambda *_: on_change(self._query.get()))
+        entry.bind('<Return>', lambda _: on_submit(self._query.get()))
+
+    def set_count(self, text: str):
+        self._count['text'] = text
+
+
+def filetree_nodes(tree) -> List[TreeNode]:
+    nodes = []
     for k in tree:
         if k == 'root':
             # insert files after directories
             continue
-        new_parent_id = treeview.insert(parent_id, 'end', text=k, values=[count_leaves(tree[k]), ''])
-        build_filetree_view(treeview, new_parent_id, tree[k])
+        nodes.append(TreeNode(k, [count_leaves(tree[k]), ''], children=lambda t=tree[k]: filetree_nodes(t)))
 
     if 'root' in tree:
         for f, text in tree['root']:
-            treeview.insert(parent_id, 'end', text=f, values=['', text])
-
-
-def build_notetree_view(treeview, parent_id, tree: NoteTree) -> Dict[str, int]:
+            nodes.append(TreeNode(f, ['', text]))
+    return nodes
+
+
+def build_filetree_view(lazy_tree: LazyTree, parent_id, tree):
+    for node in filetree_nodes(tree):
+        lazy_tree.insert(parent_id, node)
+
+
+def notetree_nodes(tree: NoteTree, prefix: str) -> List[TreeNode]:
+    def _note_nodes(notes):
+        nodes = []
+        for i, note in notes:
+            if note.is_valid():
+                status_text = 'OK'
+                status_tag = 'valid'
+            else:
+                status_text = note.get_invalid_reason()
+                status_tag = 'invalid'
+            nodes.append(TreeNode(
+                note.relative_path,
+                ['', status_text, note.text[:48] + '...'],
+                tags=['note', status_tag],
+                iid=f'{prefix}{i}'
+            ))
+        return nodes
+
+    nodes = []
+    for deck in tree:
+        tag_nodes = [
+            TreeNode(tag, [count_leaves(tree[deck][tag]), '', ''], children=lambda n=tree[deck][tag]: _note_nodes(n))
+            for tag in tree[deck]
+        ]
+        nodes.append(TreeNode(deck, [count_leaves(tree[deck]), '', ''], children=tag_nodes))
+    return nodes
+
+
+def build_notetree_view(lazy_tree: LazyTree, parent_id, tree: NoteTree, prefix='note') -> Dict[str, int]:
+    """
+    Inserts the decks of tree, tags and notes are inserted when opened.
+    :return: iid -> index of the note, for every note of tree, inserted or not.
+    """
     index_map = {}
     for deck in tree:
-        values = [count_leaves(tree[deck]), '', '']
-        d_id = treeview.insert(parent_id, 'end', text=deck, values=values)
-
         for tag in tree[deck]:
-            values = [count_leaves(tree[deck][tag]), '', '']
-            t_id = treeview.insert(d_id, 'end', text=tag, values=values)
-
-            for i, note in tree[deck][tag]:
-                if note.is_valid():
-                    status_text = 'OK'
-                    status_tag = 'valid'
-                else:
-                    status_text = note.get_invalid_reason()
-                    status_tag = 'invalid'
-
-                iid = treeview.insert(
-                    t_id,
-                    'end',
-                    text=note.relative_path,
-                    values=['', status_text, note.text[:48] + '...'],
-                    tags=['note', status_tag]
-                )
-                index_map[iid] = i
+            for i, _ in tree[deck][tag]:
+                index_map[f'{prefix}{i}'] = i
+
+    for node in notetree_nodes(tree, prefix):
+        lazy_tree.insert(parent_id, node)
     return index_map
 
 
-def open_tree_recursively(tree, event):
+def open_tree_recursively(tree, event, lazy_tree: LazyTree = None):
     def _open_children(parent):
+        if lazy_tree is not None:
+            lazy_tree.expand(parent)
         tree.item(parent, open=True)
         for child in tree.get_children(parent):
             _open_children(child)
@@ -62,15 +177,33 @@ def open_tree_recursively(tree, event):
     _open_children(tree.focus())
 
 
-def get_treeview_selection(treeview: ttk.Treeview, iid_list: tuple, key=lambda x: True, option=None):
+def get_treeview_selection(treeview: ttk.Treeview, iid_list: tuple, key=lambda x: True, option=None,
+                           lazy_tree: LazyTree = None):
+    """
+    iids of the leaves under the selected items accepted by key, items never opened are resolved from their nodes.
+    """
     items = []
     for iid in iid_list:
 
+        if lazy_tree is not None and lazy_tree.is_pending(iid):
+            items.extend(_node_selection(lazy_tree.nodes(iid), key, option))
+            continue
+
         children = treeview.get_children(iid)
         if len(children) > 0:
-            items.extend(get_treeview_selection(treeview, children, key, option))
+            items.extend(get_treeview_selection(treeview, children, key, option, lazy_tree))
 
         elif key(treeview.item(iid, option=option)):
             items.append(iid)
 
     return items
+
+
+def _node_selection(nodes: List[TreeNode], key, option) -> List[str]:
+    items = []
+    for node in nodes:
+        if node.children is not None:
+            items.extend(_node_selection(node.get_children(), key, option))
+        elif node.iid is not None and key(node.option(option)):
+            items.append(node.iid)
+    return items
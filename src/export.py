@@ -0,0 +1,234 @@
+﻿import csv
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import time
+import zipfile
+
+from os import path
+from typing import Dict, Iterable
+
+# focus imports
+import settings
+from anki_handler import AnkiNote, MODEL_NAME, MODEL_FIELDS, _get_templates
+
+COMMIT_EVERY = 1000
+_RE_HTML_TAG = re.compile(r'<[^>]+>')
+
+# legacy collection schema (version 11), still imported by every Anki version
+_SCHEMA = """
+CREATE TABLE col (
+    id integer primary key, crt integer not null, mod integer not null, scm integer not null, ver integer not null,
+    dty integer not null, usn integer not null, ls integer not null, conf text not null, models text not null,
+    decks text not null, dconf text not null, tags text not null
+);
+CREATE TABLE notes (
+    id integer primary key, guid text not null, mid integer not null, mod integer not null, usn integer not null,
+    tags text not null, flds text not null, sfld integer not null, csum integer not null, flags integer not null,
+    data text not null
+);
+CREATE TABLE cards (
+    id integer primary key, nid integer not null, did integer not null, ord integer not null, mod integer not null,
+    usn integer not null, type integer not null, queue integer not null, due integer not null, ivl integer not null,
+    factor integer not null, reps integer not null, lapses integer not null, left integer not null,
+    odue integer not null, odid integer not null, flags integer not null, data text not null
+);
+CREATE TABLE revlog (
+    id integer primary key, cid integer not null, usn integer not null, ease integer not null, ivl integer not null,
+    lastIvl integer not null, factor integer not null, time integer not null, type integer not null
+);
+CREATE TABLE graves (usn integer not null, oid integer not null, type integer not null);
+CREATE INDEX ix_notes_usn on notes (usn);
+CREATE INDEX ix_cards_usn on cards (usn);
+CREATE INDEX ix_revlog_usn on revlog (usn);
+CREATE INDEX ix_cards_nid on cards (nid);
+CREATE INDEX ix_cards_sched on cards (did, queue, due);
+CREATE INDEX ix_revlog_cid on revlog (cid);
+CREATE INDEX ix_notes_csum on notes (csum);
+"""
+
+_DECK_CONF = {
+    'id': 1, 'name': 'Default', 'mod': 0, 'usn': 0, 'maxTaken': 60, 'autoplay': True, 'timer': 0, 'replayq': True,
+    'dyn': False,
+    'new': {'bury': True, 'delays': [1, 10], 'initialFactor': 2500, 'ints': [1, 4, 7], 'order': 1, 'perDay': 20,
+            'separate': True},
+    'lapse': {'delays': [10], 'leechAction': 0, 'leechFails': 8, 'minInt': 1, 'mult': 0},
+    'rev': {'bury': True, 'ease4': 1.3, 'fuzz': 0.05, 'ivlFct': 1, 'maxIvl': 36500, 'minSpace': 1, 'perDay': 100},
+}
+
+
+def note_guid(note: AnkiNote) -> str:
+    # the source ID, so importing the same note again updates it instead of adding a copy
+    if note.source_id is not None:
+        return note.source_id
+    return hashlib.sha1(note.question.encode('utf-8')).hexdigest()[:20]
+
+
+def export_notes(notes: Iterable[AnkiNote], filepath: str) -> int:
+    """
+    Writes notes to an Anki import file, an .apkg package or a tab separated text file depending on the extension.
+    Anki does not need to be running.
+    :return: the number of exported notes.
+    """
+    if filepath.lower().endswith('.apkg'):
+        return export_apkg(notes, filepath)
+    return export_text(notes, filepath)
+
+
+def export_text(notes: Iterable[AnkiNote], filepath: str) -> int:
+    """
+    Tab separated text file with the header lines of the Anki importer, one row per note, written as notes are read.
+    Media is not included, embedded files must be copied to the collection.media folder of the profile under the
+    names of AnkiNote.media.
+    """
+    n_notes = 0
+    with open(filepath, 'w', encoding='utf-8', newline='') as fp:
+        fp.write('#separator:tab\n#html:true\n#notetype column:1\n#deck column:2\n#guid column:3\n')
+        fp.write(f'#tags column:{4 + len(MODEL_FIELDS)}\n')
+
+        writer = csv.writer(fp, delimiter='\t', lineterminator='\n')
+        for note in notes:
+            fields = note.fields()
+            writer.writerow(
+                [MODEL_NAME, note.deck, note_guid(note)]
+                + [fields.get(name, '') for name in MODEL_FIELDS]
+                + [' '.join(note.convert_to_nested_tags())]
+            )
+            n_notes += 1
+    return n_notes
+
+
+def export_apkg(notes: Iterable[AnkiNote], filepath: str) -> int:
+    """
+    Anki package with the Focus model, its templates and styles, the notes and their media.
+    Notes are written to a temporary collection as they are read, only decks and media names are kept in memory.
+    """
+    now = int(time.time())
+    model_id = _stable_id(MODEL_NAME)
+    next_id = now * 1000
+
+    decks: Dict[str, int] = {}
+    media: Dict[str, str] = {}
+
+    tmpdir = tempfile.mkdtemp(dir=path.dirname(path.abspath(filepath)))
+    col_path = path.join(tmpdir, 'collection.anki2')
+    try:
+        db = sqlite3.connect(col_path)
+        db.executescript(_SCHEMA)
+
+        n_notes = 0
+        for note in notes:
+            deck_id = _add_deck(decks, note.deck)
+            media.update(note.media)
+
+            fields = note.fields()
+            flds = [fields.get(name, '') for name in MODEL_FIELDS]
+            sfld = _strip_html(flds[0])
+            csum = int(hashlib.sha1(sfld.encode('utf-8')).hexdigest()[:8], 16)
+            tags = ' '.join(note.convert_to_nested_tags())
+
+            next_id += 1
+            note_id = next_id
+            db.execute(
+                "INSERT INTO notes VALUES (?, ?, ?, ?, -1, ?, ?, ?, ?, 0, '')",
+                (note_id, note_guid(note), model_id, now, f' {tags} ' if tags else '', '\x1f'.join(flds), sfld, csum)
+            )
+            for ordinal in range(len(_get_templates())):
+                next_id += 1
+                db.execute(
+                    "INSERT INTO cards VALUES (?, ?, ?, ?, ?, -1, 0, 0, ?, 0, 0, 0, 0, 0, 0, 0, 0, '')",
+                    (next_id, note_id, deck_id, ordinal, now, n_notes + 1)
+                )
+
+            n_notes += 1
+            if n_notes % COMMIT_EVERY == 0:
+                db.commit()
+
+        db.execute(
+            "INSERT INTO col VALUES (1, ?, ?, ?, 11, 0, 0, 0, ?, ?, ?, ?, '{}')",
+            (
+                now, now * 1000, now * 1000,
+                json.dumps({'nextPos': n_notes + 1, 'curModel': model_id, 'activeDecks': [1], 'curDeck': 1}),
+                json.dumps({str(model_id): _model_json(model_id, now)}),
+                json.dumps(_decks_json(decks, now)),
+                json.dumps({'1': _DECK_CONF})
+            )
+        )
+        db.commit()
+        db.close()
+
+        # zip members: the collection, then the media files named 0, 1, ... and the map of those names
+        with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED) as apkg:
+            apkg.write(col_path, 'collection.anki2')
+            media_map = {}
+            for i, (name, media_path) in enumerate(media.items()):
+                apkg.write(media_path, str(i))
+                media_map[str(i)] = name
+            apkg.writestr('media', json.dumps(media_map))
+    finally:
+        if path.isfile(col_path):
+            os.remove(col_path)
+        os.rmdir(tmpdir)
+
+    return n_notes
+
+
+def _stable_id(name: str) -> int:
+    # same ID for the same name on every export, below 2**53 like Anki's millisecond IDs
+    return int(hashlib.sha1(name.encode('utf-8')).hexdigest()[:12], 16)
+
+
+def _strip_html(text: str) -> str:
+    return _RE_HTML_TAG.sub('', text)
+
+
+def _add_deck(decks: Dict[str, int], name: str) -> int:
+    # parent decks are created as well, "a::b" also needs "a"
+    parts = name.split('::')
+    for i in range(1, len(parts) + 1):
+        parent = '::'.join(parts[:i])
+        if parent not in decks:
+            decks[parent] = _stable_id('deck:' + parent)
+    return decks[name]
+
+
+def _decks_json(decks: Dict[str, int], now: int) -> dict:
+    out = {}
+    for name, deck_id in [('Default', 1)] + list(decks.items()):
+        out[str(deck_id)] = {
+            'id': deck_id, 'name': name, 'mod': now, 'usn': -1, 'desc': '', 'dyn': 0, 'conf': 1, 'collapsed': False,
+            'extendNew': 10, 'extendRev': 50,
+            'newToday': [0, 0], 'revToday': [0, 0], 'lrnToday': [0, 0], 'timeToday': [0, 0],
+        }
+    return out
+
+
+def _model_json(model_id: int, now: int) -> dict:
+    templates = _get_templates()
+    return {
+        'id': model_id,
+        'name': MODEL_NAME,
+        'type': 0,
+        'mod': now,
+        'usn': -1,
+        'sortf': 0,
+        'did': 1,
+        'tmpls': [
+            {'name': name, 'ord': i, 'qfmt': t['Front'], 'afmt': t['Back'], 'did': None, 'bqfmt': '', 'bafmt': ''}
+            for i, (name, t) in enumerate(templates.items())
+        ],
+        'flds': [
+            {'name': name, 'ord': i, 'sticky': False, 'rtl': False, 'font': 'Arial', 'size': 20, 'media': []}
+            for i, name in enumerate(MODEL_FIELDS)
+        ],
+        'css': settings.STYLES.to_string(),
+        'latexPre': '\\documentclass[12pt]{article}\n\\special{papersize=3in,5in}\n\\usepackage{amssymb,amsmath}\n'
+                    '\\pagestyle{empty}\n\\setlength{\\parindent}{0in}\n\\begin{document}\n',
+        'latexPost': '\\end{document}',
+        'tags': [],
+        'vers': [],
+        'req': [[i, 'any', [0]] for i in range(len(templates))],
+    }
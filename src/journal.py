@@ -0,0 +1,164 @@
+﻿import json
+import os
+import time
+
+from os import path
+from typing import Dict, List, Tuple
+
+# focus imports
+import settings
+from anki_handler import AnkiNote
+from sources import SourceMap, field_hash
+
+JOURNAL_NAME = 'sync_journal.jsonl'
+# the journal is rewritten with the last sync of each profile only once it grows past this size
+COMPACT_BYTES = 8 * 1024 * 1024
+
+ADD = 'add'
+UPDATE = 'update'
+
+
+class SyncJournal:
+    """
+    Append-only record of the pushes of every profile under OUTPUT_DIR, one JSON object per line, each line on disk
+    before the call returns. begin() writes the notes a sync is about to push, done() the notes of each pushed chunk
+    with their note ID, end() closes the sync and revert() records the notes deleted by a revert.
+    A sync may push the notes of several vaults, extend() adds the notes of the next one to its plan.
+    A sync without its end line was interrupted: recover() links the notes it pushed in the source map, so the next
+    sync skips them instead of adding them again, and last_sync() still has them after a restart for --revert-last.
+    """
+    def __init__(self, filepath: str, profile: str):
+        self.filepath = filepath
+        self.profile = profile
+        self._sync_id: str | None = None
+
+    @classmethod
+    def open(cls) -> 'SyncJournal':
+        return cls(path.join(settings.OUTPUT_DIR, JOURNAL_NAME), settings.PROFILE)
+
+    def begin(self, notes: List[AnkiNote] = ()) -> str:
+        if path.isfile(self.filepath) and os.path.getsize(self.filepath) > COMPACT_BYTES:
+            self._compact()
+
+        self._sync_id = f'{time.time_ns():x}'
+        self._write({'op': 'begin', 'time': time.time(), 'plan': _plan(notes)})
+        return self._sync_id
+
+    def extend(self, notes: List[AnkiNote]) -> None:
+        # more notes about to be pushed by the same sync, like the next vault of a profile
+        self._write({'op': 'plan', 'plan': _plan(notes)})
+
+    def done(self, notes: List[AnkiNote], indices: List[int], note_ids: List[int | None]) -> None:
+        # checkpoint after each chunk, as passed by anki_handler.push_notes
+        items = [
+            [notes[i].source_id, UPDATE if notes[i].duplicate_id is not None else ADD, note_id, field_hash(notes[i])]
+            for i, note_id in zip(indices, note_ids) if note_id is not None
+        ]
+        if len(items) > 0:
+            self._write({'op': 'done', 'items': items})
+
+    def end(self) -> None:
+        self._write({'op': 'end'})
+        self._sync_id = None
+
+    def revert(self, sync_id: str, note_ids: List[int]) -> None:
+        self._write({'op': 'revert', 'notes': note_ids}, sync_id)
+
+    def recover(self, source_map: SourceMap) -> int:
+        """
+        Records in source_map the notes pushed by the interrupted syncs of the profile, then closes those syncs.
+        :return: the number of notes recovered.
+        """
+        n_notes = 0
+        for sync_id, sync in self._syncs().items():
+            if sync['closed']:
+                continue
+            for source_id, _, note_id, digest in sync['done']:
+                if source_id is not None:
+                    source_map.link(source_id, note_id, digest)
+                    n_notes += 1
+            source_map.save()
+            self._write({'op': 'recovered'}, sync_id)
+        if n_notes > 0:
+            print(f'\t{n_notes} notes of an interrupted sync recovered from the journal')
+        return n_notes
+
+    def last_sync(self) -> Tuple[str, List[Tuple[str, int]]] | None:
+        """
+        :return: ID of the last sync of the profile that pushed notes and was not reverted, with the (action, note ID)
+        it pushed.
+        """
+        syncs = [(sync_id, s) for sync_id, s in self._syncs().items() if not s['reverted'] and len(s['done']) > 0]
+        if len(syncs) == 0:
+            return None
+        sync_id, sync = syncs[-1]
+        return sync_id, [(action, note_id) for _, action, note_id, _ in sync['done']]
+
+    def _syncs(self) -> Dict[str, dict]:
+        # sync ID -> {'done': [[source ID, action, note ID, field hash]], 'closed', 'reverted'}, oldest first
+        syncs = {}
+        for record in self._read():
+            if record.get('profile') != self.profile:
+                continue
+            sync_id, op = record['sync'], record['op']
+            if op == 'begin':
+                syncs[sync_id] = {'done': [], 'closed': False, 'reverted': False}
+            elif sync_id not in syncs:
+                continue
+            elif op == 'done':
+                syncs[sync_id]['done'].extend(record['items'])
+            elif op in ('end', 'recovered'):
+                syncs[sync_id]['closed'] = True
+            elif op == 'revert':
+                syncs[sync_id]['closed'] = True
+                syncs[sync_id]['reverted'] = True
+        return syncs
+
+    def _read(self) -> List[dict]:
+        if not path.isfile(self.filepath):
+            return []
+        records = []
+        with open(self.filepath, 'r', encoding='utf-8') as fp:
+            for line in fp:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # the last line of a process killed while writing it
+                    print(f'WARNING: skipping a truncated line of {self.filepath}')
+        return records
+
+    def _write(self, record: dict, sync_id: str = None) -> None:
+        record = {'sync': sync_id if sync_id is not None else self._sync_id, 'profile': self.profile, **record}
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        with open(self.filepath, 'a+b') as fp:
+            if fp.tell() > 0:
+                fp.seek(-1, os.SEEK_END)
+                if fp.read(1) != b'\n':
+                    # after a truncated line, which must not swallow this one
+                    line = b'\n' + line
+            fp.write(line)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def _compact(self) -> None:
+        # keeps every line of the last sync of each profile and of its last sync that pushed notes, so that one can
+        # still be reverted and an interrupted one recovered
+        records = self._read()
+        last, last_pushed = {}, {}
+        for record in records:
+            if record['op'] == 'begin':
+                last[record['profile']] = record['sync']
+            elif record['op'] == 'done':
+                last_pushed[record['profile']] = record['sync']
+        keep = set(last.values()) | set(last_pushed.values())
+
+        tmp = self.filepath + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            for record in records:
+                if record['sync'] in keep:
+                    fp.write(json.dumps(record) + '\n')
+        os.replace(tmp, self.filepath)
+
+
+def _plan(notes: List[AnkiNote]) -> List[list]:
+    return [[n.source_id, UPDATE if n.duplicate_id is not None else ADD, n.duplicate_id] for n in notes]
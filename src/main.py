@@ -1,22 +1,76 @@
-﻿
+﻿import argparse
+
 from os import path
 
 import settings
-from crawler import VaultCrawler
-from display import mainloop
+from crawler import VaultCrawler, link_index_path
+from progress import ConsoleProgress
 
 
 def _main():
+    parser = argparse.ArgumentParser(description='Sync the Anki cards of an Obsidian vault')
+    parser.add_argument(
+        '--export', metavar='FILE', default=None,
+        help='write the notes to an Anki import file (.apkg or tab separated .txt) instead, Anki is not needed'
+    )
+    parser.add_argument(
+        '--sync', action='store_true',
+        help='sync every vault of VAULTS to its profile without the wizard, only new and changed notes are pushed'
+    )
+    parser.add_argument('--workers', type=int, default=None, help='processes preparing the vaults for --sync')
+    parser.add_argument(
+        '--files', nargs='+', metavar='FILE', default=None,
+        help='sync the notes of these files only, without the wizard and without reading the whole vault'
+    )
+    parser.add_argument(
+        '--revert-last', action='store_true',
+        help='delete the notes added by the last sync of PROFILE, from the sync journal, even after a restart'
+    )
+    args = parser.parse_args()
+
     # ../../settings.txt
     root = path.dirname((path.dirname(path.abspath(__file__))))
     filepath = path.join(root, 'settings.txt')
 
     settings.update_with_user_settings(filepath)
 
-    crawler = VaultCrawler(settings.VAULT)
+    if args.revert_last:
+        import sync
+        sync.revert_last(settings.PROFILE)
+        return
+
+    if args.files is not None:
+        import sync
+        sync.print_report(sync.sync_files(args.files, settings.VAULTS))
+        return
+
+    if args.sync:
+        import sync
+        sync.print_report(sync.sync_all(settings.VAULTS, filepath, args.workers))
+        return
+
+    # every crawl saves the links of the vault for --files
+    index_path = link_index_path(settings.OUTPUT_DIR, settings.VAULT)
+    if args.export is not None:
+        progress = ConsoleProgress()
+        _export(VaultCrawler(settings.VAULT, progress, index_path=index_path), args.export, progress)
+        return
+
+    # tkinter and the wizard are only imported here, the vault is read once the window is shown
+    crawler = VaultCrawler(settings.VAULT, crawl=False, index_path=index_path)
+
+    from display import mainloop
     mainloop(crawler)
 
 
+def _export(crawler: VaultCrawler, filepath: str, progress: ConsoleProgress):
+    import export
+    import printer
+
+    crawler.convert_files(progress)
+    n_notes = export.export_notes(printer.render_notes(crawler.valid_notes, progress), filepath)
+    print(f'Exported {n_notes} notes to {filepath}, {len(crawler.invalid_notes)} invalid notes skipped')
+
 
 if __name__ == '__main__':
     _main()
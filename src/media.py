@@ -0,0 +1,135 @@
+﻿import base64
+import hashlib
+import json
+import os
+
+from os import path
+from typing import Dict, Iterable, List, Tuple
+
+# focus imports
+import settings
+import anki_handler
+from anki_handler import AnkiNote
+from progress import Progress, ensure
+
+MANIFEST_NAME = 'media_manifest.json'
+BATCH_SIZE = 8
+
+
+class MediaManifest:
+    """
+    Content hashes of the vault media and of the media already stored in each Anki profile.
+    A file is only hashed again when its size or modification time change, and only read in full when its hash
+    differs from the one stored in the profile.
+    """
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+
+        # absolute path -> [mtime_ns, size, sha256]
+        self._files: Dict[str, List] = {}
+        # profile -> {file name in Anki -> sha256}
+        self._stored: Dict[str, Dict[str, str]] = {}
+
+        if path.isfile(filepath):
+            with open(filepath, 'r', encoding='utf-8') as fp:
+                data = json.load(fp)
+            self._files = data['files']
+            self._stored = data['stored']
+
+    def digest(self, filepath: str) -> str:
+        stat = os.stat(filepath)
+        cached = self._files.get(filepath)
+        if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+
+        sha = hashlib.sha256()
+        with open(filepath, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 16), b''):
+                sha.update(chunk)
+
+        digest = sha.hexdigest()
+        self._files[filepath] = [stat.st_mtime_ns, stat.st_size, digest]
+        return digest
+
+    def is_stored(self, profile: str, name: str, digest: str) -> bool:
+        return self._stored.get(profile, {}).get(name) == digest
+
+    def set_stored(self, profile: str, name: str, digest: str) -> None:
+        if profile not in self._stored:
+            self._stored[profile] = {}
+        self._stored[profile][name] = digest
+
+    def forget(self, profile: str, names: Iterable[str]) -> None:
+        stored = self._stored.get(profile, {})
+        for name in names:
+            stored.pop(name, None)
+
+    def save(self) -> None:
+        tmp = self.filepath + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            json.dump({'files': self._files, 'stored': self._stored}, fp)
+        os.replace(tmp, self.filepath)
+
+
+def load_manifest() -> MediaManifest:
+    return MediaManifest(path.join(settings.OUTPUT_DIR, MANIFEST_NAME))
+
+
+def store_media(notes: Iterable[AnkiNote], batch_size=BATCH_SIZE, progress: Progress = None) -> Dict[str, str]:
+    """
+    Uploads the media embedded in notes that is not yet in the collection, in batches of storeMediaFile actions.
+    When progress is cancelled the remaining batches are not sent, the files already stored are kept in the manifest.
+    :return: file name -> error, for every file that could not be stored.
+    """
+    files = {}
+    for note in notes:
+        files.update(note.media)
+    if len(files) == 0:
+        return {}
+
+    manifest = load_manifest()
+    _forget_deleted(manifest, files)
+
+    pending: List[Tuple[str, str, str]] = []
+    for name, filepath in files.items():
+        digest = manifest.digest(filepath)
+        if not manifest.is_stored(settings.PROFILE, name, digest):
+            pending.append((name, filepath, digest))
+
+    print(f'Storing media: {len(pending)}/{len(files)} files changed')
+    progress = ensure(progress)
+    progress.start('storing media', len(pending))
+
+    errors = {}
+    for i in range(0, len(pending), batch_size):
+        if progress.is_cancelled():
+            break
+        batch = pending[i:i + batch_size]
+
+        data = []
+        for name, filepath, _ in batch:
+            with open(filepath, 'rb') as fp:
+                data.append((name, base64.b64encode(fp.read()).decode('ascii')))
+
+        for (name, _, digest), error in zip(batch, anki_handler.store_media_files(data)):
+            if error is None:
+                manifest.set_stored(settings.PROFILE, name, digest)
+            else:
+                errors[name] = error
+
+        manifest.save()  # keep the progress of every batch
+        progress.advance(len(batch))
+
+    if len(pending) == 0:
+        manifest.save()  # new hashes may have been cached
+    return errors
+
+
+def _forget_deleted(manifest: MediaManifest, files: Dict[str, str]) -> None:
+    # files deleted in Anki (Check Media, another device) are uploaded again, one getMediaFilesNames for the profile
+    stored = [name for name, filepath in files.items()
+              if manifest.is_stored(settings.PROFILE, name, manifest.digest(filepath))]
+    if len(stored) == 0:
+        return
+    in_anki = set(anki_handler.invoke('getMediaFilesNames', pattern='*'))
+    manifest.forget(settings.PROFILE, [name for name in stored if name not in in_anki])
@@ -0,0 +1,193 @@
+﻿import html
+import math
+import re
+import sqlite3
+import time
+
+from os import path
+from typing import List, Set, Dict
+
+# focus imports
+import settings
+import anki_handler
+from anki_handler import AnkiNote, MODEL_NAME
+from similarity import CandidateIndex
+
+MIRROR_NAME = 'mirror.sqlite3'
+NOTES_INFO_CHUNK = 500
+DUPLICATE_STATUS = 'cannot create note because it is a duplicate'
+
+_RE_HTML_TAG = re.compile(r'<[^>]+>')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS notes (
+    profile TEXT NOT NULL,
+    note_id INTEGER NOT NULL,
+    deck TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    question TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    question_key TEXT NOT NULL,
+    mod INTEGER NOT NULL,
+    PRIMARY KEY (profile, note_id)
+);
+CREATE INDEX IF NOT EXISTS notes_question_key ON notes (profile, question_key);
+CREATE TABLE IF NOT EXISTS meta (
+    profile TEXT PRIMARY KEY,
+    synced_at REAL NOT NULL
+);
+"""
+
+
+def _question_key(question: str) -> str:
+    # Anki compares the first field without its HTML when looking for duplicates
+    return html.unescape(_RE_HTML_TAG.sub('', question)).strip()
+
+
+def _in_deck(note_deck: str, deck: str) -> bool:
+    # "deck:X" also matches the subdecks of X
+    note_deck, deck = note_deck.lower(), deck.lower()
+    return note_deck == deck or note_deck.startswith(deck + '::')
+
+
+def _has_tag(note_tags: List[str], tag: str) -> bool:
+    # "tag:X" also matches the child tags of X
+    tag = tag.lower()
+    return any(t == tag or t.startswith(tag + '::') for t in (nt.lower() for nt in note_tags))
+
+
+class AnkiMirror:
+    """
+    Local SQLite copy of the notes of the Focus model: ID, deck, tags, Question, Answer and modification time.
+    refresh() only fetches the notes edited since the previous refresh, plus the ones the mirror has never seen.
+    """
+    def __init__(self, filepath: str, profile: str):
+        self.profile = profile
+        self._db = sqlite3.connect(filepath)
+        self._db.executescript(_SCHEMA)
+        # notes added or modified by the last refresh
+        self.changed: Set[int] = set()
+
+    @classmethod
+    def open(cls) -> 'AnkiMirror':
+        return cls(path.join(settings.OUTPUT_DIR, MIRROR_NAME), settings.PROFILE)
+
+    def close(self):
+        self._db.close()
+
+    def refresh(self) -> Set[int]:
+        now = time.time()
+        model_query = f'"note:{MODEL_NAME}"'
+
+        all_ids = set(anki_handler.invoke('findNotes', query=model_query))
+        known = {row[0] for row in self._db.execute('SELECT note_id FROM notes WHERE profile = ?', (self.profile,))}
+
+        row = self._db.execute('SELECT synced_at FROM meta WHERE profile = ?', (self.profile,)).fetchone()
+        if row is None:
+            candidates = all_ids
+        else:
+            days = max(1, math.ceil((now - row[0]) / 86400))
+            candidates = set(anki_handler.invoke('findNotes', query=f'{model_query} edited:{days}'))
+            candidates |= all_ids - known
+
+        deleted = known - all_ids
+        self._db.executemany(
+            'DELETE FROM notes WHERE profile = ? AND note_id = ?',
+            [(self.profile, i) for i in deleted]
+        )
+
+        stored_mod = dict(self._db.execute('SELECT note_id, mod FROM notes WHERE profile = ?', (self.profile,)))
+
+        self.changed = set()
+        candidates = sorted(candidates)
+        for k in range(0, len(candidates), NOTES_INFO_CHUNK):
+            infos = anki_handler.invoke('notesInfo', notes=candidates[k:k + NOTES_INFO_CHUNK])
+            infos = [res for res in infos if res and stored_mod.get(res['noteId']) != res.get('mod', 0)]
+            if len(infos) == 0:
+                continue
+
+            decks = self._fetch_decks(infos)
+            self._db.executemany(
+                'INSERT OR REPLACE INTO notes VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (
+                        self.profile, res['noteId'], decks.get(res['noteId'], ''), ' '.join(res['tags']),
+                        res['fields']['Question']['value'], res['fields']['Answer']['value'],
+                        _question_key(res['fields']['Question']['value']), res.get('mod', 0)
+                    )
+                    for res in infos
+                ]
+            )
+            self.changed.update(res['noteId'] for res in infos)
+
+        self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (self.profile, now))
+        self._db.commit()
+
+        print(f'Mirror refreshed: {len(self.changed)} changed, {len(deleted)} deleted, {len(all_ids)} notes')
+        return self.changed
+
+    def check_notes(self, notes: List[AnkiNote]) -> List[AnkiNote]:
+        """
+        Sets the status, ratios and duplicate_id of notes from the mirror, as canAddNotesWithErrorDetail and
+        calculate_ratio would.
+        :return: the notes whose result depends on a note changed by the last refresh, to be verified with AnkiConnect.
+        """
+        verify = []
+        snapshots: Dict[str, CandidateIndex] = {}
+        for note in notes:
+            key = _question_key(note.question)
+            if key == '':
+                verify.append(note)  # let Anki report why it cannot be added
+                continue
+
+            same_first_field = [row[0] for row in self._db.execute(
+                'SELECT note_id FROM notes WHERE profile = ? AND question_key = ?', (self.profile, key)
+            )]
+            if len(same_first_field) == 0:
+                note.status = 'can_add'
+                continue
+
+            note.status = DUPLICATE_STATUS
+
+            query = anki_handler.find_notes_query(note.deck, note.convert_to_nested_tags())
+            if query not in snapshots:
+                snapshots[query] = CandidateIndex(self._find_candidates(note.deck, note.convert_to_nested_tags()))
+            candidates = snapshots[query]
+
+            if len(candidates) != 1:
+                note.set_ratio(candidates)
+
+            related = set(same_first_field) | set(candidates.note_ids())
+            if not related.isdisjoint(self.changed):
+                verify.append(note)
+
+        return verify
+
+    def _find_candidates(self, deck: str, tags: List[str]) -> List[dict]:
+        # same notes as find_notes(deck, tags), in notesInfo format
+        rows = self._db.execute(
+            'SELECT note_id, deck, tags, question, answer FROM notes WHERE profile = ? ORDER BY note_id',
+            (self.profile,)
+        )
+
+        candidates = []
+        for note_id, note_deck, note_tags, question, answer in rows:
+            note_tags = note_tags.split()
+            if _in_deck(note_deck, deck) and all(_has_tag(note_tags, t) for t in tags):
+                candidates.append({
+                    'noteId': note_id,
+                    'fields': {'Question': {'value': question}, 'Answer': {'value': answer}}
+                })
+        return candidates
+
+    def _fetch_decks(self, infos: List[dict]) -> Dict[int, str]:
+        # notesInfo has no deck, use the deck of the first card of each note
+        card_to_note = {res['cards'][0]: res['noteId'] for res in infos if res.get('cards')}
+        if len(card_to_note) == 0:
+            return {}
+
+        decks = {}
+        for deck, cards in anki_handler.invoke('getDecks', cards=list(card_to_note)).items():
+            for card in cards:
+                decks[card_to_note[card]] = deck
+        return decks
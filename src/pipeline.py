@@ -0,0 +1,116 @@
+﻿import queue
+import threading
+
+from typing import Generic, Iterable, Iterator, List, TypeVar
+
+T = TypeVar('T')
+
+QUEUE_SIZE = 256
+PUT_TIMEOUT = 0.1
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class Stage(Generic[T]):
+    """
+    A stage of a pipeline: items is iterated on a worker thread while the caller consumes what it already produced.
+    The queue between them holds at most maxsize items, the worker waits while it is full so a slow consumer is never
+    buried in work (backpressure). An exception of the worker is raised in the caller, close() stops the worker at
+    its next item.
+    Stages doing Python work share the GIL, the overlap comes from the ones waiting on files or AnkiConnect.
+    """
+    def __init__(self, items: Iterable[T], maxsize=QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize)
+        self._stop = threading.Event()
+        self._done = False
+
+        # the worker only holds the queue and the event, so an abandoned stage is collected and stops it
+        self._worker = threading.Thread(target=_produce, args=(items, self._queue, self._stop), daemon=True)
+        self._worker.start()
+
+    def __iter__(self) -> Iterator[T]:
+        return self
+
+    def __next__(self) -> T:
+        if self._done:
+            raise StopIteration
+        return self._unwrap(self._queue.get())
+
+    def ready(self, max_size: int) -> List[T]:
+        """
+        Waits for the next item and returns it with the ones already queued behind it, up to max_size.
+        A consumer sending batches gets small ones while the producer is slow and large ones while it is slow itself.
+        :return: an empty list once every item was consumed.
+        """
+        batch = []
+        try:
+            batch.append(next(self))
+            while len(batch) < max_size:
+                batch.append(self._unwrap(self._queue.get_nowait()))
+        except (StopIteration, queue.Empty):
+            pass
+        return batch
+
+    def close(self) -> None:
+        self._stop.set()
+
+    def __del__(self):
+        self._stop.set()
+
+    def _unwrap(self, item):
+        if item is _DONE or isinstance(item, _Failure):
+            self._done = True
+            self._worker.join()
+            if item is _DONE:
+                raise StopIteration
+            raise item.error
+        return item
+
+
+def _produce(items: Iterable, items_queue: queue.Queue, stop: threading.Event):
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items_queue.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        for item in items:
+            if not put(item):
+                return
+    except BaseException as ex:
+        put(_Failure(ex))
+        return
+    put(_DONE)
+
+
+def threaded(items: Iterable[T], maxsize=QUEUE_SIZE) -> Stage[T]:
+    return Stage(items, maxsize)
+
+
+def chunked(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    """
+    Lists of at most size items. From a Stage, each list holds what was ready when it was asked for, so the consumer
+    never waits for a full chunk; from anything else the lists have size items, the last one may be shorter.
+    """
+    if isinstance(items, Stage):
+        while batch := items.ready(size):
+            yield batch
+        return
+
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
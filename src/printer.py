@@ -1,15 +1,15 @@
 ﻿import re
-import webbrowser
-import markdown
 
 from html import escape
 from os import path
-from typing import Tuple, List
+from typing import Dict, Tuple, List, Iterable, Iterator, Sized
 
 # focus imports
 import settings
 from crawler import ObsidianNote
+from crawler.utils import RE_MEDIA_EMBED
 from anki_handler import AnkiNote
+from progress import Progress, ensure
 
 
 _RE_CALLOUT = re.compile(r'<blockquote>\s*<p>\[!(\w+)] *(.*)([\s\S]*)</p>\s*</blockquote>')
@@ -42,6 +42,12 @@ def webpreview(notes: List[ObsidianNote]):
     with open(filepath, 'w', encoding='utf-8') as fp:
         fp.write(buf)
 
+    _open_in_browser(filepath)
+
+
+def _open_in_browser(filepath: str):
+    # webbrowser and markdown are imported on first use, they are the slowest imports of the startup
+    import webbrowser
     webbrowser.open('file:///' + filepath)
 
 
@@ -67,23 +73,36 @@ def webpreview_textual(notes: List[AnkiNote]):
     with open(filepath, 'w', encoding='utf-8') as fp:
         fp.write(buf)
 
-    webbrowser.open('file:///' + filepath)
+    _open_in_browser(filepath)
 
 
-def note_to_html(fields: List[Tuple[str, str]], web=False):
+def note_to_html(fields: List[Tuple[str, str]], web=False, media_names: Dict[str, str] = None):
+    # media_names: embed -> file name in Anki, see ObsidianNote.media_names
     front, back = '', ''
     if len(fields) == 1:
         q, ans = fields[0]
-        front = text_to_html(q, web=web)
-        back = text_to_html(ans, web=web)
+        front = text_to_html(q, web=web, media_names=media_names)
+        back = text_to_html(ans, web=web, media_names=media_names)
     else:
         for i, (q, ans) in enumerate(fields):
-            front += f'<h1>Q{i+1}</h1>' + text_to_html(q, True, web)
-            back += f'<h1>R{i+1}</h1>' + text_to_html(ans, True, web)
+            front += f'<h1>Q{i+1}</h1>' + text_to_html(q, True, web, media_names)
+            back += f'<h1>R{i+1}</h1>' + text_to_html(ans, True, web, media_names)
     return front, back
 
 
-def text_to_html(text, lower_headings=False, web=False):
+def render_notes(notes: Iterable[ObsidianNote], progress: Progress = None) -> Iterator[AnkiNote]:
+    # AnkiNote of each note, rendered one at a time, notes may be a stage of a pipeline still producing them
+    progress = ensure(progress)
+    progress.start('rendering notes', len(notes) if isinstance(notes, Sized) else None)
+    for md_note in notes:
+        progress.check()
+        front, back = note_to_html(list(md_note.get_fields()), media_names=md_note.media_names)
+        yield AnkiNote(md_note.deck, front, back, md_note.tags, md_note.media, md_note.source_id())
+        progress.advance()
+
+
+def text_to_html(text, lower_headings=False, web=False, media_names: Dict[str, str] = None):
+    text = _replace_media_embed(text, media_names)
     text = _replace_link(text)
     text = _replace_strikethrough(text)
     text = _RE_TAGS.sub('', text)  # remove tags
@@ -94,6 +113,7 @@ def text_to_html(text, lower_headings=False, web=False):
     text = _safe_lists(text)
     text = _replace_highlight(text)
     text = _replace_anki_mathjax(text)
+    import markdown
     text = markdown.markdown(text, extensions=['tables', 'sane_lists'])
     text = _replace_callout(text)
     if web:
@@ -218,6 +238,22 @@ def _replace_highlight(text):
     return _RE_HIGHLIGHT.sub(repl, text)
 
 
+def _replace_media_embed(text, media_names: Dict[str, str] = None):
+    # media is stored in Anki under the name given by the crawler (crawler.media_name), see media.store_media;
+    # embeds without one keep their file name
+    media_names = media_names if media_names is not None else {}
+
+    def repl(m):
+        buffer = f'<img src="{media_names.get(m.group(1), path.basename(m.group(1)))}"'
+        if m.group(2):
+            buffer += f' width="{m.group(2)}"'
+        if m.group(3):
+            buffer += f' height="{m.group(3)}"'
+        return buffer + '>'
+
+    return RE_MEDIA_EMBED.sub(repl, text)
+
+
 def _replace_link(text):
     def repl(m):
         link = m.group(1)
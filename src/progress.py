@@ -0,0 +1,80 @@
+﻿import threading
+import time
+
+from typing import Callable
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Progress:
+    """
+    Progress of a long operation, shared between the thread doing the work and the one watching it.
+    The work calls start() for each stage and advance() after each unit, and check() between units to stop with
+    Cancelled once cancel() was called. Operations that must keep what they already did (adding notes) test
+    is_cancelled() instead and return early.
+    :param callback: called with this object on every start() and advance(), from the working thread.
+    """
+    def __init__(self, callback: Callable[['Progress'], None] = None):
+        self.stage = ''
+        self.done = 0
+        self.total: int | None = None
+
+        self._callback = callback
+        self._cancelled = threading.Event()
+        self._started = time.perf_counter()
+
+    def start(self, stage: str, total: int = None) -> None:
+        self.stage = stage
+        self.done = 0
+        self.total = total
+        self._started = time.perf_counter()
+        if self._callback is not None:
+            self._callback(self)
+
+    def advance(self, n=1) -> None:
+        self.done += n
+        if self._callback is not None:
+            self._callback(self)
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def check(self) -> None:
+        if self._cancelled.is_set():
+            raise Cancelled(f'cancelled during {self.stage} after {self.done} items')
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._started
+
+    def rate(self) -> float:
+        # units per second in the current stage
+        elapsed = self.elapsed()
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        count = f'{self.done}/{self.total}' if self.total is not None else f'{self.done}'
+        return f'{self.stage} {count} ({self.rate():.1f}/s)'
+
+
+class ConsoleProgress(Progress):
+    """ Prints the progress at most once every interval seconds, for the headless mode. """
+    def __init__(self, interval=1.0):
+        super().__init__(self._print)
+        self.interval = interval
+        self._printed = 0.0
+
+    def _print(self, progress: Progress):
+        now = time.perf_counter()
+        if now - self._printed >= self.interval or progress.done == progress.total:
+            self._printed = now
+            print(f'\t{progress}')
+
+
+def ensure(progress: Progress | None) -> Progress:
+    # functions take progress=None, this gives them an object nobody watches or cancels
+    return progress if progress is not None else Progress()
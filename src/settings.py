@@ -3,7 +3,7 @@ import os
 
 from pathlib import Path
 from os import path
-from typing import Iterable, Tuple
+from typing import Iterable, List, Tuple
 
 _DEFAULTS = path.join(path.dirname(__file__), '_defaults')
 _DEFAULT_OUTPUT_DIR = path.join(_DEFAULTS, 'out')
@@ -18,14 +18,33 @@ class Styles:
     _callout_types = ('info', 'note', 'warning', 'error', 'danger')
 
     def __init__(self, default_styles):
-        with open(default_styles, 'r', encoding='utf-8') as fp:
+        self._default_styles = default_styles
+        self._required: dict | None = None
+        self._css: dict | None = None
+
+    def _load(self) -> None:
+        # the defaults are read on first use, so importing settings does not touch the disk
+        if self._required is not None:
+            return
+
+        with open(self._default_styles, 'r', encoding='utf-8') as fp:
             data = fp.read()
 
-        self._required_styles = {}
+        self._required = {}
         for css in self._css_pattern.finditer(data):
-            self._required_styles[css['name']] = css['body'].strip()
+            self._required[css['name']] = css['body'].strip()
+
+        self._css = self._required
+
+    @property
+    def _required_styles(self) -> dict:
+        self._load()
+        return self._required
 
-        self.css_data = self._required_styles
+    @property
+    def css_data(self) -> dict:
+        self._load()
+        return self._css
 
     def add_user_styles(self, user_styles):
         with open(user_styles, 'r', encoding='utf-8') as fp:
@@ -81,7 +100,11 @@ class Styles:
 
 VAULT = None
 PROFILE = None
+# (vault, profile) of every vault synced by --sync, [(VAULT, PROFILE)] when settings.txt has no VAULTS
+VAULTS: List[Tuple[str, str]] = []
 OUTPUT_DIR = _DEFAULT_OUTPUT_DIR
+BULK_INSERT = True
+MIRROR = False
 STYLES = Styles(_DEFAULT_STYLES)
 
 
@@ -94,34 +117,63 @@ def update_with_user_settings(filepath) -> None:
 
     data = re.sub(r'#.*', '', data)
 
+    _update_vaults(data)
     _update_vault(data)
     _update_profile(data)
+    if len(VAULTS) == 0:
+        VAULTS.append((VAULT, PROFILE))
     _update_output_dir(data)
     _update_styles(data)
+    _update_bulk_insert(data)
+    _update_mirror(data)
 
 
 def _update_vault(data: str):
+    global VAULT
     dirpath = re.search('VAULT=(.*)', data)
+    if dirpath is None and len(VAULTS) > 0:
+        # the wizard opens the first vault of the list
+        VAULT = VAULTS[0][0]
+        return
     if dirpath is None:
-        raise ValueError('"VAULT" must be specified in settings.txt')
+        raise ValueError('"VAULT" or "VAULTS" must be specified in settings.txt')
 
     dirpath = Path(dirpath.group(1)).expanduser()
     if not dirpath.is_dir():
         raise NotADirectoryError(dirpath)
 
-    global VAULT
     VAULT = path.normcase(dirpath)
 
 
 def _update_profile(data):
+    global PROFILE
     profile = re.search('PROFILE=(.*)', data)
+    if profile is None and len(VAULTS) > 0:
+        PROFILE = VAULTS[0][1]
+        return
     if profile is None:
-        raise ValueError('"PROFILE" must be specified in settings.txt')
+        raise ValueError('"PROFILE" or "VAULTS" must be specified in settings.txt')
 
-    global PROFILE
     PROFILE = profile.group(1)
 
 
+def _update_vaults(data: str):
+    # one line per vault: VAULTS=<vault> -> <profile>
+    vaults = []
+    for line in re.findall('VAULTS=(.*)', data):
+        dirpath, sep, profile = line.rpartition('->')
+        if not sep or not dirpath.strip() or not profile.strip():
+            raise ValueError(f'"VAULTS" must be given as <vault> -> <profile>, got {line}')
+
+        dirpath = Path(dirpath.strip()).expanduser()
+        if not dirpath.is_dir():
+            raise NotADirectoryError(dirpath)
+        vaults.append((path.normcase(dirpath), profile.strip()))
+
+    VAULTS.clear()
+    VAULTS.extend(vaults)
+
+
 def _update_output_dir(data: str):
     dirpath = re.search('OUTPUT_DIR=(.*)', data)
     if dirpath is None:
@@ -146,3 +198,32 @@ def _update_styles(data: str):
         raise FileNotFoundError(user_styles)
 
     STYLES.add_user_styles(user_styles)
+
+
+def _search_bool(data: str, key: str) -> bool | None:
+    value = re.search(f'{key}=(.*)', data)
+    if value is None:
+        return None
+
+    value = value.group(1).strip().lower()
+    if value not in ('true', 'false'):
+        raise ValueError(f'"{key}" must be true or false, got {value}')
+    return value == 'true'
+
+
+def _update_bulk_insert(data: str):
+    bulk_insert = _search_bool(data, 'BULK_INSERT')
+    if bulk_insert is None:
+        return
+
+    global BULK_INSERT
+    BULK_INSERT = bulk_insert
+
+
+def _update_mirror(data: str):
+    mirror = _search_bool(data, 'MIRROR')
+    if mirror is None:
+        return
+
+    global MIRROR
+    MIRROR = mirror
@@ -0,0 +1,298 @@
+﻿import html
+import math
+import re
+import zlib
+
+from collections import Counter
+from typing import List, Tuple, Dict, Iterator
+
+# focus imports
+from progress import Progress, ensure
+
+NGRAM = 3
+HASH_BITS = 14
+ROW_BLOCK = 256
+# the dense product is used when it needs at most DENSE_MAX_BYTES and DENSE_FLOPS times the multiply-adds of the join
+DENSE_MAX_BYTES = 1 << 27
+DENSE_FLOPS = 256
+# multiply-adds of the join done at once, about 40 bytes each
+JOIN_SIZE = 1 << 20
+
+_RE_HTML_TAG = re.compile(r'<[^>]+>')
+
+
+def is_junk(x) -> bool:
+    return x == ' '
+
+
+def _upper_bound(len_a: int, counts_a: Counter, len_b: int, counts_b: Counter) -> float:
+    # SequenceMatcher.quick_ratio without building the matcher, never smaller than ratio()
+    if len_a + len_b == 0:
+        return 1.0
+    if min(len_a, len_b) == 0:
+        return 0.0
+    if len(counts_a) > len(counts_b):
+        counts_a, counts_b = counts_b, counts_a
+    matches = sum(min(n, counts_b[ch]) for ch, n in counts_a.items())
+    return 2.0 * matches / (len_a + len_b)
+
+
+class _Field:
+    __slots__ = ('text', 'counts', 'matcher')
+
+    def __init__(self, text: str):
+        self.text = text
+        self.counts = Counter(text)
+        self.matcher = None
+
+    def ratio(self, other: str) -> float:
+        # the candidate is always the second sequence, so its b2j index is built once and reused for every note
+        if self.matcher is None:
+            from difflib import SequenceMatcher
+            self.matcher = SequenceMatcher(is_junk, '', self.text)
+        self.matcher.set_seq1(other)
+        return self.matcher.ratio()
+
+
+class CandidateIndex:
+    """
+    Question and Answer of the candidates returned by notesInfo, with their character counts.
+    score() gives the same result as comparing a note against every candidate with SequenceMatcher.ratio(),
+    but the ratio is only computed for candidates whose upper bound can still change the result.
+    """
+    def __init__(self, candidates: List[dict]):
+        self._ids = []
+        self._questions: List[_Field] = []
+        self._answers: List[_Field] = []
+        for res in candidates:
+            self._ids.append(res['noteId'])
+            self._questions.append(_Field(res['fields']['Question']['value']))
+            self._answers.append(_Field(res['fields']['Answer']['value']))
+
+        self.comparisons = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    def note_ids(self) -> List[int]:
+        return list(self._ids)
+
+    def score(self, question: str, answer: str) -> Tuple[float, float, int | None]:
+        """
+        Same result as AnkiNote.set_ratio scanning every candidate in order: the highest Question and Answer ratios,
+        and as duplicate_id the last candidate that raised both running maxima.
+        The maxima are found best first by upper bound. No candidate after the first one holding a maximum can raise
+        it again, so only the candidates up to the earliest of those are scanned in order to find duplicate_id.
+        :return: q_ratio, ans_ratio and duplicate_id.
+        """
+        q_counts, ans_counts = Counter(question), Counter(answer)
+        q_cache, ans_cache = {}, {}
+
+        q_max, q_pos = self._first_max(self._questions, question, q_counts, q_cache)
+        ans_max, ans_pos = self._first_max(self._answers, answer, ans_counts, ans_cache)
+
+        if q_pos is None or ans_pos is None:
+            return q_max, ans_max, None  # one of the ratios never rises above 0
+        if q_pos == ans_pos:
+            return q_max, ans_max, self._ids[q_pos]
+
+        q_run, ans_run, dup_id = 0, 0, None
+        for i in range(min(q_pos, ans_pos) + 1):
+            q_ratio = self._bounded_ratio(self._questions[i], question, q_counts, q_run, q_cache, i)
+            ans_ratio = self._bounded_ratio(self._answers[i], answer, ans_counts, ans_run, ans_cache, i)
+
+            if q_ratio > q_run and ans_ratio > ans_run:
+                q_run = q_ratio
+                ans_run = ans_ratio
+                dup_id = self._ids[i]
+            elif q_ratio > q_run:
+                q_run = q_ratio
+            elif ans_ratio > ans_run:
+                ans_run = ans_ratio
+
+        return q_max, ans_max, dup_id
+
+    def best(self, question: str, answer: str) -> Tuple[float, float]:
+        # highest Question and highest Answer ratio, taken independently
+        q_max, _ = self._first_max(self._questions, question, Counter(question), {})
+        ans_max, _ = self._first_max(self._answers, answer, Counter(answer), {})
+        return q_max, ans_max
+
+    def _first_max(self, fields: List[_Field], text: str, counts: Counter, cache: dict) -> Tuple[float, int | None]:
+        # highest ratio above 0 and the first candidate holding it, candidates are compared in decreasing bound order
+        bounds = sorted(
+            ((_upper_bound(len(text), counts, len(f.text), f.counts), i) for i, f in enumerate(fields)),
+            key=lambda x: (-x[0], x[1])
+        )
+
+        best, pos = 0, None
+        for bound, i in bounds:
+            if bound < best or bound == 0:
+                break
+            ratio = self._ratio(fields[i], text, cache, i)
+            if ratio > best:
+                best, pos = ratio, i
+            elif ratio == best and pos is not None and i < pos:
+                pos = i
+        return best, pos
+
+    def _bounded_ratio(self, field: _Field, text: str, counts: Counter, current_max: float, cache: dict, i: int):
+        # the exact ratio, or current_max when the ratio cannot exceed it
+        if i not in cache and _upper_bound(len(text), counts, len(field.text), field.counts) <= current_max:
+            return current_max
+        return self._ratio(field, text, cache, i)
+
+    def _ratio(self, field: _Field, text: str, cache: dict, i: int) -> float:
+        if i not in cache:
+            self.comparisons += 1
+            cache[i] = field.ratio(text)
+        return cache[i]
+
+
+def build_index(candidates: List[dict] | CandidateIndex) -> CandidateIndex:
+    if isinstance(candidates, CandidateIndex):
+        return candidates
+    return CandidateIndex(candidates)
+
+
+def plain_text(rendered: str) -> str:
+    # the text of a rendered field, without the markup every note shares
+    return html.unescape(_RE_HTML_TAG.sub(' ', rendered)).strip()
+
+
+def _ngram_counts(text: str) -> Dict[int, int]:
+    # character n-grams hashed into 2**HASH_BITS buckets, crc32 so the buckets do not change between runs
+    mask = (1 << HASH_BITS) - 1
+    counts = {}
+    if text == '':
+        return counts  # similar to nothing, not to every other empty text
+    for i in range(max(len(text) - NGRAM + 1, 1)):
+        h = zlib.crc32(text[i:i + NGRAM].encode('utf-8')) & mask
+        counts[h] = counts.get(h, 0) + 1
+    return counts
+
+
+def batch_duplicates(texts: List[str], threshold: float, progress: Progress = None) -> List[Tuple[int, int, float]]:
+    """
+    All-pairs cosine similarity of the hashed character n-gram vectors of texts, strip the markup first (plain_text).
+    With NumPy, an optional dependency (pip install numpy), blocks of ROW_BLOCK texts are compared at once, otherwise
+    only pairs sharing an n-gram are compared through an inverted index of the n-grams, in pure Python.
+    :param progress: checked and advanced once per ROW_BLOCK texts.
+    :return: (i, j, similarity) of every pair i < j with similarity >= threshold, sorted.
+    """
+    vectors = [_ngram_counts(t) for t in texts if t is not None]
+    if len(vectors) != len(texts):
+        raise ValueError('texts must not contain None')
+    progress = ensure(progress)
+    progress.start('comparing notes', len(texts))
+    if len(texts) < 2:
+        return []
+
+    try:
+        import numpy
+    except ImportError:
+        return _batch_duplicates_sparse(vectors, threshold, progress)
+
+    n = len(vectors)
+    lengths = numpy.fromiter((len(vec) for vec in vectors), dtype=numpy.int64, count=n)
+    indptr = numpy.concatenate(([0], numpy.cumsum(lengths)))
+    indices = numpy.fromiter((h for vec in vectors for h in vec), dtype=numpy.int64, count=indptr[-1])
+    data = numpy.fromiter((c for vec in vectors for c in vec.values()), dtype=numpy.float64, count=indptr[-1])
+    rows = numpy.repeat(numpy.arange(n), lengths)
+    norms = numpy.sqrt(numpy.bincount(rows, weights=data * data, minlength=n))
+    data /= numpy.where(norms == 0, 1, norms)[rows]
+
+    # the join does a multiply-add per pair of texts sharing an n-gram, the dense product n * n per n-gram in use:
+    # few distinct n-grams shared by most texts are faster dense, many rare ones joined
+    postings = numpy.bincount(indices, minlength=1 << HASH_BITS)
+    used = numpy.flatnonzero(postings)
+    shared = int((postings * (postings - 1) // 2).sum())
+    if n * len(used) * 4 <= DENSE_MAX_BYTES and n * n * len(used) <= DENSE_FLOPS * shared:
+        blocks = _dense_blocks(n, rows, numpy.searchsorted(used, indices), len(used), data, threshold)
+    else:
+        blocks = _joined_blocks(n, indptr, indices, rows, data, threshold)
+
+    pairs = []
+    for block_size, block_pairs in blocks:
+        pairs.extend(block_pairs)
+        progress.advance(block_size)
+        progress.check()
+    return sorted(pairs)
+
+
+def _dense_blocks(n: int, rows, cols, n_cols: int, data, threshold: float) -> Iterator[Tuple[int, List]]:
+    # n x n_cols float32 matrix of the n-grams in use, each block of rows against the rows from its first on
+    import numpy
+    matrix = numpy.zeros((n, n_cols), dtype=numpy.float32)
+    matrix[rows, cols] = data
+    for start in range(0, n, ROW_BLOCK):
+        sims = matrix[start:start + ROW_BLOCK] @ matrix[start:].T
+        r, c = numpy.nonzero(sims >= threshold)
+        keep = r < c
+        r, c = r[keep], c[keep]
+        yield len(sims), list(zip((r + start).tolist(), (c + start).tolist(), sims[r, c].tolist()))
+
+
+def _joined_blocks(n: int, indptr, indices, rows, data, threshold: float) -> Iterator[Tuple[int, List]]:
+    # sparse product of the CSR rows with themselves, upper triangle only, accumulated a block of rows at a time
+    import numpy
+
+    # n-grams sorted by bucket then row: the later rows holding the bucket of an n-gram follow its key
+    keys = indices * n + rows
+    sorted_keys = numpy.sort(keys)
+    order = numpy.argsort(keys)
+    other_rows, other_data = rows[order], data[order]
+    firsts = numpy.searchsorted(sorted_keys, keys + 1)
+    counts = numpy.searchsorted(sorted_keys, (indices + 1) * n) - firsts
+
+    for start in range(0, n, ROW_BLOCK):
+        stop = min(start + ROW_BLOCK, n)
+        sims = numpy.zeros((stop - start) * n)
+
+        # the n-grams of the block in chunks of about JOIN_SIZE multiply-adds
+        a, b = indptr[start], indptr[stop]
+        ends = numpy.cumsum(counts[a:b])
+        e = a
+        while e < b:
+            done = ends[e - a - 1] if e > a else 0
+            last = max(a + int(numpy.searchsorted(ends, done + JOIN_SIZE, 'right')), e + 1)
+            c = counts[e:last]
+            total = int(ends[last - a - 1] - done)
+            if total > 0:
+                other = numpy.repeat(firsts[e:last] - (numpy.cumsum(c) - c), c) + numpy.arange(total)
+                weights = numpy.repeat(data[e:last], c) * other_data[other]
+                cells = numpy.repeat((rows[e:last] - start) * n, c) + other_rows[other]
+                sims += numpy.bincount(cells, weights=weights, minlength=len(sims))
+            e = last
+
+        hits = numpy.flatnonzero(sims >= threshold)
+        yield stop - start, [
+            (start + cell // n, cell % n, sim) for cell, sim in zip(hits.tolist(), sims[hits].tolist())
+        ]
+
+
+def _batch_duplicates_sparse(
+        vectors: List[Dict[int, int]], threshold: float, progress: Progress
+) -> List[Tuple[int, int, float]]:
+    # same as batch_duplicates without NumPy, only pairs sharing at least one n-gram are compared
+    norms = [math.sqrt(sum(n * n for n in vec.values())) for vec in vectors]
+
+    postings: Dict[int, List[Tuple[int, int]]] = {}
+    pairs = []
+    for j, vec in enumerate(vectors):
+        if j % ROW_BLOCK == 0:
+            progress.check()
+            if j > 0:
+                progress.advance(ROW_BLOCK)
+        dots: Dict[int, int] = {}
+        for h, n in vec.items():
+            for i, m in postings.get(h, ()):
+                dots[i] = dots.get(i, 0) + n * m
+            postings.setdefault(h, []).append((j, n))
+
+        for i, dot in dots.items():
+            sim = dot / (norms[i] * norms[j]) if norms[i] and norms[j] else 0.0
+            if sim >= threshold:
+                pairs.append((i, j, sim))
+    progress.advance(len(vectors) - progress.done)
+    return sorted(pairs)
@@ -0,0 +1,126 @@
+﻿import hashlib
+import json
+import os
+
+from os import path
+from typing import Dict, Iterable, List
+
+# focus imports
+import settings
+import anki_handler
+from anki_handler import AnkiNote, MODEL_NAME, SOURCE_FIELD
+
+SOURCE_MAP_NAME = 'source_map.json'
+NOTES_INFO_CHUNK = 500
+
+
+def field_hash(note: AnkiNote) -> str:
+    # fields, deck and tags: moving a note to another deck or tag in the vault updates it too
+    sha = hashlib.sha1()
+    for name, value in note.fields().items():
+        sha.update(name.encode('utf-8') + b'\0' + value.encode('utf-8') + b'\0')
+    sha.update(note.deck.encode('utf-8') + b'\0')
+    sha.update(' '.join(sorted(note.convert_to_nested_tags())).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class SourceMap:
+    """
+    Source ID of each vault note -> ID of the Anki note created from it and hash of the fields last pushed, per profile.
+    open() drops the links to notes deleted in Anki with a single findNotes, then plan() links the notes found in the
+    map to their Anki note without any AnkiConnect call: notes whose fields did not change are skipped, the others are
+    updated by note ID.
+    The source ID holds the questions of the note, a vault note whose question changed is a new note: it is checked
+    with canAdd and the duplicate scoring like any unknown note, and its old link stays until its Anki note is deleted.
+    """
+    def __init__(self, filepath: str, profile: str):
+        self.filepath = filepath
+        self.profile = profile
+
+        # profile -> {source ID -> [note ID, field hash]}
+        self._profiles: Dict[str, Dict[str, List]] = {}
+        if path.isfile(filepath):
+            with open(filepath, 'r', encoding='utf-8') as fp:
+                self._profiles = json.load(fp)
+
+        if profile not in self._profiles:
+            self._profiles[profile] = {}
+            self._rebuild()
+        self._sources = self._profiles[profile]
+
+    @classmethod
+    def open(cls) -> 'SourceMap':
+        from journal import SyncJournal
+
+        source_map = cls(path.join(settings.OUTPUT_DIR, SOURCE_MAP_NAME), settings.PROFILE)
+        # notes pushed by a sync that stopped before recording them here
+        SyncJournal.open().recover(source_map)
+        source_map.prune()
+        return source_map
+
+    def __len__(self):
+        return len(self._sources)
+
+    def plan(self, notes: Iterable[AnkiNote]) -> List[AnkiNote]:
+        """
+        Sets the status and duplicate_id of the notes found in the map.
+        :return: the notes not found in the map, to be checked with canAddNotesWithErrorDetail as before.
+        """
+        unknown = []
+        for note in notes:
+            entry = self._sources.get(note.source_id) if note.source_id is not None else None
+            if entry is None:
+                unknown.append(note)
+            else:
+                note.set_source_match(entry[0], entry[1] == field_hash(note))
+        return unknown
+
+    def record(self, notes: List[AnkiNote], results: List[int | None]) -> None:
+        # results as returned by anki_handler.push_notes, None for the notes that failed
+        for note, note_id in zip(notes, results):
+            if note.source_id is None:
+                continue
+            if note_id is None:
+                if note.is_source_update():
+                    # the linked note is gone from the collection, it is added again on the next sync
+                    self._sources.pop(note.source_id, None)
+                continue
+            self._sources[note.source_id] = [note_id, field_hash(note)]
+
+    def link(self, source_id: str, note_id: int, digest: str) -> None:
+        self._sources[source_id] = [note_id, digest]
+
+    def forget(self, note_ids: Iterable[int]) -> None:
+        note_ids = set(note_ids)
+        for source_id in [s for s, (note_id, _) in self._sources.items() if note_id in note_ids]:
+            del self._sources[source_id]
+
+    def prune(self) -> int:
+        """
+        Drops the links to notes no longer in the collection, so their vault notes are added again.
+        :return: the number of links dropped.
+        """
+        if len(self._sources) == 0:
+            return 0
+        existing = set(anki_handler.invoke('findNotes', query=f'"note:{MODEL_NAME}"'))
+        missing = [note_id for note_id, _ in self._sources.values() if note_id not in existing]
+        self.forget(missing)
+        if len(missing) > 0:
+            print(f'\t{len(missing)} linked notes were deleted in Anki, they are added again')
+        return len(missing)
+
+    def save(self) -> None:
+        tmp = self.filepath + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            json.dump(self._profiles, fp)
+        os.replace(tmp, self.filepath)
+
+    def _rebuild(self) -> None:
+        # first use of this profile, read the Source field of the notes already in the collection
+        note_ids = anki_handler.invoke('findNotes', query=f'"note:{MODEL_NAME}"')
+        for k in range(0, len(note_ids), NOTES_INFO_CHUNK):
+            for res in anki_handler.invoke('notesInfo', notes=note_ids[k:k + NOTES_INFO_CHUNK]):
+                source = res.get('fields', {}).get(SOURCE_FIELD) if res else None
+                if source is not None and source['value'] != '':
+                    # the hash is unknown, the first sync updates the note once
+                    self._profiles[self.profile][source['value']] = [res['noteId'], '']
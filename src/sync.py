@@ -0,0 +1,328 @@
+﻿import time
+
+from os import path
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+# focus imports
+import media
+import printer
+import settings
+import anki_handler
+from anki_handler import AnkiNote
+from crawler import VaultCrawler, ObsidianNote, link_index_path, vault_name
+from mirror import AnkiMirror
+from pipeline import threaded
+from progress import ConsoleProgress
+from sources import SourceMap
+from journal import SyncJournal, ADD
+
+REPORT_COLUMNS = ('profile', 'vault', 'notes', 'invalid', 'added', 'updated', 'unchanged', 'review', 'failed', 'time')
+
+
+class VaultReport:
+    """ What --sync did with one vault, a row of the combined report. """
+    def __init__(self, vault: str, profile: str):
+        self.vault = vault
+        self.profile = profile
+
+        self.notes = 0
+        self.invalid = 0
+        self.added = 0
+        self.updated = 0
+        self.unchanged = 0
+        # neither new nor linked by source ID, similar notes need a decision in the wizard
+        self.review = 0
+        self.failed = 0
+        self.seconds = 0.0
+        self.error: str | None = None
+
+    def row(self) -> List[str]:
+        return [
+            self.profile, self.vault, str(self.notes), str(self.invalid), str(self.added), str(self.updated),
+            str(self.unchanged), str(self.review), str(self.failed), f'{self.seconds:.1f} s'
+        ]
+
+
+def prepare_vault(vault: str) -> Tuple[List[AnkiNote], int, float]:
+    """
+    Crawls, converts and renders a vault, the part of a sync that does not need Anki. Runs in a worker process.
+    :return: the notes, the number of invalid notes and the time it took.
+    """
+    start = time.perf_counter()
+    crawler = VaultCrawler(vault, index_path=link_index_path(settings.OUTPUT_DIR, vault))
+    crawler.convert_files()
+    notes = list(printer.render_notes(crawler.valid_notes))
+    return notes, len(crawler.invalid_notes), time.perf_counter() - start
+
+
+def stream_vault(report: VaultReport, filepaths: List[str] = None) -> Iterator[AnkiNote]:
+    """
+    prepare_vault as a pipeline, for the vault of report or for filepaths only: the vault is read and converted on a
+    worker thread and rendered on another one (pipeline.threaded), while the caller checks the notes already rendered
+    with Anki. Nothing runs before the first note is asked for. report.invalid is set once every note was consumed.
+    """
+    crawler = VaultCrawler(report.vault, crawl=False, index_path=link_index_path(settings.OUTPUT_DIR, report.vault))
+    if filepaths is None:
+        converted = _crawled(crawler)
+    else:
+        converted = crawler.iter_converted_paths(filepaths)
+    yield from threaded(printer.render_notes(threaded(converted)))
+
+    report.invalid = len(crawler.invalid_notes)
+    if filepaths is not None:
+        for rp, reason in crawler.invalid_files.items():
+            print(f'WARNING: {rp} is not an Anki file, {reason}')
+        for md_note in crawler.invalid_notes:
+            print(f'WARNING: invalid note in {md_note.relative_path}, {md_note.get_invalid_reason()}')
+
+
+def _crawled(crawler: VaultCrawler) -> Iterator[ObsidianNote]:
+    crawler.reset()
+    yield from crawler.iter_converted()
+
+
+def sync_all(vaults: List[Tuple[str, str]], settings_path: str, workers: int = None) -> List[VaultReport]:
+    """
+    Syncs every (vault, profile) without the wizard. The vaults are prepared in parallel worker processes, then the
+    AnkiConnect part runs one profile at a time, AnkiConnect only has one profile loaded. The first vault is streamed
+    instead (stream_vault): it is converted and rendered while its notes are checked, the others are prepared
+    meanwhile. Only notes that need no decision are pushed: new notes with no similar note in Anki and notes changed
+    since the last sync.
+    :param settings_path: settings.txt, read again by each worker process.
+    :return: one report per vault, in the order of vaults.
+    """
+    reports = [VaultReport(vault, profile) for vault, profile in vaults]
+    clashes = _name_clashes(vaults)
+    for report in reports:
+        if (report.vault, report.profile) in clashes:
+            report.error = _clash_error(clashes[(report.vault, report.profile)])
+
+    # profile -> reports of its vaults, in the order the profiles first appear
+    by_profile: Dict[str, List[VaultReport]] = {}
+    for report in reports:
+        by_profile.setdefault(report.profile, []).append(report)
+
+    # the Anki part would wait for the whole preparation of the first vault, it is streamed in this process instead
+    streamed = next((r for rs in by_profile.values() for r in rs if r.error is None), None)
+
+    current_profile = settings.PROFILE
+    pool = ProcessPoolExecutor(workers, initializer=settings.update_with_user_settings, initargs=(settings_path,))
+    with pool:
+        futures = {
+            report: pool.submit(prepare_vault, report.vault)
+            for report in reports if report.error is None and report is not streamed
+        }
+
+        # the first profile is pushed while the vaults of the next ones are still being prepared
+        for profile, profile_reports in by_profile.items():
+            prepared: List[Tuple[VaultReport, Iterable[AnkiNote]]] = []
+            for report in profile_reports:
+                if report is streamed:
+                    prepared.append((report, stream_vault(report)))
+                    continue
+                if report not in futures:
+                    continue
+                try:
+                    notes, report.invalid, report.seconds = futures[report].result()
+                except Exception as ex:
+                    report.error = f'unable to read the vault: {ex}'
+                    continue
+                prepared.append((report, notes))
+
+            if len(prepared) > 0:
+                print(f'Syncing {len(prepared)} vaults with profile {profile}')
+                _sync_profile(profile, prepared)
+
+    settings.PROFILE = current_profile
+    return reports
+
+
+def sync_files(filepaths: List[str], vaults: List[Tuple[str, str]]) -> List[VaultReport]:
+    """
+    Syncs the notes of filepaths only, each file with the profile of the vault holding it. The files are converted
+    with VaultCrawler.iter_converted_paths(), so a vault is not crawled while its link index is up to date, and
+    streamed to the Anki checks (stream_vault).
+    :return: one report per vault holding some of the files.
+    """
+    by_vault: Dict[Tuple[str, str], List[str]] = {}
+    for filepath in filepaths:
+        mapping = _find_vault(filepath, vaults)
+        if mapping is None:
+            raise ValueError(f'{filepath} is not in any vault of settings.txt')
+        by_vault.setdefault(mapping, []).append(filepath)
+
+    reports = []
+    clashes = _name_clashes(vaults)
+    by_profile: Dict[str, List[Tuple[VaultReport, Iterable[AnkiNote]]]] = {}
+    for (vault, profile), files in by_vault.items():
+        report = VaultReport(vault, profile)
+        reports.append(report)
+        if (vault, profile) in clashes:
+            report.error = _clash_error(clashes[(vault, profile)])
+            continue
+        by_profile.setdefault(profile, []).append((report, stream_vault(report, files)))
+
+    current_profile = settings.PROFILE
+    for profile, prepared in by_profile.items():
+        _sync_profile(profile, prepared)
+    settings.PROFILE = current_profile
+    return reports
+
+
+def _name_clashes(vaults: List[Tuple[str, str]]) -> Dict[Tuple[str, str], str]:
+    """
+    The vault name is part of the source IDs, two vaults of a profile with the same name would update each other.
+    :return: (vault, profile) -> the first vault of that profile with the same name, for every later one.
+    """
+    first: Dict[Tuple[str, str], str] = {}
+    clashes = {}
+    for vault, profile in vaults:
+        key = (profile, vault_name(vault))
+        if key in first and path.normpath(first[key]) != path.normpath(vault):
+            clashes[(vault, profile)] = first[key]
+        first.setdefault(key, vault)
+    return clashes
+
+
+def _clash_error(other: str) -> str:
+    return f'same folder name as {other}, rename one of them to sync both with this profile'
+
+
+def _find_vault(filepath: str, vaults: List[Tuple[str, str]]) -> Tuple[str, str] | None:
+    # the innermost vault holding filepath
+    filepath = path.normcase(path.abspath(filepath))
+    found = None
+    for vault, profile in vaults:
+        if filepath.startswith(path.normcase(path.normpath(vault)) + path.sep):
+            if found is None or len(vault) > len(found[0]):
+                found = (vault, profile)
+    return found
+
+
+def _sync_profile(profile: str, prepared: List[Tuple[VaultReport, Iterable[AnkiNote]]]) -> None:
+    settings.PROFILE = profile
+    try:
+        is_startup_ok, _ = anki_handler.startup()
+        if not is_startup_ok:
+            raise ValueError(f'the {anki_handler.MODEL_NAME} model needs changes, open this profile with the wizard')
+        source_map = SourceMap.open()
+    except Exception as ex:
+        for report, _ in prepared:
+            report.error = str(ex)
+        return
+
+    # a single journal sync for the vaults of the profile, --revert-last reverts all of them
+    journal = SyncJournal.open()
+    journal.begin()
+    is_complete = True
+    for report, notes in prepared:
+        start = time.perf_counter()
+        try:
+            _sync_notes(report, notes, source_map, journal)
+        except Exception as ex:
+            report.error = str(ex)
+            is_complete = False
+        finally:
+            # notes pushed before an error are still recorded
+            source_map.save()
+        report.seconds += time.perf_counter() - start
+
+    if is_complete:
+        journal.end()
+    # otherwise the sync stays open, the next SourceMap.open() recovers the notes pushed before the error
+
+
+def _sync_notes(report: VaultReport, notes: Iterable[AnkiNote], source_map: SourceMap, journal: SyncJournal) -> None:
+    # notes is a list prepared by prepare_vault or the notes of stream_vault, checked as they are rendered
+    progress = ConsoleProgress()
+    anki_mirror = AnkiMirror.open() if settings.MIRROR else None
+    if anki_mirror is not None:
+        anki_mirror.refresh()
+
+    def select(chunk: List[AnkiNote]) -> List[AnkiNote]:
+        # notes pushed by a previous sync are linked through their source ID, only new notes are checked
+        unknown = source_map.plan(chunk)
+        return anki_mirror.check_notes(unknown) if anki_mirror is not None else unknown
+
+    try:
+        total = len(notes) if isinstance(notes, list) else None
+        notes = anki_handler.check_notes_stream(notes, select, total, progress=progress)
+    finally:
+        if anki_mirror is not None:
+            anki_mirror.close()
+    report.notes = len(notes)
+
+    pushed = [n for n in notes if n.is_valid() or n.is_source_update()]
+    report.unchanged = len([n for n in notes if n.is_unchanged()])
+    report.review = len(notes) - len(pushed) - report.unchanged
+    if len(pushed) == 0:
+        return
+
+    for name, error in media.store_media(pushed, progress=progress).items():
+        print(f'WARNING: unable to store {name} error={error}')
+
+    journal.extend(pushed)
+
+    def checkpoint(indices, note_ids):
+        journal.done(pushed, indices, note_ids)
+
+    if settings.BULK_INSERT:
+        results = anki_handler.push_notes(pushed, progress=progress, checkpoint=checkpoint)
+    else:
+        results = anki_handler.push_notes_sequential(pushed, progress, checkpoint)
+    source_map.record(pushed, results)
+    source_map.save()
+
+    for note, res in zip(pushed, results):
+        if res is None:
+            report.failed += 1
+        elif note.is_source_update():
+            report.updated += 1
+        else:
+            report.added += 1
+
+
+def revert_last(profile: str) -> int:
+    """
+    Deletes the notes added by the last sync of profile that pushed notes and was not reverted, every vault of that
+    sync, from its journal, so it works after a restart or a crash. Updated notes were in the collection before that
+    sync and are left as they are.
+    :return: the number of deleted notes.
+    """
+    settings.PROFILE = profile
+    anki_handler.startup()
+    source_map = SourceMap.open()
+    journal = SyncJournal.open()
+
+    last = journal.last_sync()
+    if last is None:
+        print(f'No sync of {profile} to revert')
+        return 0
+    sync_id, pushed = last
+
+    added = [note_id for action, note_id in pushed if action == ADD]
+    anki_handler.invoke('deleteNotes', notes=added)
+    source_map.forget(added)
+    source_map.save()
+    journal.revert(sync_id, added)
+    print(f'Reverted the last sync of {profile}: {len(added)} notes deleted, '
+          f'{len(pushed) - len(added)} updated notes left as they are')
+    return len(added)
+
+
+def print_report(reports: List[VaultReport]) -> None:
+    rows = [list(REPORT_COLUMNS)] + [r.row() for r in reports]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(REPORT_COLUMNS))]
+    for row in rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+    for report in reports:
+        if report.error is not None:
+            print(f'WARNING: {report.vault} ({report.profile}) {report.error}')
+
+    notes, added, updated, review, failed = [
+        sum(getattr(r, name) for r in reports) for name in ('notes', 'added', 'updated', 'review', 'failed')
+    ]
+    print(f'{len(reports)} vaults, {notes} notes: {added} added, {updated} updated, {review} to review in the wizard, '
+          f'{failed} failed')